@@ -21,17 +21,17 @@
 
 import logging
 import pathlib
-import zipfile
+import sys
 
-import requests
+# imports src
+sys.path.append("../")
+from src import download, extract  # noqa
 
 # In[21]:
 
 
 # downloading the data
 log_file_name = pathlib.Path("download_log.log")
-chunk_size_download = 81920
-control_url = ""
 train_url = "https://github.com/wayscience/mitocheck_data/raw/main/3.normalize_data/normalized_data/training_data.csv.gz"
 control_url = "https://zenodo.org/records/7967386/files/3.normalize_data__normalized_data.zip?download=1"
 
@@ -42,6 +42,36 @@ control_out_path = raw_dir / "3.normalized_data.zip"
 train_out_path = raw_dir / train_outname
 control_unzip_path = raw_dir / "normalized_data"
 
+# expected sizes of the downloaded files, as served on 2023-12-05
+train_size = 38934164
+control_size = 18097771757
+
+# expected checksums of the downloaded files ("sha256:{hex digest}"). Files without
+# a checksum are refused unless `allow_unverified` is True, their checksum is then
+# logged so it can be pinned here.
+train_checksum = None
+control_checksum = None
+allow_unverified = False
+
+# local directory or base URL containing the files under their output names, used
+# instead of the original servers (e.g. on compute nodes without internet access)
+mirror = None
+
+# number of files downloaded concurrently
+n_workers = 2
+
+# if True, the training dataset is transcoded into a parquet file while it is
+# downloaded, the CSV file is never written to disk
+transcode_training = False
+
+# members of the control dataset used by the analysis, other members are never
+# extracted. Add "positive_control_data.csv.gz" to extract the positive controls.
+control_members = ["negative_control_data.csv.gz"]
+
+# if True, the control members are transcoded into parquet files while they are
+# extracted, the CSV files are never written to disk
+transcode_controls = False
+
 
 # setting up logger
 logging.basicConfig(
@@ -54,39 +84,42 @@ logging.basicConfig(
 # In[16]:
 
 
-# downloading training data using requests
-logging.info(f"Downloading trianing set data from: {train_url}")
-with requests.get(train_url, stream=True) as r:
-    # raise error if the there's an error
-    r.raise_for_status()
-    logging.info(f"Downloading training dataset: {r.headers.get('Content-Length')}MB")
-
-    # creating a file to write the downloaded contents in chunks
-    with open(train_out_path, mode="wb") as out_file:
-        for chunk in r.iter_content(chunk_size=chunk_size_download):
-            out_file.write(chunk)
-
-
-# In[17]:
-
-
-# downloading control data using requests
-logging.info(f"Downloading control dataset from: {train_url}")
-with requests.get(control_url, stream=True) as r:
-    # raise error if the there's an error
-    r.raise_for_status()
-    logging.info(f"Downloading control dataset: {r.headers.get('Content-Length')}MB")
-
-    # creating a file to write the downloaded contents in chunks
-    with open(control_out_path, mode="wb") as out_file:
-        for chunk in r.iter_content(chunk_size=1024**2):
-            out_file.write(chunk)
+# downloading the training and control datasets concurrently. Interrupted downloads
+# are resumed and files that are already downloaded and verified are skipped
+logging.info(f"Downloading training dataset from: {train_url}")
+logging.info(f"Downloading control dataset from: {control_url}")
+download.download_files(
+    [
+        download.RemoteFile(
+            url=train_url,
+            out_path=(
+                raw_dir / "training_data.parquet"
+                if transcode_training
+                else train_out_path
+            ),
+            size=train_size,
+            checksum=train_checksum,
+            transcode=transcode_training,
+        ),
+        download.RemoteFile(
+            url=control_url,
+            out_path=control_out_path,
+            size=control_size,
+            checksum=control_checksum,
+        ),
+    ],
+    mirror=mirror,
+    n_workers=n_workers,
+    allow_unverified=allow_unverified,
+)
 
 
 # In[25]:
 
 
-# next is to unzip the control dataset inside the raw data folder
-logging.info(f"Unzipping control dataset into: {raw_dir}")
-with zipfile.ZipFile(control_out_path, mode="r") as zip_ref:
-    zip_ref.extractall(raw_dir)
+# next is to extract the selected members of the control dataset inside the raw data
+# folder, members are streamed out of the archive one at a time
+logging.info(f"Extracting {control_members} from control dataset into: {raw_dir}")
+extract.extract_members(
+    control_out_path, control_members, raw_dir, transcode=transcode_controls
+)
@@ -7,16 +7,27 @@
 import logging
 import pathlib
 import sys
-from typing import Optional
+from typing import Dict
 
 import numpy as np
 import pandas as pd
-from copairs.map import run_pipeline
-from pycytominer import feature_select
 
 # imports src
 sys.path.append("../")
-from src import utils  # noqa
+from src import (  # noqa
+    average_precision,
+    feature_selection,
+    feature_store,
+    loader,
+    metadata_codec,
+    pair_index,
+    resampling,
+    results_store,
+    scheduler,
+    similarity,
+    stage_cache,
+    utils,
+)
 
 # setting up logger
 logging.basicConfig(
@@ -26,120 +37,57 @@ logging.basicConfig(
 )
 
 
-# ## Helper functions
-# Set of helper functions to help out throughout the notebook
-
-# In[2]:
-
-
-## Helper function
-def shuffle_meta_labels(
-    dataset: pd.DataFrame, target_col: str, seed: Optional[int] = 0
-) -> pd.DataFrame:
-    """shuffles labels or values within a single selected column
-
-    Parameters
-    ----------
-    dataset : pd.DataFrame
-        dataframe containing the dataset
-
-    target_col : str
-        Column to select in order to conduct the shuffling
-
-    seed : int
-        setting random seed
-
-    Returns
-    -------
-    pd.DataFrame
-        shuffled dataset
-
-    Raises
-    ------
-    TypeError
-        raised if incorrect types are provided
-    """
-    # setting seed
-    np.random.seed(seed)
-
-    # type checking
-    if not isinstance(target_col, str):
-        raise TypeError("'target_col' must be a string type")
-    if not isinstance(dataset, pd.DataFrame):
-        raise TypeError("'dataset' must be a pandas dataframe")
-
-    # selecting column, shuffle values within column, add to dataframe
-    dataset[target_col] = np.random.permutation(dataset[target_col].values)
-    return dataset
-
-
-def shuffle_features(feature_vals: np.array, seed: Optional[int] = 0) -> np.array:
-    """suffles all values within feature space
-
-    Parameters
-    ----------
-    feature_vals : np.array
-        shuffled
-
-    seed : Optional[int]
-        setting random seed
-
-    Returns
-    -------
-    np.array
-        Returns shuffled values within the feature space
-
-    Raises
-    ------
-    TypeError
-        Raised if a numpy array is not provided
-    """
-    # setting seed
-    np.random.seed(seed)
-
-    # shuffle given array
-    if not isinstance(feature_vals, np.ndarray):
-        raise TypeError("'feature_vals' must be a numpy array")
-    if feature_vals.ndim != 2:
-        raise TypeError("'feature_vals' must be a 2x2 matrix")
-
-    # creating a copy for feature vales to prevent overwriting of global variables
-    feature_vals = np.copy(feature_vals)
-
-    # shuffling feature space
-    n_cols = feature_vals.shape[1]
-    for col_idx in range(0, n_cols):
-        # selecting column, shuffle, and update:
-        feature_vals[:, col_idx] = np.random.permutation(feature_vals[:, col_idx])
-
-    return feature_vals
-
-
 # ## Setting up Paths and loading data
 
 # In[3]:
 
 
 # parameters
-training_singlecell_data = pathlib.Path("../data/raw/training_data.csv.gz").resolve(
-    strict=True
-)
+# profiles transcoded into parquet while downloading or extracting them (see
+# data/download.py) are loaded directly, the CSV files are used otherwise
+training_singlecell_data = pathlib.Path("../data/raw/training_data.parquet")
+if not training_singlecell_data.is_file():
+    training_singlecell_data = pathlib.Path("../data/raw/training_data.csv.gz")
+training_singlecell_data = training_singlecell_data.resolve(strict=True)
 neg_control_data = pathlib.Path(
-    "../data/raw/normalized_data/negative_control_data.csv.gz"
-).resolve(strict=True)
+    "../data/raw/normalized_data/negative_control_data.parquet"
+)
+if not neg_control_data.is_file():
+    neg_control_data = pathlib.Path(
+        "../data/raw/normalized_data/negative_control_data.csv.gz"
+    )
+neg_control_data = neg_control_data.resolve(strict=True)
 
 # output directories
 map_out_dir = pathlib.Path("../data/processed/mAP_scores/")
 map_out_dir.mkdir(parents=True, exist_ok=True)
 
+# directory containing the parquet files generated from the raw CSV files
+profile_cache_dir = pathlib.Path("../data/processed/profile_cache/")
+
+# directory containing the memory-mapped arrays shared with the worker processes
+feature_store_dir = pathlib.Path("../data/processed/feature_store/")
+
+# directory containing the null distributions used to compute p-values
+null_cache_dir = pathlib.Path("../data/processed/null_cache/")
+
+# directory containing the artefacts of the analysis stages (selected features, mAP
+# results), keyed by a hash of their parameters and inputs. Stages are only computed
+# again when their parameters or inputs change.
+analysis_stages = stage_cache.StageCache("../data/processed/stage_cache/")
+
 
 # In[4]:
 
 
-# training_sc_data = pd.read_parquet("../data/processed/training_sc_data.parquet")
-# neg_control_sc_data = pd.read_parquet("../data/processed/neg_control_sc_data.parquet")
-training_sc_data = pd.read_csv(training_singlecell_data).drop("Unnamed: 0", axis=1)
-neg_control_sc_data = pd.read_csv(neg_control_data)
+# loading profiles through the parquet cache
+# the CSV files are only parsed in the first run, next runs read the cached files
+training_sc_data = loader.load_profiles(
+    training_singlecell_data, cache_dir=profile_cache_dir
+).drop("Unnamed: 0", axis=1)
+neg_control_sc_data = loader.load_profiles(
+    neg_control_data, cache_dir=profile_cache_dir
+)
 
 # adding the Mitocheck_Phenotypic_Class into the controls  and labels
 neg_control_sc_data.insert(0, "Mitocheck_Phenotypic_Class", "neg_control")
@@ -151,81 +99,49 @@ neg_control_sc_data.insert(1, "Metadata_is_control", 1)
 # droping column from trainign data since it does not exist in the controls
 training_sc_data = training_sc_data.drop("Metadata_Object_Outline", axis=1)
 
+# encoding the phenotype labels, cell identifiers, plates and wells into integer
+# codes shared by both datasets. Pairs are found and results are stored on the
+# codes, the values are only decoded when the results are saved
+meta_codec = metadata_codec.MetadataCodec.fit([training_sc_data, neg_control_sc_data])
+training_sc_data = meta_codec.encode(training_sc_data)
+neg_control_sc_data = meta_codec.encode(neg_control_sc_data)
+
 
 print("control shape:", neg_control_sc_data.shape)
 print("training shape:", training_sc_data.shape)
 
 
 # ## Applying Pycytominer Selected features data
+# Feature selection is applied once on the CP features of the training and control
+# profiles together, so both datasets keep the same CP features. Feature statistics
+# are streamed from the cached profile files in row batches, so feature selection
+# does not need a copy of the profiles in memory. The selected features are cached
+# as a stage and only selected again if the files or the parameters change.
 
 # In[5]:
 
 
-# applying cytominer feature selection trianing data
+# applying cytominer feature selection on training and negative control data
 cp_cols = [
     colname for colname in training_sc_data.columns if colname.startswith("CP__")
 ]
-
-# # extracting only CP features
-train_meta, train_features = utils.split_data(training_sc_data, dataset="CP")
-cp_data = pd.concat([train_meta, pd.DataFrame(train_features)], axis=1)
-cp_data.columns = train_meta.columns.tolist() + cp_cols
-
-# applying pycytominer feature select
-# had to specify the feature names since the defaults did not match
-pycytm_cp_training_feats_df = feature_select(cp_data, features=cp_cols)
-pycytm_cp_training_feats_df = pycytm_cp_training_feats_df[
-    [
-        cols
-        for cols in pycytm_cp_training_feats_df.columns.tolist()
-        if cols.startswith("CP__")
-    ]
-]
-del cp_data
-
-# now update loaded dataset with pycytominer selected features to trainin dataset
-# remove old CP features and added new pycytominer selected CP_features
-training_sc_data = training_sc_data[
-    [col for col in training_sc_data.columns.tolist() if not col.startswith("CP__")]
-]
-training_sc_data = pd.concat([training_sc_data, pycytm_cp_training_feats_df], axis=1)
-
-
-# In[7]:
-
-
-# applying cytominer feature selection negative control data
-cp_cols = [
-    colname for colname in neg_control_sc_data.columns if colname.startswith("CP__")
-]
-
-# extracting only CP features
-neg_control_meta, neg_control_features = utils.split_data(
-    neg_control_sc_data, dataset="CP"
+cp_feature_selection = analysis_stages.run(
+    "cp_feature_selection",
+    lambda: feature_selection.select_features_streaming(
+        [training_singlecell_data, neg_control_data],
+        features=cp_cols,
+        operation="variance_threshold",
+        profile_cache_dir=profile_cache_dir,
+    ),
+    params={"features": cp_cols, "operation": "variance_threshold"},
+    inputs=[training_singlecell_data, neg_control_data],
 )
-cp_data = pd.concat([neg_control_meta, pd.DataFrame(neg_control_features)], axis=1)
-cp_data.columns = neg_control_meta.columns.tolist() + cp_cols
-
-# applying pycytominer feature select
-# had to specify the feature names since the defaults did not match
-pycytm_cp_training_feats_df = feature_select(cp_data, features=cp_cols)
-pycytm_cp_training_feats_df = pycytm_cp_training_feats_df[
-    [
-        cols
-        for cols in pycytm_cp_training_feats_df.columns.tolist()
-        if cols.startswith("CP__")
-    ]
-]
-del cp_data
+selected_cp_cols = cp_feature_selection.value
 
-# now update loaded dataset with pycytominer selected features to trainin dataset
-# remove old CP features and added new pycytominer selected features
-neg_control_sc_data = neg_control_sc_data[
-    [col for col in neg_control_sc_data.columns.tolist() if not col.startswith("CP__")]
-]
-neg_control_sc_data = pd.concat(
-    [neg_control_sc_data, pycytm_cp_training_feats_df], axis=1
-)
+# now remove the CP features that were not selected from both datasets
+dropped_cp_cols = [colname for colname in cp_cols if colname not in selected_cp_cols]
+training_sc_data = training_sc_data.drop(dropped_cp_cols, axis=1)
+neg_control_sc_data = neg_control_sc_data.drop(dropped_cp_cols, axis=1)
 
 
 # ### mAP Pipeline Parameters
@@ -247,446 +163,350 @@ batch_size = 1000
 # number of resampling
 n_resamples = 10
 
+# fraction of the control cells drawn by each resample
+control_frac = 0.010
 
-# ## Running mAP Pipeline on regular dataset
+# number of phenotype label permutations per resample
+n_label_permutations = 1
 
-# In[11]:
+# number of worker processes, None uses all CPUs
+n_workers = None
 
+# null distributions are shared by all jobs and saved for the next runs
+null_cache = average_precision.NullDistributionCache(null_cache_dir)
 
-# storing all map results based on postiive and negative controls and feature types
-logging.info("Running mAP pipeline with regular dataset")
-map_results_neg_cp = []
-map_results_neg_dp = []
-map_results_neg_cp_dp = []
-
-# running process
-# for loop selects one single phenotype
-# then splits the data into metadata and raw feature values
-# two different groups that contains 3 splits caused by the types of features
-# applie the copairs pipeline
-for phenotype in list(training_sc_data["Mitocheck_Phenotypic_Class"].unique()):
-    # select training dataset based on phenotype
-    selected_training = training_sc_data.loc[
-        training_sc_data["Mitocheck_Phenotypic_Class"] == phenotype
-    ]
-    n_entries_training = selected_training.shape[0]
-
-    # This will generated 100 values [0..100] as seed values
-    # This will occur per phenotype
-    for seed in range(0, n_resamples):
-        # concatenate to positive and negative control
-        # selecting around 0.015% of the control data, that's around 117 cells
-        training_w_neg = pd.concat(
-            [
-                selected_training,
-                neg_control_sc_data.sample(frac=0.010, random_state=seed).iloc[
-                    :n_entries_training
-                ],
-            ]
-        )
+# set to the threshold used in the plotting notebook (0.05) to stop drawing null
+# samples once a p-value is decisively above or below it, None draws all samples
+p_value_threshold = None
 
-        # spliting metadata and raw feature values
-        logging.info("splitting data set into metadata and raw feature values")
-        negative_training_cp_meta, negative_training_cp_feats = utils.split_data(
-            training_w_neg, dataset="CP"
-        )
-        negative_training_dp_meta, negative_training_dp_feats = utils.split_data(
-            training_w_neg, dataset="DP"
-        )
-        negative_training_cp_dp_meta, negative_training_cp_dp_feats = utils.split_data(
-            training_w_neg, dataset="CP_and_DP"
-        )
+# type of the similarities, "float32" halves the memory of the pool dot products and
+# ranks cells faster, but similarities closer than float32 precision become ties
+similarity_dtype = "float64"
 
-        # placing under "try" block as some phenotype may raise "DivisionByZeroError"
-        try:
-            # execute pipeline on negative control with trianing dataset with cp features
-            logging.info(f"Running pipeline on CP features using {phenotype} phenotype")
-            cp_negative_training_result = run_pipeline(
-                meta=negative_training_cp_meta,
-                feats=negative_training_cp_feats,
-                pos_sameby=pos_sameby,
-                pos_diffby=pos_diffby,
-                neg_sameby=neg_sameby,
-                neg_diffby=neg_diffby,
-                batch_size=batch_size,
-                null_size=null_size,
-            )
-
-            # adding columsn
-            cp_negative_training_result["shuffled"] = "non-shuffled"
-            cp_negative_training_result["seed_val"] = seed
-
-            # append to list
-            map_results_neg_cp.append(cp_negative_training_result)
-
-            # execute pipeline on negative control with trianing dataset with dp features
-            logging.info(f"Running pipeline on DP features using {phenotype} phenotype")
-            dp_negative_training_result = run_pipeline(
-                meta=negative_training_dp_meta,
-                feats=negative_training_dp_feats,
-                pos_sameby=pos_sameby,
-                pos_diffby=pos_diffby,
-                neg_sameby=neg_sameby,
-                neg_diffby=neg_diffby,
-                batch_size=batch_size,
-                null_size=null_size,
-            )
-
-            # adding shuffle label column
-            dp_negative_training_result["shuffled"] = "non-shuffled"
-            dp_negative_training_result["seed_val"] = seed
-
-            # append to list
-            map_results_neg_dp.append(dp_negative_training_result)
-
-            # execute pipeline on negative control with trianing dataset with cp_dp features
-            logging.info(
-                f"Running pipeline on CP and DP features using {phenotype} phenotype"
-            )
-            cp_dp_negative_training_result = run_pipeline(
-                meta=negative_training_cp_dp_meta,
-                feats=negative_training_cp_dp_feats,
-                pos_sameby=pos_sameby,
-                pos_diffby=pos_diffby,
-                neg_sameby=neg_sameby,
-                neg_diffby=neg_diffby,
-                batch_size=batch_size,
-                null_size=null_size,
-            )
-
-            # adding shuffle label column
-            cp_dp_negative_training_result["shuffled"] = "non-shuffled"
-            cp_dp_negative_training_result["seed_val"] = seed
-
-            # append to list
-            map_results_neg_cp_dp.append(cp_dp_negative_training_result)
-        except ZeroDivisionError as e:
-            logging.warning(f"{e} captured on phenotye: {phenotype}. Skipping")
-            continue
 
+# In[10]:
 
-# concatenating all datasets
-pd.concat(map_results_neg_cp).to_csv(
-    map_out_dir / "cp_sc_mAP_scores_regular.csv", index=False
-)
-pd.concat(map_results_neg_dp).to_csv(
-    map_out_dir / "dp_sc_mAP_scores_regular.csv", index=False
-)
-pd.concat(map_results_neg_cp_dp).to_csv(
-    map_out_dir / "cp_dp_sc_mAP_scores_regular.csv", index=False
-)
 
+# indexing the columns of the concatenated training and control profiles
+# this index is built once and used to split every resampled dataset
+feature_schema = utils.FeatureSchema.from_dataframe(
+    pd.concat([training_sc_data.iloc[:0], neg_control_sc_data.iloc[:0]])
+)
 
-# ## Running MAP Pipeline with shuffled phenotype labels
 
-# In[12]:
+# ## Building similarity cache
+# Dot products between all training cells and all the control cells that can be
+# selected by the resamples are computed once for the CP and DP feature blocks.
+# The similarity matrix of each resample is then a sub-block of the similarity matrix
+# of this pool of cells.
+#
+# The features, encoded metadata and dot products of the pool are stored in
+# memory-mapped files, worker processes attach to them instead of holding their own
+# copy.
+
+# In[ ]:
+
+
+# drawing the control cells of every seed once, all shuffling modes and feature
+# spaces of a seed use the same controls
+# the controls of a phenotype with n cells are the first n controls of the seed
+max_n_entries = training_sc_data["Mitocheck_Phenotypic_Class"].value_counts().max()
+seeds = list(range(0, n_resamples))
+control_draws = resampling.draw_controls(
+    neg_control_sc_data.shape[0],
+    seeds=seeds,
+    n_entries=max_n_entries,
+    frac=control_frac,
+)
 
+# control cells that can be selected by any of the resamples
+control_pool_pos, control_pool_draws = resampling.control_pool(control_draws)
 
-logging.info("Running mAP pipeline with shuffled phenotype labeled data")
+# positions of the training cells of each phenotype
+phenotype_pos = {
+    phenotype: np.flatnonzero(
+        training_sc_data["Mitocheck_Phenotypic_Class"] == phenotype
+    )
+    for phenotype in training_sc_data["Mitocheck_Phenotypic_Class"].unique()
+}
+
+# storing the features and metadata of the pool of cells
+pool_sc_data = pd.concat([training_sc_data, neg_control_sc_data.iloc[control_pool_pos]])
+pool_store = feature_store.FeatureStore.create(feature_store_dir)
+pool_feats = pool_store.save("pool_feats", feature_schema.feature_matrix(pool_sc_data))
+pool_store.save_metadata("pool_meta", pool_sc_data.iloc[:, feature_schema.metadata_idx])
+
+# hashing every row of the pool, used to detect the jobs whose input rows changed
+pool_row_hashes = {
+    "meta": results_store.row_hashes(pool_sc_data.iloc[:, feature_schema.metadata_idx]),
+    "CP": results_store.row_hashes(feature_schema.feature_view(pool_feats, "CP")),
+    "DP": results_store.row_hashes(feature_schema.feature_view(pool_feats, "DP")),
+}
+del pool_sc_data
+
+# building the similarity cache from the CP and DP feature blocks
+# CP_and_DP similarities are assembled from the CP and DP parts
+similarity_cache = similarity.BlockSimilarityCache(
+    {
+        "CP": feature_schema.feature_view(pool_feats, "CP"),
+        "DP": feature_schema.feature_view(pool_feats, "DP"),
+    },
+    store=pool_store,
+    dtype=similarity_dtype,
+)
 
-# storing generated mAP pipline results seperated by feature
-shuffled_labels_map_results_neg_cp = []
-shuffled_labels_map_results_neg_dp = []
-shuffled_labels_map_results_neg_cp_dp = []
 
-# running process
-# for loop selects one single phenotype
-# then splits the data into metadata and raw feature values
-# two different groups that contains 3 splits caused by the types of features
-# applie the copairs pipeline
-for phenotype in list(training_sc_data["Mitocheck_Phenotypic_Class"].unique()):
-    # select training dataset based on phenotype
-    logging.info(f"Phenotype selected: {phenotype}")
-    selected_training = training_sc_data.loc[
-        training_sc_data["Mitocheck_Phenotypic_Class"] == phenotype
-    ]
-    n_entries_training = selected_training.shape[0]
+# ## Running mAP Pipeline
+# The analysis grid (phenotypes x seeds x feature spaces x shuffling modes) is split
+# into independent jobs that are computed on a pool of worker processes, starting
+# with the largest phenotypes.
+#
+# - non-shuffled: regular dataset.
+# - phenotype_shuffled: phenotype labels are shuffled. Shuffling the labels does not
+# change the features of the selected cells, therefore this mode is computed within
+# the same job as the regular dataset and reuses its rank lists. All
+# `n_label_permutations` permutations of a resample are scored in a single batched
+# pass and share the same null distributions.
+# - features_shuffled: feature values within the feature space are shuffled.
 
-    # This will generated 100 values [0..100] as seed values
-    # seed values will
-    for seed in range(0, n_resamples):
-        # setting seed
-        logging.info(
-            f"Running MAP Pipeline with shuffled data. Setting random seed too: {seed}"
-        )
-        np.random.seed(seed)
+# In[11]:
 
-        # Below, we are running the same test, but we are shuffling the phenotypes
-        logging.info(
-            "Shuffling data based on the Mitocheck_Phenotypic_Class (phenotype) labels"
-        )
 
-        # concatenate to positive and negative control and shuffle labels
-        training_w_neg = pd.concat(
-            [
-                selected_training,
-                neg_control_sc_data.sample(frac=0.010, random_state=seed).iloc[
-                    :n_entries_training
-                ],
-            ]
-        )
-        training_w_neg = shuffle_meta_labels(
-            dataset=training_w_neg, target_col="Mitocheck_Phenotypic_Class", seed=seed
-        )
+def select_pool_idx(job: scheduler.MapJob) -> np.ndarray:
+    """Returns the positions within the pool of cells of the training cells of the
+    job phenotype, followed by the same number of controls drawn with the job seed
 
-        # splitting metadata labeled shuffled data
-        logging.info("splitting shuffled data set into metadata and raw feature values")
-        (
-            shuffled_negative_training_cp_meta,
-            shuffled_negative_training_cp_feats,
-        ) = utils.split_data(training_w_neg, dataset="CP")
-        (
-            shuffled_negative_training_dp_meta,
-            shuffled_negative_training_dp_feats,
-        ) = utils.split_data(training_w_neg, dataset="DP")
-        (
-            shuffled_negative_training_cp_dp_meta,
-            shuffled_negative_training_cp_dp_feats,
-        ) = utils.split_data(training_w_neg, dataset="CP_and_DP")
+    Parameters
+    ----------
+    job : scheduler.MapJob
+        job generated by `scheduler.expand_grid()`
 
-        try:
-            # execute pipeline on negative control with trianing dataset with cp features
-            logging.info(
-                f"Running pipeline on CP features using {phenotype} phenotype, data is shuffled by phenoptype labels"
-            )
-            shuffled_cp_negative_training_result = run_pipeline(
-                meta=shuffled_negative_training_cp_meta,
-                feats=shuffled_negative_training_cp_feats,
-                pos_sameby=pos_sameby,
-                pos_diffby=pos_diffby,
-                neg_sameby=neg_sameby,
-                neg_diffby=neg_diffby,
-                batch_size=batch_size,
-                null_size=null_size,
-            )
-
-            # adding shuffle label column
-            shuffled_cp_negative_training_result["shuffled"] = "phenotype_shuffled"
-            shuffled_cp_negative_training_result["seed_val"] = seed
-
-            # append to list
-            shuffled_labels_map_results_neg_cp.append(
-                shuffled_cp_negative_training_result
-            )
-
-            # execute pipeline on negative control with trianing dataset with dp features
-            logging.info(
-                f"Running pipeline on DP features using {phenotype} phenotype, data is shuffled by phenoptype labels"
-            )
-            shuffled_dp_negative_training_result = run_pipeline(
-                meta=shuffled_negative_training_dp_meta,
-                feats=shuffled_negative_training_dp_feats,
-                pos_sameby=pos_sameby,
-                pos_diffby=pos_diffby,
-                neg_sameby=neg_sameby,
-                neg_diffby=neg_diffby,
-                batch_size=batch_size,
-                null_size=null_size,
-            )
-
-            # adding shuffle label column
-            shuffled_dp_negative_training_result["shuffled"] = "phenotype_shuffled"
-            shuffled_dp_negative_training_result["seed_val"] = seed
-
-            # append to list
-            shuffled_labels_map_results_neg_dp.append(
-                shuffled_dp_negative_training_result
-            )
-
-            # execute pipeline on negative control with trianing dataset with cp_dp features
-            logging.info(
-                f"Running pipeline on CP and DP features using {phenotype} phenotype, data is shuffled by phenoptype labels"
-            )
-            shuffled_cp_dp_negative_training_result = run_pipeline(
-                meta=shuffled_negative_training_cp_dp_meta,
-                feats=shuffled_negative_training_cp_dp_feats,
-                pos_sameby=pos_sameby,
-                pos_diffby=pos_diffby,
-                neg_sameby=neg_sameby,
-                neg_diffby=neg_diffby,
-                batch_size=batch_size,
-                null_size=null_size,
-            )
-
-            # adding shuffle label column
-            shuffled_cp_dp_negative_training_result["shuffled"] = "phenotype_shuffled"
-            shuffled_cp_dp_negative_training_result["seed_val"] = seed
-
-            # append to list
-            shuffled_labels_map_results_neg_cp_dp.append(
-                shuffled_cp_dp_negative_training_result
-            )
-        except ZeroDivisionError as e:
-            logging.warning(f"{e} captured on phenotye: {phenotype}. Skipping")
-            continue
+    Returns
+    -------
+    np.ndarray
+        positions of the selected cells within the pool
+    """
+    selected_training_pos = phenotype_pos[job.phenotype]
+    n_entries_training = selected_training_pos.shape[0]
+    return np.concatenate(
+        [
+            selected_training_pos,
+            training_sc_data.shape[0]
+            + control_pool_draws[seeds.index(job.seed), :n_entries_training],
+        ]
+    )
 
-# saving to csv
-pd.concat(shuffled_labels_map_results_neg_cp).to_csv(
-    map_out_dir / "cp_sc_mAP_scores_label_shuffled.csv", index=False
-)
-pd.concat(shuffled_labels_map_results_neg_dp).to_csv(
-    map_out_dir / "dp_sc_mAP_scores_label_shuffled.csv", index=False
-)
-pd.concat(shuffled_labels_map_results_neg_cp_dp).to_csv(
-    map_out_dir / "cp_dp_sc_mAP_scores_label_shuffled.csv", index=False
-)
 
+def map_job_fingerprint(job: scheduler.MapJob) -> str:
+    """Fingerprints the metadata and features of the cells selected by a job, stored
+    results of the job are reused only if its fingerprint is unchanged
 
-# ## Running MAP Pipeline with shuffled feature space
+    Parameters
+    ----------
+    job : scheduler.MapJob
+        job generated by `scheduler.expand_grid()`
 
-# In[13]:
+    Returns
+    -------
+    str
+        fingerprint of the job input
+    """
+    pool_idx = select_pool_idx(job)
+    blocks = ["meta", *similarity.DATASET_BLOCKS[job.feature_space]]
+    return results_store.job_fingerprint(
+        [pool_row_hashes[block][pool_idx] for block in blocks],
+        columns=feature_schema.metadata_cols()
+        + feature_schema.feature_cols(job.feature_space),
+    )
 
 
-logging.info("Running mAP pipeline with shuffled feature space data")
-shuffled_feat_map_results_neg_cp = []
-shuffled_feat_map_results_neg_dp = []
-shuffled_feat_map_results_neg_cp_dp = []
+def run_map_job(job: scheduler.MapJob) -> Dict[str, pd.DataFrame]:
+    """Computes the mAP results of a single phenotype, seed and feature space for
+    the shuffling modes of the job
 
-# running process
-# for loop selects one single phenotype
-# then splits the data into metadata and raw feature values
-# two different groups that contains 3 splits caused by the types of features
-# applie the copairs pipeline
-for phenotype in list(training_sc_data["Mitocheck_Phenotypic_Class"].unique()):
-    # select training dataset based on phenotype
-    selected_training = training_sc_data.loc[
-        training_sc_data["Mitocheck_Phenotypic_Class"] == phenotype
-    ]
-    n_entries_training = selected_training.shape[0]
+    Parameters
+    ----------
+    job : scheduler.MapJob
+        job generated by `scheduler.expand_grid()`
 
-    # This will generated 100 values [0..100] as seed values
-    # seed values will
-    for seed in range(0, n_resamples):
-        # setting seed
+    Returns
+    -------
+    Dict[str, pd.DataFrame]
+        mAP results of each shuffling mode. Modes without positive pairs are skipped.
+    """
+    # selecting the training cells of the phenotype and the same number of controls
+    # positions are given within the pool of cells, training cells come first
+    logging.info(f"Phenotype selected: {job.phenotype}")
+    pool_idx = select_pool_idx(job)
+
+    # selecting the metadata and similarities of the selected cells from the store
+    logging.info("selecting metadata and similarities of the selected cells")
+    negative_training_meta = pool_store.load_metadata("pool_meta", pool_idx)
+
+    pipeline_params = dict(
+        pos_sameby=pos_sameby,
+        pos_diffby=pos_diffby,
+        neg_sameby=neg_sameby,
+        neg_diffby=neg_diffby,
+        batch_size=batch_size,
+        null_size=null_size,
+        null_cache=null_cache,
+        p_value_threshold=p_value_threshold,
+    )
+
+    # placing under "try" block as some phenotype may not have positive pairs
+    job_results = {}
+    for mode in job.modes:
         logging.info(
-            f"Running MAP Pipeline with shuffled data. Setting random seed too: {seed}"
-        )
-        np.random.seed(seed)
-
-        # Below, we are running the same test, but we are shuffling the phenotypes
-        logging.info("Shuffling data based on the feature space")
-        training_w_neg = pd.concat(
-            [
-                selected_training,
-                neg_control_sc_data.sample(frac=0.010, random_state=seed).iloc[
-                    :n_entries_training
-                ],
-            ]
-        )
-
-        # split the shuffled dataset
-        # spliting metadata and raw feature values
-        logging.info("splitting shuffled data set into metadata and raw feature values")
-        (
-            shuffled_negative_training_cp_meta,
-            shuffled_negative_training_cp_feats,
-        ) = utils.split_data(training_w_neg, dataset="CP")
-        (
-            shuffled_negative_training_dp_meta,
-            shuffled_negative_training_dp_feats,
-        ) = utils.split_data(training_w_neg, dataset="DP")
-        (
-            shuffled_negative_training_cp_dp_meta,
-            shuffled_negative_training_cp_dp_feats,
-        ) = utils.split_data(training_w_neg, dataset="CP_and_DP")
-
-        # shuffling the features, this will overwrite the generated feature space from above with the shuffled one
-        shuffled_negative_training_cp_feats = shuffle_features(
-            feature_vals=shuffled_negative_training_cp_feats, seed=seed
-        )
-        shuffled_negative_training_dp_feats = shuffle_features(
-            feature_vals=shuffled_negative_training_dp_feats, seed=seed
+            f"Running pipeline on {job.feature_space} features using {job.phenotype} phenotype, mode: {mode}"
         )
-        shuffled_negative_training_cp_dp_feats = shuffle_features(
-            feature_vals=shuffled_negative_training_cp_dp_feats, seed=seed
-        )
-
         try:
-            # execute pipeline on negative control with trianing dataset with cp features
-            logging.info(
-                f"Running pipeline on CP features using {phenotype} phenotype, feature space is shuffled"
-            )
-            shuffled_cp_feat_negative_training_result = run_pipeline(
-                meta=shuffled_negative_training_cp_meta,
-                feats=shuffled_negative_training_cp_feats,
-                pos_sameby=pos_sameby,
-                pos_diffby=pos_diffby,
-                neg_sameby=neg_sameby,
-                neg_diffby=neg_diffby,
-                batch_size=batch_size,
-                null_size=null_size,
-            )
-
-            # adding shuffle label column
-            shuffled_cp_feat_negative_training_result["shuffled"] = "features_shuffled"
-            shuffled_cp_feat_negative_training_result["seed_val"] = seed
-
-            # append to list
-            shuffled_feat_map_results_neg_cp.append(
-                shuffled_cp_feat_negative_training_result
-            )
-
-            # execute pipeline on negative control with trianing dataset with dp features
-            logging.info(
-                f"Running pipeline on DP features using {phenotype} phenotype, feature space is shuffled"
-            )
-            shuffled_dp_feat_negative_training_result = run_pipeline(
-                meta=shuffled_negative_training_dp_meta,
-                feats=shuffled_negative_training_dp_feats,
-                pos_sameby=pos_sameby,
-                pos_diffby=pos_diffby,
-                neg_sameby=neg_sameby,
-                neg_diffby=neg_diffby,
-                batch_size=batch_size,
-                null_size=null_size,
-            )
-
-            # adding shuffle label column
-            shuffled_dp_feat_negative_training_result["shuffled"] = "features_shuffled"
-            shuffled_dp_feat_negative_training_result["seed_val"] = seed
-
-            # append to list
-            shuffled_feat_map_results_neg_dp.append(
-                shuffled_dp_feat_negative_training_result
-            )
-
-            # execute pipeline on negative control with trianing dataset with cp_dp features
-            logging.info(
-                f"Running pipeline on CP and DP features using {phenotype} phenotype, feature space is shuffled"
-            )
-            shuffled_cp_dp_feat_negative_training_result = run_pipeline(
-                meta=shuffled_negative_training_cp_dp_meta,
-                feats=shuffled_negative_training_cp_dp_feats,
-                pos_sameby=pos_sameby,
-                pos_diffby=pos_diffby,
-                neg_sameby=neg_sameby,
-                neg_diffby=neg_diffby,
-                batch_size=batch_size,
-                null_size=null_size,
-            )
-
-            # adding shuffle label column
-            shuffled_cp_dp_feat_negative_training_result[
-                "shuffled"
-            ] = "features_shuffled"
-            shuffled_cp_dp_feat_negative_training_result["seed_val"] = seed
-
-            # append to list
-            shuffled_feat_map_results_neg_cp_dp.append(
-                shuffled_cp_dp_feat_negative_training_result
-            )
-        except ZeroDivisionError as e:
-            logging.warning(f"{e} captured on phenotype: {phenotype}. Skipping")
+            if mode == "non-shuffled":
+                # similarities are kept to rank tied positive pairs first
+                pool_sim = similarity_cache.submatrix(pool_idx, job.feature_space)
+                rank_ix = average_precision.rank_lists(pool_sim)
+                job_results[mode] = average_precision.run_pipeline(
+                    meta=negative_training_meta,
+                    similarity=pool_sim,
+                    rank_ix=rank_ix,
+                    pair_index=pair_indexes[job.phenotype, job.seed],
+                    **pipeline_params,
+                )
+
+            elif mode == "phenotype_shuffled":
+                # reusing the rank lists of the regular dataset if already computed
+                if "non-shuffled" not in job.modes:
+                    pool_sim = similarity_cache.submatrix(pool_idx, job.feature_space)
+                    rank_ix = average_precision.rank_lists(pool_sim)
+                # permuting the label codes, decoded with the codec categories
+                permuted_labels = average_precision.permute_labels(
+                    meta_codec.codes(
+                        negative_training_meta, "Mitocheck_Phenotypic_Class"
+                    ),
+                    n_permutations=n_label_permutations,
+                    seed=job.seed,
+                )
+                job_results[mode] = average_precision.run_permutations(
+                    meta=negative_training_meta,
+                    similarity=pool_sim,
+                    label_col="Mitocheck_Phenotypic_Class",
+                    permuted_labels=permuted_labels,
+                    rank_ix=rank_ix,
+                    **pipeline_params,
+                )
+
+            elif mode == "features_shuffled":
+                # shuffling the feature space of the selected cells
+                # fancy indexing already copies the features, shuffling in place
+                shuffled_feats = utils.shuffle_columns(
+                    feature_schema.feature_view(
+                        pool_store.load("pool_feats"), job.feature_space
+                    )[pool_idx],
+                    seed=job.seed,
+                    inplace=True,
+                )
+                job_results[mode] = average_precision.run_pipeline(
+                    meta=negative_training_meta,
+                    similarity=similarity.cosine_similarity(
+                        shuffled_feats, dtype=similarity_dtype
+                    ),
+                    pair_index=pair_indexes[job.phenotype, job.seed],
+                    **pipeline_params,
+                )
+        except ValueError as e:
+            logging.warning(f"{e} captured on phenotype: {job.phenotype}. Skipping")
             continue
 
+        # adding shuffle label column
+        job_results[mode]["shuffled"] = mode
+        job_results[mode]["seed_val"] = job.seed
+
+    return job_results
+
 
-# saving to csv
-pd.concat(shuffled_feat_map_results_neg_cp).to_csv(
-    map_out_dir / "cp_sc_mAP_scores_feat_shuffled.csv", index=False
+# In[12]:
+
+
+# expanding the analysis grid into jobs, largest phenotypes are computed first
+# phenotypes follow their order of appearance in the training data
+phenotype_sizes = {
+    phenotype: training_pos.shape[0]
+    for phenotype, training_pos in phenotype_pos.items()
+}
+map_jobs = scheduler.expand_grid(
+    phenotype_sizes=phenotype_sizes,
+    seeds=seeds,
+    feature_spaces=["CP", "DP", "CP_and_DP"],
+    modes=["non-shuffled", "phenotype_shuffled", "features_shuffled"],
 )
-pd.concat(shuffled_feat_map_results_neg_dp).to_csv(
-    map_out_dir / "dp_sc_mAP_scores_feat_shuffled.csv", index=False
+logging.info(f"Running {len(map_jobs)} mAP jobs")
+
+# results are stored in a stage keyed by the pipeline parameters. Phenotypes and
+# seeds are partitions of the stage and each job is fingerprinted from its input
+# rows, so when phenotypes, seeds or cells are added only the new jobs and the jobs
+# whose input rows changed are computed and merged with the stored results
+map_results_stage = analysis_stages.stage_dir(
+    "map_results",
+    params=dict(
+        pos_sameby=pos_sameby,
+        pos_diffby=pos_diffby,
+        neg_sameby=neg_sameby,
+        neg_diffby=neg_diffby,
+        null_size=null_size,
+        batch_size=batch_size,
+        n_label_permutations=n_label_permutations,
+        control_frac=control_frac,
+        p_value_threshold=p_value_threshold,
+        similarity_dtype=similarity_dtype,
+    ),
 )
-pd.concat(shuffled_feat_map_results_neg_cp_dp).to_csv(
-    map_out_dir / "cp_dp_sc_mAP_scores_feat_shuffled.csv", index=False
+map_results = results_store.ResultsStore(map_results_stage.value)
+map_job_fingerprints = {job: map_job_fingerprint(job) for job in map_jobs}
+
+# computing the dot products before starting the workers, so they are shared by all
+# workers. Dot products are not needed if all the jobs are already stored
+pending_map_jobs = map_results.pending_jobs(map_jobs, map_job_fingerprints)
+if len(pending_map_jobs) > 0:
+    similarity_cache.precompute()
+
+# indexing the pairs of the cells of every phenotype and seed once, the index is
+# shared by all the feature spaces and shuffling modes of the phenotype and seed
+pair_indexes = {}
+for job in pending_map_jobs:
+    if (job.phenotype, job.seed) not in pair_indexes:
+        pair_indexes[job.phenotype, job.seed] = pair_index.build_pair_index(
+            pool_store.load_metadata("pool_meta", select_pool_idx(job)),
+            pos_sameby=pos_sameby,
+            pos_diffby=pos_diffby,
+            neg_sameby=neg_sameby,
+            neg_diffby=neg_diffby,
+        )
+
+# running the new and changed jobs, results are stored as soon as each job finishes
+scheduler.run_jobs(
+    map_jobs,
+    run_map_job,
+    map_results,
+    n_workers=n_workers,
+    fingerprints=map_job_fingerprints,
 )
+
+
+# In[13]:
+
+
+# saving results of each feature space and shuffling mode
+feature_space_names = {"CP": "cp", "DP": "dp", "CP_and_DP": "cp_dp"}
+mode_names = {
+    "non-shuffled": "regular",
+    "phenotype_shuffled": "label_shuffled",
+    "features_shuffled": "feat_shuffled",
+}
+for feature_space, feature_space_name in feature_space_names.items():
+    for mode, mode_name in mode_names.items():
+        map_results.to_csv(
+            map_out_dir / f"{feature_space_name}_sc_mAP_scores_{mode_name}.csv",
+            feature_space=feature_space,
+            mode=mode,
+            jobs=map_jobs,
+        )
@@ -5,13 +5,17 @@
 
 
 import pathlib
+import sys
 import warnings
 
-import numpy as np
 import pandas as pd
 import plotly.express as px
 from copairs.map import aggregate
 
+# imports src
+sys.path.append("../")
+from src import aggregation, metadata_codec, score_stats, stage_cache  # noqa
+
 warnings.filterwarnings("ignore")
 
 
@@ -24,6 +28,10 @@ figures_dir = pathlib.Path("../figures/").resolve(strict=True)
 sc_ap_scores_dir = (processed_data_dir / "sc_ap_scores").resolve(strict=True)
 agg_sc_ap_scores_dir = (processed_data_dir / "aggregate_mAPs").resolve(strict=True)
 
+# aggregated scores are cached as stages keyed by their parameters and inputs, they
+# are only computed again when the single-cell scores or the parameters change
+plotting_stages = stage_cache.StageCache(processed_data_dir / "stage_cache")
+
 
 # ## Preparing the dataset
 #
@@ -39,21 +47,26 @@ agg_sc_ap_scores_dir = (processed_data_dir / "aggregate_mAPs").resolve(strict=Tr
 
 all_files = list(sc_ap_scores_dir.glob("*.csv"))
 
+# the phenotype labels, cell identifiers, plates and wells are parsed into
+# categorical columns, then encoded with codes shared by all the files
+coded_dtypes = {colname: "category" for colname in metadata_codec.CODED_COLUMNS}
+
 cp_sc_mAPs = []
 dp_sc_mAPs = []
 cp_dp_sc_mAPs = []
 for _file in all_files:
     if _file.name.startswith("cp_dp"):
-        cp_dp_sc_mAPs.append(pd.read_csv(_file))
+        cp_dp_sc_mAPs.append(pd.read_csv(_file, dtype=coded_dtypes))
     elif _file.name.startswith("cp_"):
-        dp_sc_mAPs.append(pd.read_csv(_file))
+        dp_sc_mAPs.append(pd.read_csv(_file, dtype=coded_dtypes))
     elif _file.name.startswith("dp_"):
-        cp_sc_mAPs.append(pd.read_csv(_file))
+        cp_sc_mAPs.append(pd.read_csv(_file, dtype=coded_dtypes))
 
-# single-cell mAP scores
-cp_sc_mAPs = pd.concat(cp_sc_mAPs)
-dp_sc_mAPs = pd.concat(dp_sc_mAPs)
-cp_dp_sc_mAPs = pd.concat(cp_dp_sc_mAPs)
+# single-cell mAP scores, scores are grouped by the metadata codes
+meta_codec = metadata_codec.MetadataCodec.fit(cp_sc_mAPs + dp_sc_mAPs + cp_dp_sc_mAPs)
+cp_sc_mAPs = pd.concat(map(meta_codec.encode, cp_sc_mAPs))
+dp_sc_mAPs = pd.concat(map(meta_codec.encode, dp_sc_mAPs))
+cp_dp_sc_mAPs = pd.concat(map(meta_codec.encode, cp_dp_sc_mAPs))
 
 
 # In[4]:
@@ -116,28 +129,10 @@ merged_sc_ap_scores_df = pd.concat(
     ]
 )
 
-# grouping dataframe based on phenotype levels, feature and feature types
-df_group = merged_sc_ap_scores_df.groupby(
-    by=["Mitocheck_Phenotypic_Class", "feature_type", "shuffled"]
-)
-
-# calculating sampling error
-sampling_error_df = []
-for name, df in df_group:
-    pheno, feature_type, shuffled_type = name
-
-    # caclulating sampling error
-    avg_percision = df["average_precision"].values
-    sampling_error = np.std(avg_percision) / np.sqrt(len(avg_percision))
-
-    sampling_error_df.append([pheno, feature_type, shuffled_type, sampling_error])
-cols = ["Mitocheck_Phenotypic_Class", "feature_type", "shuffled", "sampling_error"]
-sampling_error_df = pd.DataFrame(sampling_error_df, columns=cols)
-
-# updating name:
-sampling_error_df.loc[
-    sampling_error_df["shuffled"] == "phenotype_shuffled"
-] = "phenotypes_shuffled"
+# calculating the sampling error of each phenotype, feature type and shuffling method
+# in a single grouped operation
+map_groups = ["Mitocheck_Phenotypic_Class", "feature_type", "shuffled"]
+sampling_error_df = score_stats.sampling_error(merged_sc_ap_scores_df, by=map_groups)
 
 sampling_error_df.head()
 
@@ -146,23 +141,24 @@ sampling_error_df.head()
 
 
 # aggregate single cells scores with cell UUID
-data = tuple(merged_sc_ap_scores_df.groupby(by=["Cell_UUID"]))
-columns = merged_sc_ap_scores_df.columns
-agg_sc_ap_scores_df = []
-for cell_id, df1 in data:
-    for feature_type, df2 in df1.groupby(by="feature_type"):
-        for shuffle_type, df3 in df2.groupby(by="shuffled"):
-            aggregated_ap_score = df3["average_precision"].mean()
-
-            # select a single row since all the metadata is the same
-            selected_row = df3.iloc[0]
-
-            # update the average precision score of the single row
-            selected_row["average_precision"] = aggregated_ap_score
-            agg_sc_ap_scores_df.append(selected_row.values.tolist())
+# the AP scores of each cell are averaged over the seeds of each feature type and
+# shuffling method, the metadata of the first row of each group is kept since all
+# the metadata is the same
+# only computed again if the single-cell score files have changed
+cell_scores_stage = plotting_stages.run(
+    "cell_ap_scores",
+    lambda: aggregation.aggregate_scores(
+        merged_sc_ap_scores_df,
+        by=["Cell_UUID", "feature_type", "shuffled"],
+        scores={"average_precision": "mean"},
+    ),
+    inputs=sorted(
+        _file for _file in all_files if _file.name.startswith(("cp_", "dp_"))
+    ),
+)
+agg_sc_ap_scores_df = cell_scores_stage.value
 
 # saving into the results repo
-agg_sc_ap_scores_df = pd.DataFrame(data=agg_sc_ap_scores_df, columns=columns)
 agg_sc_ap_scores_df.to_csv(
     sc_ap_scores_dir / "merged_sc_agg_ap_scores.csv", index=False
 )
@@ -173,15 +169,56 @@ agg_sc_ap_scores_df.head()
 
 
 # Generating aggregate scores with a threshold p-value of 0.05
-mAP_dfs = []
-for name, df in tuple(agg_sc_ap_scores_df.groupby(by=["feature_type", "shuffled"])):
-    agg_df = aggregate(df, sameby=["Mitocheck_Phenotypic_Class"], threshold=0.05)
-    agg_df["shuffled"] = name[1]
-    agg_df["feature_type"] = name[0]
+p_value_threshold = 0.05
+
+
+def aggregate_map_scores(
+    agg_sc_ap_scores_df: pd.DataFrame, threshold: float
+) -> pd.DataFrame:
+    """Computes the mAP scores of each phenotype, feature type and shuffling method"""
+    mAP_dfs = []
+    for name, df in tuple(agg_sc_ap_scores_df.groupby(by=["feature_type", "shuffled"])):
+        agg_df = aggregate(
+            meta_codec.decode(df),
+            sameby=["Mitocheck_Phenotypic_Class"],
+            threshold=threshold,
+        )
+        agg_df["shuffled"] = name[1]
+        agg_df["feature_type"] = name[0]
+
+        mAP_dfs.append(agg_df)
+
+    return pd.concat(mAP_dfs)
+
+
+# changing the threshold only recomputes this stage
+mAP_stage = plotting_stages.run(
+    "map_scores",
+    lambda: aggregate_map_scores(agg_sc_ap_scores_df, threshold=p_value_threshold),
+    params={"threshold": p_value_threshold},
+    inputs=[cell_scores_stage],
+)
 
-    mAP_dfs.append(agg_df)
+# bootstrap confidence intervals of the mAP scores, the cells of each phenotype,
+# feature type and shuffling method are resampled with replacement
+n_bootstrap_resamples = 1000
+confidence = 0.95
+mAP_ci_stage = plotting_stages.run(
+    "map_confidence_intervals",
+    lambda: score_stats.bootstrap_ci(
+        agg_sc_ap_scores_df,
+        by=map_groups,
+        n_resamples=n_bootstrap_resamples,
+        confidence=confidence,
+    ),
+    params={"n_resamples": n_bootstrap_resamples, "confidence": confidence},
+    inputs=[cell_scores_stage],
+)
 
-mAP_dfs = pd.concat(mAP_dfs)
+# merging the sampling errors and confidence intervals with the mAP scores
+mAP_dfs = mAP_stage.value.merge(sampling_error_df, on=map_groups, how="left").merge(
+    mAP_ci_stage.value, on=map_groups, how="left"
+)
 mAP_dfs.to_csv(agg_sc_ap_scores_dir / "sc_mAP_scores.csv", index=False)
 mAP_dfs.head()
 
@@ -217,13 +254,23 @@ df = (
     )
     .reset_index()
     .drop("index", axis=1)
-)[["Mitocheck_Phenotypic_Class", "mean_average_precision", "shuffled"]]
+)[
+    [
+        "Mitocheck_Phenotypic_Class",
+        "mean_average_precision",
+        "shuffled",
+        "ci_low",
+        "ci_high",
+    ]
+]
 
 
 fig = px.bar(
     df,
     x="Mitocheck_Phenotypic_Class",
     y="mean_average_precision",
+    error_y=df["ci_high"] - df["mean_average_precision"],
+    error_y_minus=df["mean_average_precision"] - df["ci_low"],
     color="shuffled",
     barmode="group",
     title="Mean Average Precision for Each Mitocheck Phenotypic Class Using CP Features",
@@ -265,12 +312,22 @@ df = (
     )
     .reset_index()
     .drop("index", axis=1)
-)[["Mitocheck_Phenotypic_Class", "mean_average_precision", "shuffled"]]
+)[
+    [
+        "Mitocheck_Phenotypic_Class",
+        "mean_average_precision",
+        "shuffled",
+        "ci_low",
+        "ci_high",
+    ]
+]
 
 fig = px.bar(
     df,
     x="Mitocheck_Phenotypic_Class",
     y="mean_average_precision",
+    error_y=df["ci_high"] - df["mean_average_precision"],
+    error_y_minus=df["mean_average_precision"] - df["ci_low"],
     color="shuffled",
     barmode="group",
     title="Mean Average Precision for Each Mitocheck Phenotypic Class Using CP Features",
@@ -312,12 +369,22 @@ data = (
     )
     .reset_index()
     .drop("index", axis=1)
-)[["Mitocheck_Phenotypic_Class", "mean_average_precision", "shuffled"]]
+)[
+    [
+        "Mitocheck_Phenotypic_Class",
+        "mean_average_precision",
+        "shuffled",
+        "ci_low",
+        "ci_high",
+    ]
+]
 
 fig = px.bar(
     df,
     x="Mitocheck_Phenotypic_Class",
     y="mean_average_precision",
+    error_y=df["ci_high"] - df["mean_average_precision"],
+    error_y_minus=df["mean_average_precision"] - df["ci_low"],
     color="shuffled",
     barmode="group",
     title="Mean Average Precision for Each Mitocheck Phenotypic Class Using CP_DP Features",
@@ -0,0 +1,8 @@
+"""
+Makes the repository modules importable from the tests, as the test notebooks do
+with `sys.path.append("../../")`.
+"""
+import pathlib
+import sys
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
@@ -0,0 +1,69 @@
+"""
+Tests of the grouped aggregation of single-cell scores against a plain groupby.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import aggregation
+
+GROUP_COLS = ["Cell_UUID", "feature_type", "shuffled"]
+
+
+def _single_cell_scores(categorical: bool) -> pd.DataFrame:
+    """Single-cell scores of several resamples, with missing metadata values"""
+    rng = np.random.default_rng(0)
+    n_rows = 300
+    scores = pd.DataFrame(
+        {
+            "Mitocheck_Phenotypic_Class": rng.choice(["Large", "Prometaphase"], n_rows),
+            "Cell_UUID": rng.choice([f"cell_{idx}" for idx in range(20)], n_rows),
+            "Metadata_Plate": rng.choice([1.0, 2.0, np.nan], n_rows),
+            "average_precision": rng.random(n_rows),
+            "p_value": rng.random(n_rows),
+            "feature_type": rng.choice(["CP", "DP", "CP_and_DP"], n_rows),
+            "shuffled": rng.choice(["regular", "label_shuffled"], n_rows),
+        }
+    )
+    if categorical:
+        # unused categories must not form groups
+        scores["Cell_UUID"] = pd.Categorical(
+            scores["Cell_UUID"],
+            categories=[f"cell_{idx}" for idx in range(25)],
+        )
+    return scores
+
+
+def _groupby_scores(scores: pd.DataFrame) -> pd.DataFrame:
+    """Aggregates the scores by iterating over the groups"""
+    aggregated = []
+    for _, group in scores.groupby(GROUP_COLS, sort=True, observed=True):
+        first_row = group.iloc[[0]].copy()
+        first_row["average_precision"] = group["average_precision"].mean()
+        aggregated.append(first_row)
+    return pd.concat(aggregated, ignore_index=True)
+
+
+@pytest.mark.parametrize("categorical", [False, True])
+def test_aggregate_scores_matches_groupby(categorical):
+    scores = _single_cell_scores(categorical)
+
+    aggregated = aggregation.aggregate_scores(
+        scores, by=GROUP_COLS, scores={"average_precision": "mean"}
+    )
+    pd.testing.assert_frame_equal(aggregated, _groupby_scores(scores))
+
+
+def test_rows_with_missing_keys_are_dropped():
+    scores = _single_cell_scores(categorical=False)
+    scores.loc[:9, "Cell_UUID"] = None
+
+    aggregated = aggregation.aggregate_scores(scores, by=GROUP_COLS)
+    pd.testing.assert_frame_equal(aggregated, _groupby_scores(scores))
+
+
+def test_missing_columns():
+    with pytest.raises(ValueError):
+        aggregation.aggregate_scores(
+            _single_cell_scores(categorical=False), by=["Metadata_Well"]
+        )
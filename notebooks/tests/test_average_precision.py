@@ -0,0 +1,267 @@
+"""
+Tests of the single-cell average precision kernels against a stable argsort and
+against copairs, and of the null distributions shared by the worker processes.
+"""
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import average_precision, similarity
+
+PAIR_PARAMS = dict(
+    pos_sameby=["Mitocheck_Phenotypic_Class"],
+    pos_diffby=["Cell_UUID"],
+    neg_sameby=[],
+    neg_diffby=["Mitocheck_Phenotypic_Class"],
+)
+
+
+def _phenotype_meta(n_cells: int) -> pd.DataFrame:
+    """Metadata of a phenotype followed by the same number of controls"""
+    return pd.DataFrame(
+        {
+            "Mitocheck_Phenotypic_Class": ["Large"] * n_cells
+            + ["neg_control"] * n_cells,
+            "Cell_UUID": [f"cell_{idx}" for idx in range(2 * n_cells)],
+        }
+    )
+
+
+def _copairs_average_precision(meta: pd.DataFrame, feats: np.ndarray) -> np.ndarray:
+    """Average precision scores computed by copairs"""
+    copairs_map = pytest.importorskip("copairs.map")
+    if hasattr(copairs_map, "average_precision"):
+        result = copairs_map.average_precision(meta, feats, **PAIR_PARAMS)
+    else:
+        result = copairs_map.run_pipeline(meta, feats, null_size=10, **PAIR_PARAMS)
+    return result["average_precision"].to_numpy()
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_rank_lists_match_stable_argsort(dtype):
+    rng = np.random.default_rng(0)
+    sim = rng.choice([-0.5, -0.0, 0.0, 0.25, 0.5, np.nan], size=(20, 50))
+    sim = sim.astype(dtype)
+
+    expected = np.argsort(-sim, axis=1, kind="stable")
+    np.testing.assert_array_equal(average_precision.rank_lists(sim), expected)
+
+
+def test_rank_lists_keep_near_tied_float64_similarities():
+    # these similarities are only distinct in float64
+    sim = 0.5 + np.array([[0.0, 1e-12, -1e-12, 1e-12, 2e-12, 0.0]])
+    assert np.unique(sim.astype(np.float32)).shape[0] == 1
+
+    expected = np.argsort(-sim, axis=1, kind="stable")
+    np.testing.assert_array_equal(average_precision.rank_lists(sim), expected)
+    np.testing.assert_array_equal(expected[0], [4, 1, 3, 0, 5, 2])
+
+
+def test_near_tied_float64_average_precision():
+    sim = np.full((4, 4), 0.5)
+    sim[0, 1:] = [0.5, 0.5 + 1e-12, 0.5]
+    pos_mask = np.zeros((1, 4), dtype=bool)
+    pos_mask[0, 1] = True
+    neg_mask = np.zeros((1, 4), dtype=bool)
+    neg_mask[0, 2:] = True
+
+    # the positive pair is ranked after the slightly more similar negative pair
+    ap_scores, _, _ = average_precision.top_k_average_precision(
+        sim[:1], pos_mask, neg_mask
+    )
+    np.testing.assert_allclose(ap_scores, [0.5])
+
+    rank_ix = average_precision.rank_lists(sim[:1])
+    ap_scores, _, _ = average_precision.average_precision(
+        rank_ix, pos_mask, neg_mask, similarity=sim[:1]
+    )
+    np.testing.assert_allclose(ap_scores, [0.5])
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_top_k_matches_full_sort(dtype):
+    rng = np.random.default_rng(1)
+    n_cells = 200
+    sim = rng.normal(size=(n_cells, n_cells)).astype(dtype)
+    pos_mask = rng.random((n_cells, n_cells)) < 0.05
+    neg_mask = ~pos_mask & (rng.random((n_cells, n_cells)) < 0.5)
+
+    top_k_scores = average_precision.top_k_average_precision(sim, pos_mask, neg_mask)
+    full_scores = average_precision.average_precision(
+        average_precision.rank_lists(sim), pos_mask, neg_mask, similarity=sim
+    )
+    for top_k_values, full_values in zip(top_k_scores, full_scores):
+        np.testing.assert_allclose(top_k_values, full_values, rtol=1e-12)
+
+
+def test_average_precision_matches_copairs():
+    rng = np.random.default_rng(2)
+    meta = _phenotype_meta(30)
+    feats = rng.normal(size=(meta.shape[0], 20))
+    sim = similarity.cosine_similarity(feats)
+
+    expected = _copairs_average_precision(meta, feats)
+    result = average_precision.run_pipeline(meta, sim, null_size=10, **PAIR_PARAMS)
+    np.testing.assert_allclose(result["average_precision"], expected, rtol=1e-12)
+
+
+def test_tied_average_precision_matches_copairs():
+    # cosine similarities of these features are exact (0, 0.5 or 1), so duplicated
+    # cells create many ties
+    rng = np.random.default_rng(3)
+    base_feats = np.array(
+        [[2, 0, 0, 0], [0, 2, 0, 0], [1, 1, 1, 1], [1, 1, -1, -1]], dtype=np.float64
+    )
+    meta = _phenotype_meta(15)
+    feats = base_feats[rng.integers(0, len(base_feats), size=meta.shape[0])]
+    sim = similarity.cosine_similarity(feats)
+    rank_ix = average_precision.rank_lists(sim)
+
+    expected = _copairs_average_precision(meta, feats)
+    results = [
+        average_precision.run_pipeline(meta, sim, null_size=10, **PAIR_PARAMS),
+        average_precision.run_pipeline(
+            meta, sim, rank_ix=rank_ix, null_size=10, **PAIR_PARAMS
+        ),
+        average_precision.run_permutations(
+            meta,
+            sim,
+            label_col="Mitocheck_Phenotypic_Class",
+            permuted_labels=meta["Mitocheck_Phenotypic_Class"].to_numpy()[None, :],
+            rank_ix=rank_ix,
+            null_size=10,
+            **PAIR_PARAMS,
+        ),
+    ]
+    for result in results:
+        np.testing.assert_allclose(result["average_precision"], expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize("tied", [False, True])
+def test_block_submatrix_average_precision_matches_copairs(tied):
+    rng = np.random.default_rng(4)
+    if tied:
+        base_feats = np.array(
+            [[2, 0, 0, 0], [0, 2, 0, 0], [1, 1, 1, 1], [1, 1, -1, -1]],
+            dtype=np.float64,
+        )
+        pool_feats = base_feats[rng.integers(0, len(base_feats), size=80)]
+    else:
+        pool_feats = rng.normal(size=(80, 20))
+    n_cp = pool_feats.shape[1] // 2
+    cache = similarity.BlockSimilarityCache(
+        {"CP": pool_feats[:, :n_cp], "DP": pool_feats[:, n_cp:]}
+    )
+
+    # a resample of the pool in a shuffled order
+    meta = _phenotype_meta(30)
+    idx = rng.permutation(80)[: meta.shape[0]]
+    sim = cache.submatrix(idx, "CP_and_DP")
+    assert sim.dtype == np.float64
+    rank_ix = average_precision.rank_lists(sim)
+
+    expected = _copairs_average_precision(meta, pool_feats[idx])
+    results = [
+        average_precision.run_pipeline(meta, sim, null_size=10, **PAIR_PARAMS),
+        average_precision.run_pipeline(
+            meta, sim, rank_ix=rank_ix, null_size=10, **PAIR_PARAMS
+        ),
+    ]
+    for result in results:
+        np.testing.assert_allclose(result["average_precision"], expected, rtol=1e-12)
+
+
+def test_block_submatrix_dtype():
+    rng = np.random.default_rng(5)
+    blocks = {"CP": rng.normal(size=(10, 3)), "DP": rng.normal(size=(10, 4))}
+    idx = np.arange(10)
+    expected = similarity.cosine_similarity(np.hstack([blocks["CP"], blocks["DP"]]))
+
+    sim64 = similarity.BlockSimilarityCache(blocks).submatrix(idx)
+    assert sim64.dtype == np.float64
+    np.testing.assert_allclose(sim64, expected, rtol=1e-12)
+
+    sim32 = similarity.BlockSimilarityCache(blocks, dtype="float32").submatrix(idx)
+    assert sim32.dtype == np.float32
+    np.testing.assert_allclose(sim32, expected, rtol=1e-5, atol=1e-6)
+
+
+def _get_null_after_barrier(cache_dir, barrier, queue) -> None:
+    """Gets the same null distribution as all the other processes at the same time"""
+    barrier.wait()
+    try:
+        null_cache = average_precision.NullDistributionCache(cache_dir)
+        queue.put(null_cache.get(50, 101, 1000, seed=0).tolist())
+    except Exception as error:
+        queue.put(repr(error))
+
+
+def test_null_distribution_cache_concurrent_get(tmp_path):
+    n_processes = 16
+    expected = np.sort(average_precision.random_average_precision(50, 101, 1000))
+
+    mp_context = multiprocessing.get_context("fork")
+    for round_idx in range(5):
+        cache_dir = tmp_path / f"null_cache_{round_idx}"
+        barrier = mp_context.Barrier(n_processes)
+        queue = mp_context.Queue()
+        processes = [
+            mp_context.Process(
+                target=_get_null_after_barrier, args=(cache_dir, barrier, queue)
+            )
+            for _ in range(n_processes)
+        ]
+        for process in processes:
+            process.start()
+        results = [queue.get(timeout=60) for _ in processes]
+        for process in processes:
+            process.join()
+
+        assert results == [expected.tolist()] * n_processes
+        assert [path.name for path in cache_dir.iterdir()] == ["null_50_101_1000_0.npy"]
+
+
+def _null_scores(n_queries: int):
+    """Average precision scores of queries with a few pair configurations"""
+    rng = np.random.default_rng(4)
+    n_pos = rng.choice([0, 3, 10], size=n_queries)
+    n_total = n_pos + rng.choice([20, 60], size=n_queries)
+    ap_scores = np.where(n_pos > 0, rng.random(n_queries) ** 2, np.nan)
+    return ap_scores, n_pos, n_total
+
+
+def test_adaptive_p_values_agree_with_p_values():
+    ap_scores, n_pos, n_total = _null_scores(500)
+    expected = average_precision.p_values(ap_scores, n_pos, n_total, null_size=2000)
+    pvals = average_precision.adaptive_p_values(
+        ap_scores, n_pos, n_total, null_size=2000, threshold=0.05
+    )
+
+    np.testing.assert_array_equal(np.isnan(pvals), n_pos == 0)
+    has_pos = n_pos > 0
+    # queries decided early are on the same side of the threshold as with the full
+    # null distributions, the other queries get the same p-values
+    decided_early = has_pos & (pvals != expected)
+    assert decided_early.sum() > 0
+    np.testing.assert_array_equal(pvals[has_pos] < 0.05, expected[has_pos] < 0.05)
+
+
+def test_undecided_adaptive_p_values_match_p_values(tmp_path):
+    ap_scores, n_pos, n_total = _null_scores(100)
+    null_cache = average_precision.NullDistributionCache(tmp_path)
+
+    # no query can be decided with such a wide interval
+    pvals = average_precision.adaptive_p_values(
+        ap_scores,
+        n_pos,
+        n_total,
+        null_size=1000,
+        threshold=0.05,
+        z_score=1e6,
+        null_cache=null_cache,
+    )
+    expected = average_precision.p_values(ap_scores, n_pos, n_total, null_size=1000)
+    np.testing.assert_array_equal(pvals, expected)
+    assert len(null_cache) == len(np.unique(n_total[n_pos > 0]))
@@ -0,0 +1,311 @@
+"""
+Tests of the resumable downloader against a local HTTP server with range requests.
+"""
+import gzip
+import hashlib
+import http.server
+import io
+import json
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import download, loader
+
+PAYLOAD = np.random.default_rng(0).bytes(300_000)
+CHECKSUM = f"sha256:{hashlib.sha256(PAYLOAD).hexdigest()}"
+
+
+def _profiles_csv_gz() -> bytes:
+    """Gzip compressed CSV file of single-cell profiles"""
+    rng = np.random.default_rng(1)
+    n_rows = 3000
+    profiles = pd.DataFrame(
+        {
+            "Mitocheck_Phenotypic_Class": rng.choice(["Large", "Polylobed"], n_rows),
+            "Cell_UUID": [f"cell_{idx}" for idx in range(n_rows)],
+            "Metadata_Plate": rng.integers(1, 5, n_rows),
+            "Metadata_Well": rng.choice(["A01", "B02", None], n_rows),
+            "CP__AreaShape_Area": rng.normal(size=n_rows),
+            "DP__efficientnet_0": rng.normal(size=n_rows),
+        }
+    )
+    return gzip.compress(profiles.to_csv(index=False).encode())
+
+
+CSV_GZ = _profiles_csv_gz()
+CSV_GZ_CHECKSUM = f"sha256:{hashlib.sha256(CSV_GZ).hexdigest()}"
+
+
+class _RangeServer(http.server.ThreadingHTTPServer):
+    """HTTP server of in-memory files, which supports range requests and records
+    the requests it receives. The first `n_truncated` GET responses stop halfway."""
+
+    def __init__(self, files):
+        super().__init__(("127.0.0.1", 0), _RangeHandler)
+        self.files = files
+        self.requests = []
+        self.n_truncated = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+class _RangeHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send_headers(self):
+        """Sends the status and headers of the request and returns the bytes of the
+        response, or None if there is no content"""
+        self.server.requests.append((self.command, self.headers.get("Range")))
+        content = self.server.files.get(self.path.lstrip("/"))
+        if content is None:
+            self.send_error(404)
+            return None
+
+        status, start = 200, 0
+        range_match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if range_match is not None:
+            start = int(range_match.group(1))
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(content)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+            status = 206
+
+        self.send_response(status)
+        if status == 206:
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}"
+            )
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+        return content[start:]
+
+    def do_HEAD(self) -> None:
+        self._send_headers()
+
+    def do_GET(self) -> None:
+        content = self._send_headers()
+        if content is None:
+            return
+        if self.server.n_truncated > 0:
+            self.server.n_truncated -= 1
+            content = content[: len(content) // 2]
+            self.close_connection = True
+        self.wfile.write(content)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(download.time, "sleep", lambda _: None)
+    range_server = _RangeServer({"data.bin": PAYLOAD, "training_data.csv.gz": CSV_GZ})
+    thread = threading.Thread(target=range_server.serve_forever, daemon=True)
+    thread.start()
+    yield range_server
+    range_server.shutdown()
+    range_server.server_close()
+
+
+def _remote_file(server, tmp_path, **kwargs) -> download.RemoteFile:
+    return download.RemoteFile(
+        url=f"{server.url}/data.bin", out_path=tmp_path / "data.bin", **kwargs
+    )
+
+
+def _get_ranges(server):
+    return [byte_range for method, byte_range in server.requests if method == "GET"]
+
+
+def test_resume_from_part_file(server, tmp_path):
+    remote_file = _remote_file(server, tmp_path, checksum=CHECKSUM)
+    (tmp_path / "data.bin.part").write_bytes(PAYLOAD[:1000])
+
+    out_path = download.download_file(remote_file, chunk_size=4096)
+
+    assert out_path.read_bytes() == PAYLOAD
+    assert not (tmp_path / "data.bin.part").exists()
+    assert _get_ranges(server) == ["bytes=1000-"]
+
+
+def test_resume_interrupted_download(server, tmp_path):
+    server.n_truncated = 1
+    remote_file = _remote_file(server, tmp_path, size=len(PAYLOAD), checksum=CHECKSUM)
+
+    out_path = download.download_file(remote_file, chunk_size=4096)
+
+    assert out_path.read_bytes() == PAYLOAD
+    # the second request resumes from the bytes written before the interruption
+    first_range, second_range = _get_ranges(server)
+    assert first_range is None
+    offset = int(re.fullmatch(r"bytes=(\d+)-", second_range).group(1))
+    assert 0 < offset <= len(PAYLOAD) // 2
+
+
+def test_skip_valid_file(server, tmp_path):
+    remote_file = _remote_file(server, tmp_path, checksum=CHECKSUM)
+    out_path = download.download_file(remote_file)
+    mtime_ns = out_path.stat().st_mtime_ns
+    n_requests = len(server.requests)
+
+    assert download.is_valid(remote_file)
+    assert download.download_file(remote_file) == out_path
+    assert len(server.requests) == n_requests
+    assert out_path.stat().st_mtime_ns == mtime_ns
+
+    # a modified file is downloaded again
+    out_path.write_bytes(PAYLOAD[:10])
+    assert not download.is_valid(remote_file)
+    assert download.download_file(remote_file).read_bytes() == PAYLOAD
+
+
+def test_reject_wrong_checksum(server, tmp_path):
+    wrong_checksum = f"sha256:{hashlib.sha256(b'other').hexdigest()}"
+    remote_file = _remote_file(server, tmp_path, checksum=wrong_checksum)
+
+    with pytest.raises(ValueError, match="checksum mismatch"):
+        download.download_file(remote_file)
+    assert not (tmp_path / "data.bin").exists()
+    assert not (tmp_path / "data.bin.part").exists()
+
+
+def test_part_file_larger_than_remote(server, tmp_path):
+    remote_file = _remote_file(server, tmp_path, checksum=CHECKSUM)
+    (tmp_path / "data.bin.part").write_bytes(PAYLOAD + b"extra bytes")
+
+    with pytest.raises(ValueError, match="expected 300000 bytes"):
+        download.download_file(remote_file)
+    assert not (tmp_path / "data.bin.part").exists()
+    assert not (tmp_path / "data.bin").exists()
+
+    # the next attempt downloads the whole file
+    assert download.download_file(remote_file).read_bytes() == PAYLOAD
+
+
+def test_missing_checksum(server, tmp_path):
+    remote_file = _remote_file(server, tmp_path)
+
+    with pytest.raises(ValueError, match="no expected checksum"):
+        download.download_file(remote_file)
+    assert server.requests == []
+
+    out_path = download.download_file(remote_file, allow_unverified=True)
+    assert out_path.read_bytes() == PAYLOAD
+    with open(tmp_path / "data.bin.checksum.json") as record_file:
+        assert json.load(record_file)["checksum"] == CHECKSUM
+
+
+def test_mirror_directory(tmp_path):
+    mirror_dir = tmp_path / "mirror"
+    mirror_dir.mkdir()
+    (mirror_dir / "data.bin").write_bytes(PAYLOAD)
+    remote_file = download.RemoteFile(
+        url="http://127.0.0.1:9/data.bin",
+        out_path=tmp_path / "data.bin",
+        size=len(PAYLOAD),
+        checksum=CHECKSUM,
+    )
+
+    assert download.download_file(remote_file, mirror=mirror_dir).read_bytes() == (
+        PAYLOAD
+    )
+    assert download.is_valid(remote_file)
+
+
+def test_hashing_stream():
+    chunks = [PAYLOAD[start : start + 7000] for start in range(0, len(PAYLOAD), 7000)]
+    stream = download._HashingStream(iter(chunks), algorithm="sha256")
+
+    # reads smaller and larger than the chunks
+    data = stream.read(100) + stream.read(10_000)
+    while True:
+        chunk = stream.read(3000)
+        if not chunk:
+            break
+        data += chunk
+
+    assert data == PAYLOAD
+    assert stream.size == len(PAYLOAD)
+    assert f"sha256:{stream.digest.hexdigest()}" == CHECKSUM
+
+
+def _transcoded_file(server, tmp_path, **kwargs) -> download.RemoteFile:
+    return download.RemoteFile(
+        url=f"{server.url}/training_data.csv.gz",
+        out_path=tmp_path / "training_data.parquet",
+        transcode=True,
+        **kwargs,
+    )
+
+
+def test_transcoded_download_matches_read_csv(server, tmp_path):
+    remote_file = _transcoded_file(
+        server, tmp_path, size=len(CSV_GZ), checksum=CSV_GZ_CHECKSUM
+    )
+
+    out_path = download.download_file(remote_file, chunk_size=4096)
+
+    pd.testing.assert_frame_equal(
+        loader.load_profiles(out_path),
+        pd.read_csv(io.BytesIO(CSV_GZ), compression="gzip"),
+    )
+    # the CSV file is never written to disk
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "training_data.parquet",
+        "training_data.parquet.checksum.json",
+    ]
+    with open(tmp_path / "training_data.parquet.checksum.json") as record_file:
+        record = json.load(record_file)
+    assert (record["checksum"], record["source_size"]) == (CSV_GZ_CHECKSUM, len(CSV_GZ))
+
+    # transcoded files are skipped once verified
+    n_requests = len(server.requests)
+    assert download.download_file(remote_file) == out_path
+    assert len(server.requests) == n_requests
+
+
+def test_interrupted_transcoding_restarts(server, tmp_path):
+    server.n_truncated = 1
+    remote_file = _transcoded_file(server, tmp_path, checksum=CSV_GZ_CHECKSUM)
+
+    out_path = download.download_file(remote_file, chunk_size=4096)
+
+    assert _get_ranges(server) == [None, None]
+    pd.testing.assert_frame_equal(
+        loader.load_profiles(out_path),
+        pd.read_csv(io.BytesIO(CSV_GZ), compression="gzip"),
+    )
+
+
+def test_transcoded_download_rejects_wrong_checksum(server, tmp_path):
+    remote_file = _transcoded_file(server, tmp_path, checksum=CHECKSUM)
+
+    with pytest.raises(ValueError, match="checksum mismatch"):
+        download.download_file(remote_file)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_transcoded_mirror_directory(tmp_path):
+    mirror_dir = tmp_path / "mirror"
+    mirror_dir.mkdir()
+    (mirror_dir / "training_data.csv.gz").write_bytes(CSV_GZ)
+    remote_file = download.RemoteFile(
+        url="http://127.0.0.1:9/training_data.csv.gz",
+        out_path=tmp_path / "training_data.parquet",
+        checksum=CSV_GZ_CHECKSUM,
+        transcode=True,
+    )
+
+    out_path = download.download_file(remote_file, mirror=mirror_dir, chunk_size=4096)
+    pd.testing.assert_frame_equal(
+        loader.load_profiles(out_path),
+        pd.read_csv(io.BytesIO(CSV_GZ), compression="gzip"),
+    )
+    assert download.is_valid(remote_file)
@@ -0,0 +1,116 @@
+"""
+Tests of the selective extraction of the control archive members.
+"""
+import gzip
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import extract, loader
+
+MEMBERS = [
+    "normalized_data/negative_control_data.csv.gz",
+    "normalized_data/positive_control_data.csv.gz",
+    "normalized_data/training_data.csv",
+]
+
+
+def _profiles_csv(seed: int) -> bytes:
+    """CSV file of single-cell profiles"""
+    rng = np.random.default_rng(seed)
+    n_rows = 50
+    profiles = pd.DataFrame(
+        {
+            "Mitocheck_Phenotypic_Class": rng.choice(["Large", "neg_control"], n_rows),
+            "Cell_UUID": [f"cell_{idx}" for idx in range(n_rows)],
+            "Metadata_Plate": rng.integers(1, 5, n_rows),
+            "Metadata_Well": rng.choice(["A01", "B02", None], n_rows),
+            "CP__AreaShape_Area": rng.normal(size=n_rows),
+            "DP__efficientnet_0": rng.normal(size=n_rows),
+        }
+    )
+    return profiles.to_csv(index=False).encode()
+
+
+@pytest.fixture
+def zip_path(tmp_path):
+    path = tmp_path / "3.normalized_data.zip"
+    with zipfile.ZipFile(path, mode="w") as zip_file:
+        for seed, member in enumerate(MEMBERS):
+            csv_data = _profiles_csv(seed)
+            zip_file.writestr(
+                member, gzip.compress(csv_data) if member.endswith(".gz") else csv_data
+            )
+    return path
+
+
+def _read_member(zip_path, member) -> pd.DataFrame:
+    with zipfile.ZipFile(zip_path) as zip_file, zip_file.open(member) as member_file:
+        return pd.read_csv(
+            member_file, compression="gzip" if member.endswith(".gz") else None
+        )
+
+
+def test_extract_only_requested_members(zip_path, tmp_path):
+    out_dir = tmp_path / "raw"
+    out_paths = extract.extract_members(
+        zip_path, ["negative_control_data.csv.gz"], out_dir
+    )
+
+    assert out_paths == [out_dir / MEMBERS[0]]
+    assert sorted(path.name for path in out_dir.rglob("*") if path.is_file()) == [
+        "negative_control_data.csv.gz",
+        "negative_control_data.csv.gz.member.json",
+    ]
+    with zipfile.ZipFile(zip_path) as zip_file:
+        assert out_paths[0].read_bytes() == zip_file.read(MEMBERS[0])
+
+
+def test_extracted_members_are_skipped(zip_path, tmp_path, monkeypatch):
+    out_dir = tmp_path / "raw"
+    (out_path,) = extract.extract_members(zip_path, [MEMBERS[1]], out_dir)
+    mtime_ns = out_path.stat().st_mtime_ns
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the member was extracted again")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(extract.shutil, "copyfileobj", fail)
+        assert extract.extract_members(zip_path, [MEMBERS[1]], out_dir) == [out_path]
+    assert out_path.stat().st_mtime_ns == mtime_ns
+
+    # a modified file is extracted again
+    out_path.write_bytes(b"")
+    assert extract.extract_members(zip_path, [MEMBERS[1]], out_dir) == [out_path]
+    with zipfile.ZipFile(zip_path) as zip_file:
+        assert out_path.read_bytes() == zip_file.read(MEMBERS[1])
+
+
+@pytest.mark.parametrize("member", [MEMBERS[0], MEMBERS[2]])
+def test_transcoded_members_match_read_csv(zip_path, tmp_path, monkeypatch, member):
+    out_dir = tmp_path / "raw"
+    (out_path,) = extract.extract_members(zip_path, [member], out_dir, transcode=True)
+
+    assert out_path.suffix == ".parquet"
+    # the CSV member is never written to disk
+    assert sorted(path.name for path in out_dir.rglob("*") if path.is_file()) == [
+        out_path.name,
+        f"{out_path.name}.member.json",
+    ]
+    pd.testing.assert_frame_equal(
+        loader.load_profiles(out_path), _read_member(zip_path, member)
+    )
+
+    # transcoded members are skipped too
+    def fail(*args, **kwargs):
+        raise AssertionError("the member was transcoded again")
+
+    monkeypatch.setattr(extract.loader, "stream_csv_to_parquet", fail)
+    extract.extract_members(zip_path, [member], out_dir, transcode=True)
+
+
+def test_missing_member(zip_path, tmp_path):
+    with pytest.raises(KeyError, match="matches 0 members"):
+        extract.extract_members(zip_path, ["missing.csv.gz"], tmp_path / "raw")
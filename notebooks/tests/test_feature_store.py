@@ -0,0 +1,74 @@
+"""
+Tests of the memory-mapped array store shared by the worker processes.
+"""
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from src import feature_store
+
+N_PROCESSES = 16
+
+
+def _save_after_barrier(store_dir, barrier, queue) -> None:
+    """Saves the same array as all the other processes at the same time"""
+    barrier.wait()
+    try:
+        stored = feature_store.FeatureStore(store_dir).save(
+            "shared", np.arange(100_000, dtype=np.float64)
+        )
+        queue.put(float(stored.sum()))
+    except Exception as error:
+        queue.put(repr(error))
+
+
+def test_concurrent_save(tmp_path):
+    mp_context = multiprocessing.get_context("fork")
+    for round_idx in range(5):
+        store_dir = tmp_path / f"store_{round_idx}"
+        store_dir.mkdir()
+        barrier = mp_context.Barrier(N_PROCESSES)
+        queue = mp_context.Queue()
+        processes = [
+            mp_context.Process(
+                target=_save_after_barrier, args=(store_dir, barrier, queue)
+            )
+            for _ in range(N_PROCESSES)
+        ]
+        for process in processes:
+            process.start()
+        results = [queue.get(timeout=60) for _ in processes]
+        for process in processes:
+            process.join()
+
+        assert results == [float(np.arange(100_000).sum())] * N_PROCESSES
+        assert [path.name for path in store_dir.iterdir()] == ["shared.npy"]
+
+
+def test_save_preserves_memory_layout(tmp_path):
+    store = feature_store.FeatureStore.create(tmp_path)
+    array = np.asfortranarray(np.arange(12, dtype=np.float32).reshape(3, 4))
+
+    stored = store.save("feats", array)
+    assert stored.flags.f_contiguous
+    np.testing.assert_array_equal(stored, array)
+    assert store.names() == ["feats"]
+
+
+def test_metadata_round_trip(tmp_path):
+    store = feature_store.FeatureStore.create(tmp_path)
+    meta = pd.DataFrame(
+        {
+            "Mitocheck_Phenotypic_Class": pd.Categorical(
+                ["Large", None, "neg_control", "Large"]
+            ),
+            "Metadata_Plate": [1.0, 2.0, np.nan, 2.0],
+            "Metadata_Well": ["A01", "B02", "A01", None],
+        }
+    )
+    store.save_metadata("meta", meta)
+
+    idx = np.array([3, 1, 0, 2])
+    loaded = store.load_metadata("meta", idx)
+    pd.testing.assert_frame_equal(loaded, meta.iloc[idx].reset_index(drop=True))
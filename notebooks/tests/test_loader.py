@@ -0,0 +1,101 @@
+"""
+Tests of the parquet cache of the single-cell profiles against `pd.read_csv()`.
+"""
+import gzip
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import loader
+
+N_ROWS = 2000
+
+
+def _write_profiles(csv_path) -> None:
+    """Writes a gzip compressed CSV file of single-cell profiles with a saved index.
+    Some metadata columns only get missing values or their final type in the last
+    rows, far from the first block parsed by pyarrow.
+    """
+    rng = np.random.default_rng(0)
+    profiles = pd.DataFrame(
+        {
+            "Mitocheck_Phenotypic_Class": rng.choice(["Large", "Polylobed"], N_ROWS),
+            "Cell_UUID": [f"cell_{idx}" for idx in range(N_ROWS)],
+            "Metadata_Plate": rng.integers(1, 5, N_ROWS).astype(object),
+            "Metadata_Frame": rng.integers(0, 100, N_ROWS).astype(object),
+            "Metadata_Site": rng.integers(0, 10, N_ROWS).astype(float),
+            "Metadata_Well": rng.choice(["A01", "B02"], N_ROWS).astype(object),
+            "CP__AreaShape_Area": rng.normal(size=N_ROWS),
+            "DP__efficientnet_0": rng.normal(size=N_ROWS),
+        }
+    )
+    profiles.loc[N_ROWS - 1, "Metadata_Plate"] = "LT0010_27"
+    profiles.loc[N_ROWS - 1, "Metadata_Frame"] = 1.5
+    profiles.loc[N_ROWS - 2, "Metadata_Site"] = np.nan
+    profiles.loc[N_ROWS - 3, "Metadata_Well"] = None
+    with gzip.open(csv_path, "wt") as csv_file:
+        profiles.to_csv(csv_file)
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = tmp_path / "training_data.csv.gz"
+    _write_profiles(path)
+    return path
+
+
+def test_small_blocks_match_read_csv(csv_path, tmp_path):
+    parquet_path = loader.csv_to_parquet(
+        csv_path, tmp_path / "profiles.parquet", block_size=4096
+    )
+
+    loaded = loader.load_profiles(parquet_path)
+    pd.testing.assert_frame_equal(loaded, pd.read_csv(csv_path))
+
+
+def test_stream_matches_read_csv(csv_path, tmp_path):
+    with gzip.open(csv_path, "rb") as csv_stream:
+        parquet_path = loader.stream_csv_to_parquet(
+            csv_stream, tmp_path / "profiles.parquet", block_size=4096
+        )
+
+    loaded = loader.load_profiles(parquet_path)
+    pd.testing.assert_frame_equal(loaded, pd.read_csv(csv_path))
+
+
+def test_cache_round_trip(csv_path, tmp_path):
+    cache_dir = tmp_path / "cache"
+    expected = pd.read_csv(csv_path)
+
+    loaded = loader.load_profiles(csv_path, cache_dir=cache_dir)
+    pd.testing.assert_frame_equal(loaded, expected)
+
+    # the feature space only selects the feature columns
+    loaded = loader.load_profiles(csv_path, dataset="CP", cache_dir=cache_dir)
+    pd.testing.assert_frame_equal(loaded, expected.drop(columns="DP__efficientnet_0"))
+
+
+def test_cache_is_keyed_by_feature_dtype(csv_path, tmp_path):
+    cache_dir = tmp_path / "cache"
+    float64_path = loader.build_cache(csv_path, cache_dir=cache_dir)
+    float32_path = loader.build_cache(
+        csv_path, cache_dir=cache_dir, feature_dtype="float32"
+    )
+    assert float64_path != float32_path
+    assert sorted(cache_dir.iterdir()) == sorted([float64_path, float32_path])
+
+    loaded = loader.load_profiles(
+        csv_path, cache_dir=cache_dir, feature_dtype="float32"
+    )
+    expected = pd.read_csv(csv_path)
+    for colname in ["CP__AreaShape_Area", "DP__efficientnet_0"]:
+        expected[colname] = expected[colname].astype(np.float32)
+    pd.testing.assert_frame_equal(loaded, expected)
+
+    # a modified CSV file replaces the cache files of all feature types
+    stat = csv_path.stat()
+    os.utime(csv_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    new_path = loader.build_cache(csv_path, cache_dir=cache_dir)
+    assert list(cache_dir.iterdir()) == [new_path]
@@ -0,0 +1,84 @@
+"""
+Tests of the dictionary encoding of the metadata columns.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import metadata_codec
+
+
+def _profiles():
+    """Training and control profiles with the encoded metadata columns"""
+    training = pd.DataFrame(
+        {
+            "Mitocheck_Phenotypic_Class": ["Large", "Prometaphase", "Large"],
+            "Cell_UUID": ["cell_2", "cell_0", "cell_1"],
+            "Metadata_Plate": [2, 1, 2],
+            "Metadata_Well": ["B02", None, "A01"],
+            "CP__Area": [1.0, 2.0, 3.0],
+        }
+    )
+    control = pd.DataFrame(
+        {
+            "Mitocheck_Phenotypic_Class": ["neg_control", "neg_control"],
+            "Cell_UUID": ["cell_3", "cell_4"],
+            "Metadata_Plate": [3, 1],
+            "Metadata_Well": ["C03", "A01"],
+            "CP__Area": [4.0, 5.0],
+        }
+    )
+    return training, control
+
+
+def test_round_trip():
+    training, control = _profiles()
+    codec = metadata_codec.MetadataCodec.fit([training, control])
+
+    for profile in (training, control):
+        encoded = codec.encode(profile)
+        for colname in metadata_codec.CODED_COLUMNS:
+            assert isinstance(encoded[colname].dtype, pd.CategoricalDtype)
+        pd.testing.assert_frame_equal(codec.decode(encoded), profile)
+
+
+def test_encoded_profiles_share_codes():
+    training, control = _profiles()
+    codec = metadata_codec.MetadataCodec.fit([training, control])
+    encoded = pd.concat(map(codec.encode, (training, control)), ignore_index=True)
+
+    # concatenated profiles stay categorical and keep the codes of the values
+    assert isinstance(encoded["Metadata_Well"].dtype, pd.CategoricalDtype)
+    np.testing.assert_array_equal(
+        codec.codes(encoded, "Metadata_Plate"), [1, 0, 1, 2, 0]
+    )
+    np.testing.assert_array_equal(
+        codec.codes(encoded, "Metadata_Well"), [1, -1, 0, 2, 0]
+    )
+    assert codec.code("Mitocheck_Phenotypic_Class", "neg_control") == 2
+    pd.testing.assert_frame_equal(
+        codec.decode(encoded),
+        pd.concat([training, control], ignore_index=True),
+    )
+
+
+def test_integer_column_with_missing_values_decodes_as_float():
+    training, control = _profiles()
+    codec = metadata_codec.MetadataCodec.fit([training, control])
+    training["Metadata_Plate"] = [2.0, np.nan, 1.0]
+
+    decoded = codec.decode(codec.encode(training))
+    assert decoded["Metadata_Plate"].dtype == np.float64
+    pd.testing.assert_series_equal(
+        decoded["Metadata_Plate"], training["Metadata_Plate"]
+    )
+
+
+def test_unknown_values():
+    training, control = _profiles()
+    codec = metadata_codec.MetadataCodec.fit([training])
+
+    with pytest.raises(ValueError):
+        codec.encode(control)
+    with pytest.raises(KeyError):
+        codec.code("Cell_UUID", "cell_4")
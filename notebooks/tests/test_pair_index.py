@@ -0,0 +1,137 @@
+"""
+Tests of the positive and negative pair indexes.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import average_precision, pair_index
+
+PAIR_PARAMS = dict(
+    pos_sameby=["Mitocheck_Phenotypic_Class"],
+    pos_diffby=["Cell_UUID"],
+    neg_sameby=[],
+    neg_diffby=["Mitocheck_Phenotypic_Class"],
+)
+
+
+def _block_meta(block_sizes) -> pd.DataFrame:
+    """Metadata of contiguous blocks of cells with unique identifiers"""
+    labels = np.repeat([f"class_{idx}" for idx in range(len(block_sizes))], block_sizes)
+    return pd.DataFrame(
+        {
+            "Mitocheck_Phenotypic_Class": labels,
+            "Cell_UUID": [f"cell_{idx}" for idx in range(len(labels))],
+        }
+    )
+
+
+def _all_masks(index: pair_index.PairIndex, batch_size: int):
+    """Masks of all the cells, built in batches of query cells"""
+    batches = [
+        index.masks(slice(start, start + batch_size))
+        for start in range(0, index.n_cells, batch_size)
+    ]
+    return tuple(np.concatenate(masks) for masks in zip(*batches))
+
+
+@pytest.mark.parametrize("block_sizes", [[1, 1], [5, 5], [37, 37], [3, 9], [4, 1, 6]])
+@pytest.mark.parametrize("batch_size", [1, 3, 1000])
+def test_block_index_matches_coded_index(block_sizes, batch_size):
+    meta = _block_meta(block_sizes)
+    meta["Mitocheck_Phenotypic_Class"] = meta["Mitocheck_Phenotypic_Class"].astype(
+        "category"
+    )
+
+    block_index = pair_index.build_pair_index(meta, **PAIR_PARAMS)
+    coded_index = pair_index.CodedPairIndex(meta, **PAIR_PARAMS)
+    assert isinstance(block_index, pair_index.BlockPairIndex)
+
+    for block_mask, coded_mask in zip(
+        _all_masks(block_index, batch_size), _all_masks(coded_index, batch_size)
+    ):
+        np.testing.assert_array_equal(block_mask, coded_mask)
+
+
+@pytest.mark.parametrize(
+    "labels, cell_ids",
+    [
+        (["a", "b", "a", "b"], ["w", "x", "y", "z"]),
+        (["a", "a", "b", "b"], ["w", "w", "y", "z"]),
+        (["a", "a", None, "b"], ["w", "x", "y", "z"]),
+        (["a", "a", "b", "b"], ["w", "x", None, "z"]),
+    ],
+)
+def test_other_layouts_use_coded_index(labels, cell_ids):
+    meta = pd.DataFrame({"Mitocheck_Phenotypic_Class": labels, "Cell_UUID": cell_ids})
+    index = pair_index.build_pair_index(meta, **PAIR_PARAMS)
+    assert isinstance(index, pair_index.CodedPairIndex)
+
+
+@pytest.mark.parametrize("missing_col", ["Mitocheck_Phenotypic_Class", "Cell_UUID"])
+def test_cells_with_missing_values_are_not_paired(missing_col):
+    rng = np.random.default_rng(0)
+    meta = _block_meta([10, 10])
+    missing_idx = [2, 7, 15]
+    meta.loc[missing_idx, missing_col] = None
+
+    feats = rng.normal(size=(meta.shape[0], 8))
+    sim = feats @ feats.T
+    result = average_precision.run_pipeline(meta, sim, null_size=10, **PAIR_PARAMS)
+
+    # cells with missing values have no pairs
+    assert (result.loc[missing_idx, "n_pos_pairs"] == 0).all()
+    assert result.loc[missing_idx, "average_precision"].isna().all()
+
+    # the other cells are scored as if the cells with missing values were dropped
+    kept_idx = np.setdiff1d(np.arange(meta.shape[0]), missing_idx)
+    expected = average_precision.run_pipeline(
+        meta.iloc[kept_idx],
+        sim[np.ix_(kept_idx, kept_idx)],
+        null_size=10,
+        **PAIR_PARAMS,
+    )
+    for colname in ("n_pos_pairs", "n_total_pairs"):
+        np.testing.assert_array_equal(result.loc[kept_idx, colname], expected[colname])
+    np.testing.assert_allclose(
+        result.loc[kept_idx, "average_precision"],
+        expected["average_precision"],
+        rtol=1e-12,
+    )
+
+
+def test_permutations_with_missing_labels():
+    rng = np.random.default_rng(1)
+    meta = _block_meta([8, 8])
+    meta.loc[[3, 12], "Mitocheck_Phenotypic_Class"] = None
+    feats = rng.normal(size=(meta.shape[0], 8))
+    sim = feats @ feats.T
+
+    permuted_labels = average_precision.permute_labels(
+        meta["Mitocheck_Phenotypic_Class"].to_numpy(dtype=object),
+        n_permutations=3,
+        seed=0,
+    )
+    result = average_precision.run_permutations(
+        meta,
+        sim,
+        label_col="Mitocheck_Phenotypic_Class",
+        permuted_labels=permuted_labels,
+        null_size=10,
+        **PAIR_PARAMS,
+    )
+
+    # every permutation is scored as a regular run with the permuted labels
+    for perm_idx, labels in enumerate(permuted_labels):
+        permuted_meta = meta.assign(Mitocheck_Phenotypic_Class=labels)
+        expected = average_precision.run_pipeline(
+            permuted_meta, sim, null_size=10, **PAIR_PARAMS
+        )
+        perm_result = result.iloc[
+            perm_idx * meta.shape[0] : (perm_idx + 1) * meta.shape[0]
+        ]
+        for colname in ("n_pos_pairs", "n_total_pairs"):
+            np.testing.assert_array_equal(perm_result[colname], expected[colname])
+        np.testing.assert_allclose(
+            perm_result["average_precision"], expected["average_precision"], rtol=1e-12
+        )
@@ -0,0 +1,48 @@
+"""
+Tests of the control resamples against `pd.DataFrame.sample()`.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import resampling
+
+
+@pytest.mark.parametrize("n_rows", [1, 7, 1000, 12345])
+@pytest.mark.parametrize("frac", [0.0, 0.010, 0.3, 1.0])
+def test_sample_positions_match_dataframe_sample(n_rows, frac):
+    controls = pd.DataFrame({"Cell_UUID": np.arange(n_rows)}, index=np.arange(n_rows))
+    for seed in range(5):
+        expected = controls.sample(frac=frac, random_state=seed).index.to_numpy()
+        np.testing.assert_array_equal(
+            resampling.sample_positions(n_rows, frac, seed), expected
+        )
+
+
+def test_draw_controls_match_dataframe_sample():
+    n_controls, n_entries, frac = 5000, 20, 0.010
+    seeds = [3, 0, 7]
+    controls = pd.DataFrame(
+        {"Cell_UUID": [f"cell_{idx}" for idx in range(n_controls)]},
+        index=np.arange(n_controls) * 10,
+    )
+
+    draws = resampling.draw_controls(n_controls, seeds, n_entries, frac=frac)
+    assert draws.shape == (len(seeds), n_entries)
+    for seed, seed_draws in zip(seeds, draws):
+        expected = controls.sample(frac=frac, random_state=seed).iloc[:n_entries]
+        pd.testing.assert_frame_equal(controls.iloc[seed_draws], expected)
+
+
+def test_draw_controls_with_fewer_controls_than_entries():
+    draws = resampling.draw_controls(1000, [0, 1], n_entries=50, frac=0.010)
+    assert draws.shape == (2, 10)
+
+
+def test_control_pool():
+    draws = resampling.draw_controls(5000, range(10), n_entries=30, frac=0.010)
+    pool_positions, pool_draws = resampling.control_pool(draws)
+
+    assert np.all(np.diff(pool_positions) > 0)
+    np.testing.assert_array_equal(pool_positions, np.unique(draws))
+    np.testing.assert_array_equal(pool_positions[pool_draws], draws)
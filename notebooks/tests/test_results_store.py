@@ -0,0 +1,270 @@
+"""
+Tests of the resumable results store against a single pass over the analysis grid.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import results_store, scheduler, similarity
+
+PHENOTYPE_SIZES = {"Large": 5, "Prometaphase": 8, "Apoptosis": 3}
+MODES = ["non-shuffled", "phenotype_shuffled", "features_shuffled"]
+
+
+def _grid():
+    return scheduler.expand_grid(PHENOTYPE_SIZES, [0, 1], ["CP", "DP"], MODES)
+
+
+def _job_results(job):
+    """Deterministic results of a job for each of its shuffling modes"""
+    job_results = {}
+    for mode in job.modes:
+        # a phenotype without results for the shuffled features
+        if job.phenotype == "Apoptosis" and mode == "features_shuffled":
+            continue
+        job_results[mode] = pd.DataFrame(
+            {
+                "Mitocheck_Phenotypic_Class": pd.Categorical(
+                    [job.phenotype] * job.n_cells + ["neg_control"] * 2,
+                    categories=[*PHENOTYPE_SIZES, "neg_control"],
+                ),
+                "average_precision": [
+                    job.seed + idx / (job.n_cells + 2) for idx in range(job.n_cells + 2)
+                ],
+                "shuffled": mode,
+            }
+        )
+    return job_results
+
+
+class _CountingJobFn:
+    """Job function that records the jobs it computes"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def __call__(self, job):
+        self.jobs.append(job)
+        return _job_results(job)
+
+
+def test_partitions_are_written_per_job_and_mode(tmp_path):
+    store = results_store.ResultsStore(tmp_path)
+    job = _grid()[0]
+    store.add(job, _job_results(job))
+
+    for mode in job.modes:
+        partition_dir = store.partition_dir(job, mode)
+        assert (partition_dir / results_store.SUCCESS_MARKER).is_file()
+        assert (partition_dir / "part.parquet").is_file()
+        assert not (partition_dir / "part.parquet.tmp").exists()
+    assert store.is_complete(job)
+
+
+def test_incomplete_partitions_are_recomputed(tmp_path):
+    store = results_store.ResultsStore(tmp_path)
+    jobs = _grid()
+    scheduler.run_jobs(jobs, _CountingJobFn(), store, n_workers=1)
+
+    # an interrupted write leaves the partition without its marker
+    interrupted_job = jobs[3]
+    mode = interrupted_job.modes[-1]
+    (store.partition_dir(interrupted_job, mode) / results_store.SUCCESS_MARKER).unlink()
+    assert store.pending_jobs(jobs) == [interrupted_job]
+
+    job_fn = _CountingJobFn()
+    scheduler.run_jobs(jobs, job_fn, store, n_workers=1)
+    assert job_fn.jobs == [interrupted_job]
+    assert store.pending_jobs(jobs) == []
+
+
+def test_complete_jobs_are_skipped(tmp_path):
+    store = results_store.ResultsStore(tmp_path)
+    jobs = _grid()
+    scheduler.run_jobs(jobs[:5], _CountingJobFn(), store, n_workers=1)
+
+    job_fn = _CountingJobFn()
+    scheduler.run_jobs(jobs, job_fn, store, n_workers=1)
+    assert job_fn.jobs == jobs[5:]
+
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize("feature_space", ["CP", "DP"])
+def test_to_csv_matches_single_pass(tmp_path, feature_space, mode):
+    store = results_store.ResultsStore(tmp_path / "store")
+    jobs = _grid()
+
+    # a run interrupted after a few jobs, then resumed
+    scheduler.run_jobs(jobs[:4], _CountingJobFn(), store, n_workers=1)
+    scheduler.run_jobs(jobs, _CountingJobFn(), store, n_workers=1)
+
+    # results of a single pass in sequential order
+    single_pass = pd.concat(
+        [
+            _job_results(job)[mode]
+            for job in sorted(jobs, key=lambda job: job.order)
+            if job.feature_space == feature_space and mode in _job_results(job)
+        ],
+        ignore_index=True,
+    )
+    single_pass.to_csv(tmp_path / "single_pass.csv", index=False)
+
+    store.to_csv(tmp_path / "store.csv", feature_space, mode, jobs)
+    assert (tmp_path / "store.csv").read_text() == (
+        tmp_path / "single_pass.csv"
+    ).read_text()
+
+    # partitions only keep the categories of their own rows, so the concatenated
+    # categorical columns are decoded
+    pd.testing.assert_frame_equal(
+        store.results(feature_space, mode, jobs),
+        single_pass.astype({"Mitocheck_Phenotypic_Class": str}),
+    )
+
+
+def test_to_csv_without_results(tmp_path):
+    store = results_store.ResultsStore(tmp_path)
+    with pytest.raises(ValueError, match="no results stored"):
+        store.to_csv(tmp_path / "results.csv", "CP", "non-shuffled", _grid())
+    assert not (tmp_path / "results.csv").exists()
+
+
+def _pool(n_controls=6):
+    """Metadata and CP and DP features of a pool of training and control cells"""
+    phenotypes = [
+        phenotype
+        for phenotype, n_cells in PHENOTYPE_SIZES.items()
+        for _ in range(n_cells)
+    ] + ["neg_control"] * n_controls
+    meta = pd.DataFrame(
+        {
+            "Mitocheck_Phenotypic_Class": phenotypes,
+            "Cell_UUID": [f"cell_{idx}" for idx in range(len(phenotypes))],
+        }
+    )
+    rng = np.random.default_rng(0)
+    blocks = {name: rng.normal(size=(len(meta), 3)) for name in ["CP", "DP"]}
+    return meta, blocks
+
+
+def _fingerprints(jobs, meta, blocks):
+    """Fingerprints the cells of the phenotype and the controls resampled with the
+    seed of each job, as the analysis notebook does"""
+    row_hashes = {"meta": results_store.row_hashes(meta)}
+    for name, feats in blocks.items():
+        row_hashes[name] = results_store.row_hashes(feats)
+    control_idx = np.flatnonzero(meta["Mitocheck_Phenotypic_Class"] == "neg_control")
+
+    fingerprints = {}
+    for job in jobs:
+        idx = np.concatenate(
+            [
+                np.flatnonzero(meta["Mitocheck_Phenotypic_Class"] == job.phenotype),
+                np.random.default_rng(job.seed).choice(control_idx, 2, replace=False),
+            ]
+        )
+        block_names = ["meta", *similarity.DATASET_BLOCKS[job.feature_space]]
+        fingerprints[job] = results_store.job_fingerprint(
+            [row_hashes[name][idx] for name in block_names],
+            columns=[*meta.columns, *block_names[1:]],
+        )
+    return fingerprints
+
+
+def test_job_fingerprint():
+    rng = np.random.default_rng(1)
+    hashes = [results_store.row_hashes(rng.normal(size=(5, 3)))]
+    fingerprint = results_store.job_fingerprint(hashes, ["a", "b", "c"])
+    assert results_store.job_fingerprint(hashes, ["a", "b", "c"]) == fingerprint
+
+    # different rows, row order, columns or parameters
+    changed_feats = rng.normal(size=(5, 3))
+    assert (
+        results_store.job_fingerprint(
+            [results_store.row_hashes(changed_feats)], ["a", "b", "c"]
+        )
+        != fingerprint
+    )
+    assert (
+        results_store.job_fingerprint([hashes[0][::-1]], ["a", "b", "c"]) != fingerprint
+    )
+    assert results_store.job_fingerprint(hashes, ["a", "b", "d"]) != fingerprint
+    assert (
+        results_store.job_fingerprint(hashes, ["a", "b", "c"], null_size=10)
+        != fingerprint
+    )
+
+
+def test_stale_fingerprints_are_recomputed(tmp_path):
+    store = results_store.ResultsStore(tmp_path)
+    jobs = _grid()
+    meta, blocks = _pool()
+    fingerprints = _fingerprints(jobs, meta, blocks)
+    scheduler.run_jobs(
+        jobs, _CountingJobFn(), store, n_workers=1, fingerprints=fingerprints
+    )
+
+    # matching fingerprints are skipped
+    job_fn = _CountingJobFn()
+    scheduler.run_jobs(jobs, job_fn, store, n_workers=1, fingerprints=fingerprints)
+    assert job_fn.jobs == []
+
+    # changing the DP features of a training cell only recomputes the jobs of its
+    # phenotype that use the DP features
+    blocks["DP"][0, 0] += 1
+    job_fn = _CountingJobFn()
+    scheduler.run_jobs(
+        jobs, job_fn, store, n_workers=1, fingerprints=_fingerprints(jobs, meta, blocks)
+    )
+    assert job_fn.jobs == [
+        job
+        for job in jobs
+        if job.phenotype == meta["Mitocheck_Phenotypic_Class"][0]
+        and job.feature_space == "DP"
+    ]
+
+
+def test_grown_grid_only_computes_new_jobs(tmp_path):
+    store = results_store.ResultsStore(tmp_path / "store")
+    meta, blocks = _pool()
+    jobs = scheduler.expand_grid(
+        {"Large": 5, "Prometaphase": 8}, [0, 1], ["CP", "DP"], MODES
+    )
+    scheduler.run_jobs(
+        jobs,
+        _CountingJobFn(),
+        store,
+        n_workers=1,
+        fingerprints=_fingerprints(jobs, meta, blocks),
+    )
+
+    # adding a phenotype and a seed
+    grown_jobs = scheduler.expand_grid(PHENOTYPE_SIZES, [0, 1, 2], ["CP", "DP"], MODES)
+    job_fn = _CountingJobFn()
+    scheduler.run_jobs(
+        grown_jobs,
+        job_fn,
+        store,
+        n_workers=1,
+        fingerprints=_fingerprints(grown_jobs, meta, blocks),
+    )
+    assert sorted(job_fn.jobs, key=lambda job: job.order) == sorted(
+        [job for job in grown_jobs if job.phenotype == "Apoptosis" or job.seed == 2],
+        key=lambda job: job.order,
+    )
+
+    # the merged results match a single pass over the grown grid
+    for mode in MODES:
+        single_pass = pd.concat(
+            [
+                _job_results(job)[mode]
+                for job in sorted(grown_jobs, key=lambda job: job.order)
+                if job.feature_space == "CP" and mode in _job_results(job)
+            ],
+            ignore_index=True,
+        )
+        single_pass.to_csv(tmp_path / "single_pass.csv", index=False)
+        store.to_csv(tmp_path / "store.csv", "CP", mode, grown_jobs)
+        assert (tmp_path / "store.csv").read_text() == (
+            tmp_path / "single_pass.csv"
+        ).read_text()
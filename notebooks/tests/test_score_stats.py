@@ -0,0 +1,126 @@
+"""
+Tests of the grouped sampling errors and bootstrap confidence intervals against
+plain loops over the groups.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import score_stats
+
+GROUP_COLS = ["Mitocheck_Phenotypic_Class", "feature_type"]
+
+
+def _single_cell_scores() -> pd.DataFrame:
+    """Single-cell scores of groups of different sizes, with missing scores, missing
+    group keys and a group without scores"""
+    rng = np.random.default_rng(0)
+    n_rows = 200
+    scores = pd.DataFrame(
+        {
+            "Mitocheck_Phenotypic_Class": rng.choice(
+                ["Large", "Prometaphase", "Apoptosis", None],
+                n_rows,
+                p=[0.5, 0.3, 0.1, 0.1],
+            ),
+            "feature_type": rng.choice(["CP", "DP"], n_rows),
+            "average_precision": rng.random(n_rows),
+        }
+    )
+    scores.loc[rng.random(n_rows) < 0.1, "average_precision"] = np.nan
+    scores.loc[
+        scores["Mitocheck_Phenotypic_Class"] == "Apoptosis", "feature_type"
+    ] = "CP"
+    scores.loc[
+        scores["Mitocheck_Phenotypic_Class"] == "Apoptosis", "average_precision"
+    ] = np.nan
+    scores.loc[len(scores)] = ["Large", "CP_and_DP", 0.5]
+    return scores
+
+
+def _group_scores(scores: pd.DataFrame):
+    """Yields the keys and the non-missing scores of each group"""
+    for keys, group in scores.groupby(GROUP_COLS, sort=True, observed=True):
+        yield keys, group["average_precision"].dropna().to_numpy()
+
+
+def test_sampling_error_matches_groupby():
+    scores = _single_cell_scores()
+    grouped = scores.groupby(GROUP_COLS, sort=True, observed=True)["average_precision"]
+    expected = (grouped.std(ddof=0) / np.sqrt(grouped.count())).rename("sampling_error")
+
+    errors = score_stats.sampling_error(scores, by=GROUP_COLS)
+    pd.testing.assert_series_equal(
+        errors.set_index(GROUP_COLS)["sampling_error"], expected
+    )
+
+    # population standard deviation of the scores of each group
+    for (_, group_scores), error in zip(
+        _group_scores(scores), errors["sampling_error"]
+    ):
+        if len(group_scores) == 0:
+            assert np.isnan(error)
+        else:
+            np.testing.assert_allclose(
+                error, np.std(group_scores) / np.sqrt(len(group_scores)), rtol=1e-12
+            )
+
+
+@pytest.mark.parametrize("batch_values", [score_stats.BOOTSTRAP_BATCH_VALUES, 500])
+def test_bootstrap_ci_matches_loop(monkeypatch, batch_values):
+    # small batches split the resamples into several batches of draws
+    monkeypatch.setattr(score_stats, "BOOTSTRAP_BATCH_VALUES", batch_values)
+    scores = _single_cell_scores()
+    n_resamples = 50
+
+    intervals = score_stats.bootstrap_ci(
+        scores, by=GROUP_COLS, n_resamples=n_resamples, confidence=0.9, seed=3
+    )
+
+    # resampling every group in a loop, positions are drawn in the same order
+    groups = list(_group_scores(scores))
+    group_sizes = np.concatenate(
+        [np.full(len(group_scores), len(group_scores)) for _, group_scores in groups]
+    )
+    rng = np.random.default_rng(3)
+    boot_means = np.full((n_resamples, len(groups)), np.nan)
+    for resample_idx in range(n_resamples):
+        draws = rng.integers(0, group_sizes)
+        start = 0
+        for group_idx, (_, group_scores) in enumerate(groups):
+            group_draws = draws[start : start + len(group_scores)]
+            if len(group_scores) > 0:
+                boot_means[resample_idx, group_idx] = group_scores[group_draws].mean()
+            start += len(group_scores)
+
+    assert [tuple(keys) for keys, _ in groups] == list(
+        intervals[GROUP_COLS].itertuples(index=False, name=None)
+    )
+    np.testing.assert_allclose(
+        intervals["ci_low"], np.quantile(boot_means, 0.05, axis=0), rtol=1e-12
+    )
+    np.testing.assert_allclose(
+        intervals["ci_high"], np.quantile(boot_means, 0.95, axis=0), rtol=1e-12
+    )
+
+    # groups without scores have no interval, a single score has an empty interval
+    no_scores = intervals["Mitocheck_Phenotypic_Class"] == "Apoptosis"
+    assert intervals.loc[no_scores, ["ci_low", "ci_high"]].isna().all(axis=None)
+    single_score = intervals["feature_type"] == "CP_and_DP"
+    assert (intervals.loc[single_score, ["ci_low", "ci_high"]] == 0.5).all(axis=None)
+
+
+def test_bootstrap_ci_is_seeded():
+    scores = _single_cell_scores()
+    intervals = score_stats.bootstrap_ci(scores, by=GROUP_COLS, n_resamples=20)
+    pd.testing.assert_frame_equal(
+        score_stats.bootstrap_ci(scores, by=GROUP_COLS, n_resamples=20), intervals
+    )
+    assert not score_stats.bootstrap_ci(
+        scores, by=GROUP_COLS, n_resamples=20, seed=1
+    ).equals(intervals)
+
+
+def test_bootstrap_ci_confidence():
+    with pytest.raises(ValueError, match="confidence"):
+        score_stats.bootstrap_ci(_single_cell_scores(), by=GROUP_COLS, confidence=1)
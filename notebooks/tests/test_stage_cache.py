@@ -0,0 +1,112 @@
+"""
+Tests of the content-addressed stage cache keys and artefacts.
+"""
+import os
+
+import pytest
+
+from src import stage_cache
+
+PARAMS = dict(
+    pos_sameby=["Mitocheck_Phenotypic_Class"],
+    neg_diffby=["Mitocheck_Phenotypic_Class"],
+    null_size=100,
+    batch_size=1000,
+    n_resamples=10,
+)
+
+
+@pytest.fixture
+def input_file(tmp_path):
+    file_path = tmp_path / "training_data.csv.gz"
+    file_path.write_bytes(b"0123456789")
+    os.utime(file_path, ns=(1_000_000_000, 1_000_000_000))
+    return file_path
+
+
+def test_key_changes_with_input_file_size(tmp_path, input_file):
+    cache = stage_cache.StageCache(tmp_path / "cache")
+    key = cache.key("load", PARAMS, [input_file])
+
+    input_file.write_bytes(b"01234567890")
+    os.utime(input_file, ns=(1_000_000_000, 1_000_000_000))
+    assert cache.key("load", PARAMS, [input_file]) != key
+
+
+def test_key_changes_with_input_file_mtime(tmp_path, input_file):
+    cache = stage_cache.StageCache(tmp_path / "cache")
+    key = cache.key("load", PARAMS, [input_file])
+    assert cache.key("load", PARAMS, [input_file]) == key
+
+    os.utime(input_file, ns=(2_000_000_000, 2_000_000_000))
+    assert cache.key("load", PARAMS, [input_file]) != key
+
+
+@pytest.mark.parametrize(
+    "changed_params",
+    [
+        dict(null_size=200),
+        dict(batch_size=500),
+        dict(n_resamples=11),
+        dict(pos_sameby=["Mitocheck_Phenotypic_Class", "Cell_UUID"]),
+    ],
+)
+def test_key_changes_with_params(tmp_path, input_file, changed_params):
+    cache = stage_cache.StageCache(tmp_path / "cache")
+    key = cache.key("map_results", PARAMS, [input_file])
+    assert cache.key("map_results", dict(PARAMS), [input_file]) == key
+    assert cache.key("map_results", {**PARAMS, **changed_params}, [input_file]) != key
+
+
+def test_key_ignores_param_order(tmp_path):
+    cache = stage_cache.StageCache(tmp_path / "cache")
+    reversed_params = dict(reversed(list(PARAMS.items())))
+    assert cache.key("map_results", reversed_params) == cache.key("map_results", PARAMS)
+
+
+def test_key_follows_upstream_stages(tmp_path, input_file):
+    cache = stage_cache.StageCache(tmp_path / "cache")
+    load = cache.run("load", lambda: 1, inputs=[input_file])
+    key = cache.key("aggregate", {"threshold": 0.05}, [load])
+
+    # changing an input file changes the keys of all the downstream stages
+    os.utime(input_file, ns=(2_000_000_000, 2_000_000_000))
+    changed_load = cache.run("load", lambda: 1, inputs=[input_file])
+    assert changed_load.key != load.key
+    assert cache.key("aggregate", {"threshold": 0.05}, [changed_load]) != key
+
+
+def test_key_rejects_unknown_inputs(tmp_path):
+    cache = stage_cache.StageCache(tmp_path / "cache")
+    with pytest.raises(TypeError, match="stage inputs"):
+        cache.key("load", inputs=[1])
+
+
+def test_run_reuses_cached_artefacts(tmp_path, input_file):
+    cache = stage_cache.StageCache(tmp_path / "cache")
+    calls = []
+
+    def stage_fn():
+        calls.append(len(calls))
+        return {"n_cells": len(calls)}
+
+    first = cache.run("load", stage_fn, PARAMS, [input_file])
+    second = stage_cache.StageCache(tmp_path / "cache").run(
+        "load", stage_fn, PARAMS, [input_file]
+    )
+    assert calls == [0]
+    assert second == first
+
+    # artefacts of previous parameters are kept
+    cache.run("load", stage_fn, {**PARAMS, "null_size": 200}, [input_file])
+    cache.run("load", stage_fn, PARAMS, [input_file])
+    assert calls == [0, 1]
+    assert not list((tmp_path / "cache").glob("*.tmp"))
+
+
+def test_stage_dir(tmp_path):
+    cache = stage_cache.StageCache(tmp_path / "cache")
+    result = cache.stage_dir("map_results", PARAMS)
+    assert result.value.is_dir()
+    assert result.value == cache.stage_dir("map_results", PARAMS).value
+    assert result.value != cache.stage_dir("map_results", {**PARAMS, "seed": 1}).value
@@ -0,0 +1,75 @@
+"""
+Tests of the feature space shuffling.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import utils
+
+
+def _feature_matrix() -> np.ndarray:
+    """Feature matrix where every column holds the same distinct values"""
+    return np.tile(np.arange(200, dtype=np.float64)[:, None], (1, 50))
+
+
+def test_shuffle_columns_keeps_column_values():
+    feature_mat = _feature_matrix()
+    feature_mat[::7, 3] = np.nan
+
+    shuffled = utils.shuffle_columns(feature_mat, seed=0)
+    assert shuffled.shape == feature_mat.shape
+    np.testing.assert_array_equal(
+        np.sort(shuffled, axis=0), np.sort(feature_mat, axis=0)
+    )
+
+
+def test_shuffle_columns_permutes_columns_independently():
+    feature_mat = _feature_matrix()
+
+    shuffled = utils.shuffle_columns(feature_mat, seed=0)
+    # all the columns hold the same values, so every column has its own permutation
+    # if no two shuffled columns are equal
+    assert np.unique(shuffled, axis=1).shape[1] == feature_mat.shape[1]
+    assert not np.any(np.all(shuffled == feature_mat, axis=0))
+
+
+def test_shuffle_columns_seed_and_inplace():
+    feature_mat = _feature_matrix()
+    original = feature_mat.copy()
+
+    shuffled = utils.shuffle_columns(feature_mat, seed=1)
+    np.testing.assert_array_equal(feature_mat, original)
+    np.testing.assert_array_equal(utils.shuffle_columns(original, seed=1), shuffled)
+    assert not np.array_equal(utils.shuffle_columns(original, seed=2), shuffled)
+
+    result = utils.shuffle_columns(feature_mat, seed=1, inplace=True)
+    assert result is feature_mat
+    np.testing.assert_array_equal(feature_mat, shuffled)
+
+
+def test_shuffle_columns_type_checking():
+    with pytest.raises(TypeError):
+        utils.shuffle_columns([[1.0, 2.0]])
+    with pytest.raises(TypeError):
+        utils.shuffle_columns(np.arange(10.0))
+
+
+def test_shuffle_feature_space():
+    feature_mat = _feature_matrix()
+    profile = pd.DataFrame(
+        feature_mat, columns=[f"CP__{idx}" for idx in range(feature_mat.shape[1])]
+    )
+    profile.insert(0, "Cell_UUID", [f"cell_{idx}" for idx in range(len(profile))])
+    profile.index = profile.index * 3
+
+    shuffled = utils.shuffle_feature_space(profile, col_idx_split=1, seed=4)
+    pd.testing.assert_index_equal(shuffled.index, profile.index)
+    pd.testing.assert_index_equal(shuffled.columns, profile.columns)
+    pd.testing.assert_series_equal(shuffled["Cell_UUID"], profile["Cell_UUID"])
+
+    # the features follow the permutations of shuffle_columns()
+    np.testing.assert_array_equal(
+        shuffled.iloc[:, 1:].to_numpy(), utils.shuffle_columns(feature_mat, seed=4)
+    )
+    assert not profile.iloc[:, 1:].equals(shuffled.iloc[:, 1:])
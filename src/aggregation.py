@@ -0,0 +1,85 @@
+"""
+Contains grouped aggregations of single-cell scores.
+
+Scores are aggregated in a single grouped operation instead of iterating over the
+groups in Python. Columns that are not aggregated (e.g. metadata) keep the value of
+the first row of each group, including missing values, so the aggregated table has
+the same columns as the single-cell table with one row per group.
+
+Group columns can be encoded with `metadata_codec`, rows are then grouped by codes
+and only the categories found in the rows form groups.
+"""
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+
+def first_rows(profile: pd.DataFrame, by: Sequence[str]) -> pd.DataFrame:
+    """Returns the first row of each group, in sorted group order. Unlike
+    `DataFrameGroupBy.first()`, missing values of the first row are kept.
+
+    Parameters
+    ----------
+    profile : pd.DataFrame
+        dataframe to group
+    by : Sequence[str]
+        columns used to group rows, rows with missing keys are dropped
+
+    Returns
+    -------
+    pd.DataFrame
+        first row of each group with a default index
+    """
+    group_ids = profile.groupby(list(by), sort=True, observed=True).ngroup().to_numpy()
+
+    # first position of every group, ordered by group number
+    valid_pos = np.flatnonzero(group_ids >= 0)
+    _, first_idx = np.unique(group_ids[valid_pos], return_index=True)
+
+    return profile.iloc[valid_pos[first_idx]].reset_index(drop=True)
+
+
+def aggregate_scores(
+    profile: pd.DataFrame,
+    by: Sequence[str],
+    scores: Optional[Dict[str, str]] = None,
+) -> pd.DataFrame:
+    """Aggregates scores within groups of rows. Other columns keep the value of the
+    first row of each group.
+
+    Parameters
+    ----------
+    profile : pd.DataFrame
+        single-cell scores
+    by : Sequence[str]
+        columns used to group rows (e.g. ["Cell_UUID", "feature_type", "shuffled"])
+    scores : Optional[Dict[str, str]]
+        aggregation function of each score column, by default
+        {"average_precision": "mean"}
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per group, in sorted group order, with the same columns as
+        `profile`
+
+    Raises
+    ------
+    ValueError
+        raised if a group or score column is missing
+    """
+    if scores is None:
+        scores = {"average_precision": "mean"}
+
+    # type checking
+    missing_cols = (set(by) | set(scores)) - set(profile.columns)
+    if len(missing_cols) > 0:
+        raise ValueError(f"columns missing from profile: {sorted(missing_cols)}")
+
+    aggregated = first_rows(profile, by)
+    grouped = profile.groupby(list(by), sort=True, observed=True)
+    for score_col, func in scores.items():
+        aggregated[score_col] = grouped[score_col].agg(func).to_numpy()
+
+    return aggregated
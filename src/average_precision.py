@@ -0,0 +1,939 @@
+"""
+Contains functions to compute single-cell average precision (AP) scores and their
+p-values from a precomputed cosine similarity matrix.
+
+Positive and negative pairs follow the same `sameby`/`diffby` rules as
+`copairs.map.run_pipeline()` and the returned dataframe has the same columns. As in
+copairs, positive pairs are ranked before negative pairs with the same similarity.
+Since the similarities are provided by the caller, they can be computed once and
+reused across phenotypes, seeds and shuffling methods.
+
+Rank lists (cells sorted by decreasing similarity for every query cell) only depend
+on the similarities and not on the labels. Therefore, runs that only permute labels,
+such as the shuffled phenotype labels baseline, can reuse the rank lists of the
+regular run and only recompute pair membership and average precision. When rank
+lists are not shared, `top_k_average_precision()` only sorts the cells ranked up to
+the least similar positive pair of each query.
+
+`run_permutations()` goes one step further for label permutation tests: the average
+precision of many permutations of a single label column is computed in one batched
+pass over shared rank lists, and all permutations share the same null
+distributions.
+
+Null distributions only depend on the number of positive pairs, the total number
+of pairs, the null size and the seed. Because controls are matched 1:1 with the
+training cells, the same configurations recur across phenotypes and seeds, so
+null distributions are stored in a `NullDistributionCache` that can be persisted
+to disk and shared by all jobs of a run. Alternatively, `adaptive_p_values()` draws
+null scores in increasing batches and stops for each query once its p-value is
+decisively above or below a significance threshold.
+"""
+import pathlib
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .feature_store import FeatureStore
+from .pair_index import (
+    PairIndex,
+    build_pair_index,
+    encode_columns,
+    pair_mask,
+    valid_cells,
+)
+
+# largest fraction of cells selected by `top_k_average_precision()` before falling
+# back to sorting all the cells
+TOP_K_FRACTION = 0.25
+
+
+def _rank_keys(similarity: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """Packs decreasing float32 similarities and cell positions into unique uint64
+    keys. Sorting the keys ranks cells by decreasing similarity and ties by
+    position, as a stable argsort would, but with the faster unstable sort of numpy.
+    """
+    # zero and NaN values are made canonical, NaN are ranked last as with argsort
+    neg_sim = -np.asarray(similarity, dtype=np.float32) + np.float32(0)
+    neg_sim[np.isnan(neg_sim)] = np.nan
+
+    # order preserving map from float32 to uint32
+    bits = neg_sim.view(np.uint32)
+    bits = bits ^ np.where(bits >> 31, np.uint32(0xFFFFFFFF), np.uint32(0x80000000))
+
+    return (bits.astype(np.uint64) << np.uint64(32)) | positions.astype(np.uint64)
+
+
+def _sort_ranks(similarity: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """Sorts cell positions by decreasing similarity, ties are ranked by position.
+    Similarities that are not exactly represented in float32 (e.g. float64) are
+    sorted with a stable lexicographic sort instead of packed keys, so close
+    similarities are never ranked as ties.
+    """
+    if similarity.dtype in (np.float16, np.float32):
+        keys = np.sort(_rank_keys(similarity, positions), axis=1)
+        return (keys & np.uint64(0xFFFFFFFF)).astype(np.int32)
+
+    positions = np.broadcast_to(positions, similarity.shape)
+    order = np.lexsort((positions, -similarity), axis=1)
+    return np.take_along_axis(positions, order, axis=1).astype(np.int32)
+
+
+def rank_lists(similarity: np.ndarray, batch_size: int = 1000) -> np.ndarray:
+    """Sorts all cells by decreasing similarity for every query cell. Cells with
+    the same similarity are ranked by their position.
+
+    float32 similarities (as returned by `similarity`) are ranked by sorting packed
+    (similarity, position) keys. Other types are ranked at their full precision
+    with a slower stable sort.
+
+    Parameters
+    ----------
+    similarity : np.ndarray
+        similarities between the query cells and all cells,
+        shape (n_query_cells, n_cells)
+    batch_size : int, optional
+        number of query cells sorted per batch, by default 1000
+
+    Returns
+    -------
+    np.ndarray
+        int32 positions of the ranked cells, shape (n_query_cells, n_cells)
+    """
+    rank_ix = np.empty(similarity.shape, dtype=np.int32)
+    positions = np.arange(similarity.shape[1])[None, :]
+    for start in range(0, similarity.shape[0], batch_size):
+        rows = slice(start, start + batch_size)
+        rank_ix[rows] = _sort_ranks(similarity[rows], positions)
+    return rank_ix
+
+
+def _tie_starts(ranked_sim: np.ndarray) -> np.ndarray:
+    """Marks the first cell of every group of cells ranked with the same similarity
+    along the last axis"""
+    tie_starts = np.ones(ranked_sim.shape, dtype=bool)
+    tie_starts[..., 1:] = ranked_sim[..., 1:] != ranked_sim[..., :-1]
+    return tie_starts
+
+
+def average_precision(
+    rank_ix: np.ndarray,
+    pos_mask: np.ndarray,
+    neg_mask: np.ndarray,
+    similarity: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Computes the average precision of a batch of query cells from their rank
+    lists. Cells that are neither positive nor negative pairs of the query are
+    skipped when counting ranks.
+
+    Parameters
+    ----------
+    rank_ix : np.ndarray
+        rank lists of the query cells generated with `rank_lists()`,
+        shape (n_query_cells, n_cells)
+    pos_mask : np.ndarray
+        boolean mask of positive pairs, shape (n_query_cells, n_cells)
+    neg_mask : np.ndarray
+        boolean mask of negative pairs, shape (n_query_cells, n_cells)
+    similarity : Optional[np.ndarray]
+        similarities used to build the rank lists, shape (n_query_cells, n_cells).
+        If provided, positive pairs are ranked before the negative pairs with the
+        same similarity, as in copairs. Otherwise, tied cells keep the order of the
+        rank lists. By default None.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        average precision, number of positive pairs and total number of pairs of
+        each query cell. The average precision is NaN if a query has no positive
+        pairs.
+    """
+    candidates = pos_mask | neg_mask
+
+    # relevance of each ranked cell, ranks only count cells paired with the query
+    rel_k = np.take_along_axis(pos_mask, rank_ix, axis=1)
+    candidates_k = np.take_along_axis(candidates, rank_ix, axis=1)
+
+    tie_starts = None
+    if similarity is not None:
+        tie_starts = _tie_starts(np.take_along_axis(similarity, rank_ix, axis=1))
+
+    return _ranked_average_precision(rel_k, candidates_k, tie_starts)
+
+
+def _ranked_average_precision(
+    rel_k: np.ndarray,
+    candidates_k: np.ndarray,
+    tie_starts: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Computes the average precision from masks that are already sorted by rank
+    along their last axis. Leading axes (queries, permutations) are preserved.
+    If `tie_starts` (see `_tie_starts()`) is provided, positive pairs are ranked
+    before the negative pairs of the same group of tied cells.
+    """
+    n_pos = rel_k.sum(axis=-1)
+    n_total = candidates_k.sum(axis=-1)
+    k = np.cumsum(candidates_k, axis=-1)
+    tp = np.cumsum(rel_k, axis=-1)
+
+    if tie_starts is not None:
+        # the rank of a positive pair only counts the positive pairs ranked up to it
+        # and the negative pairs of the previous groups of tied cells
+        n_neg_before = np.where(tie_starts, k - tp - (candidates_k & ~rel_k), 0)
+        k = tp + np.maximum.accumulate(n_neg_before, axis=-1)
+
+    # precision at every rank, only added up at the ranks of positive cells
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ap_scores = np.where(rel_k, tp / k, 0).sum(axis=-1) / n_pos
+
+    return ap_scores, n_pos, n_total
+
+
+def top_k_average_precision(
+    similarity: np.ndarray, pos_mask: np.ndarray, neg_mask: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Computes the average precision of a batch of query cells by only sorting the
+    most similar cells of each query.
+
+    Cells that are less similar than the least similar positive pair of a query are
+    ranked after all of its positive pairs and do not change its average precision.
+    For queries whose positive pairs are within the top `TOP_K_FRACTION` of the
+    cells, only the top k cells are selected with `np.argpartition()` and sorted,
+    with k the largest number of cells at least as similar as the least similar
+    positive pair among these queries. The other queries sort all the cells.
+    Returns the same scores as `average_precision()` with the rank lists of
+    `rank_lists()` and the similarities, positive pairs are ranked before the
+    negative pairs with the same similarity.
+
+    Parameters
+    ----------
+    similarity : np.ndarray
+        similarities between the query cells and all cells,
+        shape (n_query_cells, n_cells)
+    pos_mask : np.ndarray
+        boolean mask of positive pairs, shape (n_query_cells, n_cells)
+    neg_mask : np.ndarray
+        boolean mask of negative pairs, shape (n_query_cells, n_cells)
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        average precision, number of positive pairs and total number of pairs of
+        each query cell. The average precision is NaN if a query has no positive
+        pairs.
+    """
+    n_cells = similarity.shape[1]
+    candidates = pos_mask | neg_mask
+
+    # number of cells ranked up to the least similar positive pair of each query,
+    # positive pairs with undefined (NaN) similarities are ranked last
+    min_pos_sim = np.where(pos_mask, similarity, np.inf).min(axis=1)
+    with np.errstate(invalid="ignore"):
+        n_top = (similarity >= min_pos_sim[:, None]).sum(axis=1)
+    n_top[np.isnan(min_pos_sim)] = n_cells
+
+    # partitioning is only worth it if a small part of the cells is selected, the
+    # other queries sort all the cells
+    ap_scores = np.empty(similarity.shape[0], dtype=np.float64)
+    is_top_k = n_top <= n_cells * TOP_K_FRACTION
+    for rows in (np.flatnonzero(is_top_k), np.flatnonzero(~is_top_k)):
+        if len(rows) == 0:
+            continue
+
+        # selecting and sorting the top k cells, ties are ranked by position
+        rows_sim = similarity[rows]
+        k = max(int(n_top[rows].max()), 1)
+        if k <= n_cells * TOP_K_FRACTION:
+            top_ix = np.argpartition(-rows_sim, k - 1, axis=1)[:, :k]
+            rank_ix = _sort_ranks(np.take_along_axis(rows_sim, top_ix, axis=1), top_ix)
+        else:
+            rank_ix = _sort_ranks(rows_sim, np.arange(n_cells)[None, :])
+
+        rel_k = np.take_along_axis(pos_mask[rows], rank_ix, axis=1)
+        candidates_k = np.take_along_axis(candidates[rows], rank_ix, axis=1)
+        tie_starts = _tie_starts(np.take_along_axis(rows_sim, rank_ix, axis=1))
+        ap_scores[rows], _, _ = _ranked_average_precision(
+            rel_k, candidates_k, tie_starts
+        )
+
+    # pairs ranked after the top k cells are still counted
+    return ap_scores, pos_mask.sum(axis=1), candidates.sum(axis=1)
+
+
+def random_average_precision(
+    n_pos: int,
+    n_total: int,
+    null_size: int,
+    seed: int = 0,
+    batch_idx: Optional[int] = None,
+) -> np.ndarray:
+    """Computes the average precision of randomly ranked lists, used as the null
+    distribution of a query with `n_pos` positive pairs out of `n_total` pairs.
+
+    Only the ranks of the positive pairs are used: the precision at the rank of the
+    i-th positive pair is i / rank, so all random lists are scored with a single
+    (null_size, n_pos) array operation.
+
+    Parameters
+    ----------
+    n_pos : int
+        number of positive pairs
+    n_total : int
+        total number of pairs
+    null_size : int
+        number of random rank lists
+    seed : int, optional
+        random seed, by default 0
+    batch_idx : Optional[int]
+        index of the batch when the null distribution is drawn in successive
+        batches, each batch uses an independent random stream. By default None.
+
+    Returns
+    -------
+    np.ndarray
+        average precision scores of the random rank lists
+    """
+    entropy = [seed, n_pos, n_total]
+    if batch_idx is not None:
+        entropy.append(batch_idx)
+    rng = np.random.default_rng(entropy)
+    rel_k = np.zeros((null_size, n_total), dtype=bool)
+    rel_k[:, :n_pos] = True
+    rng.permuted(rel_k, axis=1, out=rel_k)
+
+    # 1-based ranks of the positive pairs of every random list, in increasing order
+    pos_ranks = np.nonzero(rel_k)[1].reshape(null_size, n_pos) + 1
+    return (np.arange(1, n_pos + 1) / pos_ranks).sum(axis=1) / n_pos
+
+
+class NullDistributionCache:
+    """Sorted null distributions keyed by (n_pos, n_total, null_size, seed).
+
+    Distributions are kept in memory and, if `cache_dir` is provided, saved as
+    memory-mapped files through a `FeatureStore`, so they are reused by other
+    worker processes and by later runs. Processes can generate and save the same
+    distribution concurrently.
+
+    Parameters
+    ----------
+    cache_dir : Optional[Union[str, pathlib.Path]]
+        directory where the null distributions are saved. If None, distributions
+        are only kept in memory.
+    """
+
+    def __init__(self, cache_dir: Optional[Union[str, pathlib.Path]] = None):
+        self.store = None
+        if cache_dir is not None:
+            pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            self.store = FeatureStore(cache_dir)
+        self._null_dists: Dict[Tuple[int, int, int, int], np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self._null_dists)
+
+    def get(
+        self, n_pos: int, n_total: int, null_size: int, seed: int = 0
+    ) -> np.ndarray:
+        """Returns the sorted null distribution of a configuration, generated with
+        `random_average_precision()` if it is not cached
+
+        Parameters
+        ----------
+        n_pos : int
+            number of positive pairs
+        n_total : int
+            total number of pairs
+        null_size : int
+            number of random rank lists
+        seed : int, optional
+            random seed, by default 0
+
+        Returns
+        -------
+        np.ndarray
+            sorted average precision scores of the random rank lists
+        """
+        key = (int(n_pos), int(n_total), int(null_size), int(seed))
+        if key in self._null_dists:
+            return self._null_dists[key]
+
+        name = "null_{}_{}_{}_{}".format(*key)
+        if self.store is not None and name in self.store:
+            null_dist = self.store.load(name)
+        else:
+            null_dist = np.sort(random_average_precision(*key))
+
+            # workers may generate the same distribution at the same time, a
+            # distribution stored by another process in the meantime is identical
+            if self.store is not None and name in self.store:
+                null_dist = self.store.load(name)
+            elif self.store is not None:
+                null_dist = self.store.save(name, null_dist)
+
+        self._null_dists[key] = null_dist
+        return null_dist
+
+
+def p_values(
+    ap_scores: np.ndarray,
+    n_pos: np.ndarray,
+    n_total: np.ndarray,
+    null_size: int,
+    seed: int = 0,
+    null_cache: Optional[NullDistributionCache] = None,
+) -> np.ndarray:
+    """Computes the p-value of each average precision score. Queries with the same
+    number of positive and total pairs share the same null distribution.
+
+    Parameters
+    ----------
+    ap_scores : np.ndarray
+        average precision scores
+    n_pos : np.ndarray
+        number of positive pairs of each query
+    n_total : np.ndarray
+        total number of pairs of each query
+    null_size : int
+        number of random rank lists in each null distribution
+    seed : int, optional
+        random seed, by default 0
+    null_cache : Optional[NullDistributionCache]
+        cache of null distributions shared between calls. If None, the null
+        distributions are only shared within this call.
+
+    Returns
+    -------
+    np.ndarray
+        p-values, NaN for queries without positive pairs
+    """
+    if null_cache is None:
+        null_cache = NullDistributionCache()
+
+    pvals = np.full(len(ap_scores), np.nan, dtype=np.float32)
+    has_pos = n_pos > 0
+
+    confs, conf_ix = np.unique(
+        np.stack([n_pos[has_pos], n_total[has_pos]], axis=1),
+        axis=0,
+        return_inverse=True,
+    )
+    conf_ix = conf_ix.ravel()
+    query_ix = np.flatnonzero(has_pos)
+    for idx, (conf_n_pos, conf_n_total) in enumerate(confs):
+        null_dist = null_cache.get(conf_n_pos, conf_n_total, null_size, seed=seed)
+
+        # number of null scores that are at least as high as the observed score
+        selected_ix = query_ix[conf_ix == idx]
+        n_higher = null_size - np.searchsorted(null_dist, ap_scores[selected_ix])
+        pvals[selected_ix] = (n_higher + 1) / (null_size + 1)
+
+    return pvals
+
+
+def adaptive_p_values(
+    ap_scores: np.ndarray,
+    n_pos: np.ndarray,
+    n_total: np.ndarray,
+    null_size: int,
+    threshold: float = 0.05,
+    seed: int = 0,
+    min_batch_size: int = 100,
+    z_score: float = 3.0,
+    null_cache: Optional[NullDistributionCache] = None,
+) -> np.ndarray:
+    """Computes p-values with sequential Monte Carlo sampling. Null scores are drawn
+    in batches of increasing size and a query stops drawing once its p-value is
+    decisively above or below `threshold`, i.e. once the Wilson score interval of
+    its estimated p-value does not contain `threshold`. Queries that are still
+    undecided when the next batch would reach `null_size` draws are scored against
+    the full null distribution of `null_cache` instead, so they get the same
+    p-value as `p_values()`.
+
+    Parameters
+    ----------
+    ap_scores : np.ndarray
+        average precision scores
+    n_pos : np.ndarray
+        number of positive pairs of each query
+    n_total : np.ndarray
+        total number of pairs of each query
+    null_size : int
+        largest number of random rank lists drawn per null distribution
+    threshold : float, optional
+        significance threshold used to decide when to stop, by default 0.05
+    seed : int, optional
+        random seed, by default 0
+    min_batch_size : int, optional
+        size of the first batch, following batches double in size, by default 100
+    z_score : float, optional
+        width of the Wilson score interval, by default 3.0
+    null_cache : Optional[NullDistributionCache]
+        cache of the full null distributions, shared with `p_values()`. If None,
+        the null distributions are only shared within this call.
+
+    Returns
+    -------
+    np.ndarray
+        p-values, NaN for queries without positive pairs
+    """
+    pvals = np.full(len(ap_scores), np.nan, dtype=np.float32)
+    has_pos = n_pos > 0
+    undecided = np.zeros(len(ap_scores), dtype=bool)
+
+    confs, conf_ix = np.unique(
+        np.stack([n_pos[has_pos], n_total[has_pos]], axis=1),
+        axis=0,
+        return_inverse=True,
+    )
+    conf_ix = conf_ix.ravel()
+    query_ix = np.flatnonzero(has_pos)
+    for idx, (conf_n_pos, conf_n_total) in enumerate(confs):
+        undecided_ix = query_ix[conf_ix == idx]
+        n_higher = np.zeros(len(undecided_ix), dtype=np.int64)
+        n_drawn = 0
+        batch_idx = 0
+        while len(undecided_ix) > 0:
+            batch_size = min_batch_size * 2**batch_idx
+            if n_drawn + batch_size >= null_size:
+                break
+            null_dist = np.sort(
+                random_average_precision(
+                    conf_n_pos, conf_n_total, batch_size, seed=seed, batch_idx=batch_idx
+                )
+            )
+            n_higher += batch_size - np.searchsorted(null_dist, ap_scores[undecided_ix])
+            n_drawn += batch_size
+            batch_idx += 1
+
+            # wilson score interval of the estimated p-values
+            p_hat = n_higher / n_drawn
+            denom = 1 + z_score**2 / n_drawn
+            center = (p_hat + z_score**2 / (2 * n_drawn)) / denom
+            half_width = (
+                z_score
+                * np.sqrt(
+                    p_hat * (1 - p_hat) / n_drawn + z_score**2 / (4 * n_drawn**2)
+                )
+                / denom
+            )
+            decided = (center + half_width < threshold) | (
+                center - half_width > threshold
+            )
+
+            pvals[undecided_ix[decided]] = (n_higher[decided] + 1) / (n_drawn + 1)
+            undecided_ix = undecided_ix[~decided]
+            n_higher = n_higher[~decided]
+        undecided[undecided_ix] = True
+
+    # the draws of the undecided queries are replaced by the full null distributions
+    pvals[undecided] = p_values(
+        ap_scores[undecided],
+        n_pos[undecided],
+        n_total[undecided],
+        null_size,
+        seed=seed,
+        null_cache=null_cache,
+    )
+
+    return pvals
+
+
+def _compute_p_values(
+    ap_scores: np.ndarray,
+    n_pos: np.ndarray,
+    n_total: np.ndarray,
+    null_size: int,
+    seed: int,
+    null_cache: Optional[NullDistributionCache],
+    p_value_threshold: Optional[float],
+) -> np.ndarray:
+    """Computes p-values with `p_values()`, or with `adaptive_p_values()` if a
+    threshold is provided"""
+    if p_value_threshold is None:
+        return p_values(
+            ap_scores, n_pos, n_total, null_size, seed=seed, null_cache=null_cache
+        )
+    return adaptive_p_values(
+        ap_scores,
+        n_pos,
+        n_total,
+        null_size,
+        threshold=p_value_threshold,
+        seed=seed,
+        null_cache=null_cache,
+    )
+
+
+def run_pipeline(
+    meta: pd.DataFrame,
+    similarity: Optional[np.ndarray],
+    pos_sameby: List[str],
+    pos_diffby: List[str],
+    neg_sameby: List[str],
+    neg_diffby: List[str],
+    null_size: int,
+    batch_size: int = 1000,
+    seed: int = 0,
+    rank_ix: Optional[np.ndarray] = None,
+    null_cache: Optional[NullDistributionCache] = None,
+    p_value_threshold: Optional[float] = None,
+    pair_index: Optional[PairIndex] = None,
+) -> pd.DataFrame:
+    """Computes single-cell average precision scores and p-values from a
+    precomputed similarity matrix or from precomputed rank lists.
+
+    Parameters
+    ----------
+    meta : pd.DataFrame
+        metadata dataframe, rows follow the same order as the similarity matrix
+    similarity : Optional[np.ndarray]
+        cosine similarity between all cells, shape (n_cells, n_cells). Can be None
+        if `rank_ix` is provided, tied cells then keep the order of the rank lists
+        instead of ranking positive pairs first.
+    pos_sameby : List[str]
+        columns that positive pairs share
+    pos_diffby : List[str]
+        columns in which positive pairs differ
+    neg_sameby : List[str]
+        columns that negative pairs share
+    neg_diffby : List[str]
+        columns in which negative pairs differ
+    null_size : int
+        number of random rank lists used to compute p-values
+    batch_size : int, optional
+        number of query cells processed per batch, by default 1000
+    seed : int, optional
+        random seed used for the null distributions, by default 0
+    rank_ix : Optional[np.ndarray]
+        rank lists generated with `rank_lists()`, shape (n_cells, n_cells). If
+        provided, the similarities are not sorted again. Used to share rank lists
+        between runs with the same cells but different labels.
+    null_cache : Optional[NullDistributionCache]
+        cache of null distributions shared between calls, by default None
+    p_value_threshold : Optional[float]
+        if provided, p-values are computed with `adaptive_p_values()` and null
+        sampling stops once a p-value is decisively above or below this threshold.
+        `null_cache` is only used for the p-values that are still undecided before
+        `null_size` null scores are drawn. By default None.
+    pair_index : Optional[PairIndex]
+        pairs of the cells built with `pair_index.build_pair_index()` from the same
+        metadata and pairing columns. Used to share the pairs between runs with the
+        same cells and labels. By default, the pairs are indexed from `meta`.
+
+    Returns
+    -------
+    pd.DataFrame
+        metadata with the "n_pos_pairs", "n_total_pairs", "average_precision" and
+        "p_value" columns. As in copairs, cells with missing values in the pair
+        columns are not paired and have no score.
+
+    Raises
+    ------
+    TypeError
+        raised if incorrect types are provided
+    ValueError
+        raised if the similarity matrix, the rank lists or the pair index do not
+        match the metadata or if no positive pairs are found
+    """
+    # type checking
+    if not isinstance(meta, pd.DataFrame):
+        raise TypeError("'meta' must be a pandas dataframe")
+    if not isinstance(similarity if rank_ix is None else rank_ix, np.ndarray):
+        raise TypeError("'similarity' or 'rank_ix' must be a numpy array")
+    for ranked in (similarity, rank_ix):
+        if ranked is not None and np.shape(ranked) != (meta.shape[0], meta.shape[0]):
+            raise ValueError(
+                "'similarity' must be a square matrix matching 'meta' rows"
+            )
+
+    # indexing the pairs of the cells
+    if pair_index is None:
+        pair_index = build_pair_index(
+            meta, pos_sameby, pos_diffby, neg_sameby, neg_diffby
+        )
+    elif pair_index.n_cells != meta.shape[0]:
+        raise ValueError("'pair_index' must index the pairs of the 'meta' rows")
+
+    # computing average precision in batches of query cells
+    n_cells = meta.shape[0]
+    ap_scores = np.empty(n_cells, dtype=np.float64)
+    n_pos = np.empty(n_cells, dtype=np.int64)
+    n_total = np.empty(n_cells, dtype=np.int64)
+    for start in range(0, n_cells, batch_size):
+        rows = slice(start, start + batch_size)
+        pos_mask, neg_mask = pair_index.masks(rows)
+        if rank_ix is None:
+            batch_results = top_k_average_precision(
+                similarity[rows], pos_mask, neg_mask
+            )
+        else:
+            batch_results = average_precision(
+                rank_ix[rows],
+                pos_mask,
+                neg_mask,
+                similarity=None if similarity is None else similarity[rows],
+            )
+        ap_scores[rows], n_pos[rows], n_total[rows] = batch_results
+
+    if n_pos.sum() == 0:
+        raise ValueError("Unable to find positive pairs.")
+
+    # creating result dataframe
+    result = meta.reset_index(drop=True).copy()
+    result["n_pos_pairs"] = n_pos
+    result["n_total_pairs"] = n_total
+    result["average_precision"] = ap_scores
+    result["p_value"] = _compute_p_values(
+        ap_scores, n_pos, n_total, null_size, seed, null_cache, p_value_threshold
+    )
+
+    return result
+
+
+def permute_labels(
+    labels: np.ndarray, n_permutations: int, seed: Optional[int] = 0
+) -> np.ndarray:
+    """Generates random permutations of a label vector. The first permutation is the
+    same as the one generated by `np.random.seed(seed)` followed by
+    `np.random.permutation(labels)`.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        labels of each cell
+    n_permutations : int
+        number of permutations
+    seed : Optional[int]
+        random seed, by default 0
+
+    Returns
+    -------
+    np.ndarray
+        permuted labels with shape (n_permutations, n_cells)
+    """
+    labels = np.asarray(labels)
+    random_state = np.random.RandomState(seed)
+    return np.stack([random_state.permutation(labels) for _ in range(n_permutations)])
+
+
+def _label_relation(
+    label_col: str, sameby: List[str], diffby: List[str]
+) -> Optional[bool]:
+    """Returns True if pairs must share the permuted label, False if they must
+    differ and None if the label is not used to find pairs"""
+    if label_col in sameby:
+        return True
+    if label_col in diffby:
+        return False
+    return None
+
+
+def run_permutations(
+    meta: pd.DataFrame,
+    similarity: Optional[np.ndarray],
+    label_col: str,
+    permuted_labels: np.ndarray,
+    pos_sameby: List[str],
+    pos_diffby: List[str],
+    neg_sameby: List[str],
+    neg_diffby: List[str],
+    null_size: int,
+    batch_size: int = 1000,
+    seed: int = 0,
+    rank_ix: Optional[np.ndarray] = None,
+    null_cache: Optional[NullDistributionCache] = None,
+    p_value_threshold: Optional[float] = None,
+) -> pd.DataFrame:
+    """Computes single-cell average precision scores and p-values for many
+    permutations of one label column at once.
+
+    The rank lists are shared by all the permutations since the cells do not
+    change. Pairs that do not depend on `label_col` are found once, then the pairs
+    of every permutation are derived by comparing the permuted labels in rank
+    order, so all the permutations of a batch of query cells are scored in a
+    single vectorised pass.
+
+    Parameters
+    ----------
+    meta : pd.DataFrame
+        metadata dataframe, rows follow the same order as the similarity matrix
+    similarity : Optional[np.ndarray]
+        cosine similarity between all cells, shape (n_cells, n_cells). Can be None
+        if `rank_ix` is provided, tied cells then keep the order of the rank lists
+        instead of ranking positive pairs first.
+    label_col : str
+        metadata column that is permuted
+    permuted_labels : np.ndarray
+        permuted values of `label_col`, shape (n_permutations, n_cells). Can be
+        generated with `permute_labels()`. If `label_col` is categorical, integer
+        labels are the permuted codes of the column and are decoded with its
+        categories.
+    pos_sameby : List[str]
+        columns that positive pairs share
+    pos_diffby : List[str]
+        columns in which positive pairs differ
+    neg_sameby : List[str]
+        columns that negative pairs share
+    neg_diffby : List[str]
+        columns in which negative pairs differ
+    null_size : int
+        number of random rank lists used to compute p-values
+    batch_size : int, optional
+        number of (permutation, query cell) rows processed per batch,
+        by default 1000
+    seed : int, optional
+        random seed used for the null distributions, by default 0
+    rank_ix : Optional[np.ndarray]
+        rank lists generated with `rank_lists()`, shape (n_cells, n_cells)
+    null_cache : Optional[NullDistributionCache]
+        cache of null distributions shared between calls, by default None
+    p_value_threshold : Optional[float]
+        if provided, p-values are computed with `adaptive_p_values()` and null
+        sampling stops once a p-value is decisively above or below this threshold.
+        `null_cache` is only used for the p-values that are still undecided before
+        `null_size` null scores are drawn. By default None.
+
+    Returns
+    -------
+    pd.DataFrame
+        same columns as `run_pipeline()`, with `label_col` replaced by the permuted
+        labels. The results of all permutations are concatenated in order.
+
+    Raises
+    ------
+    TypeError
+        raised if incorrect types are provided
+    ValueError
+        raised if the inputs do not match the metadata or if no positive pairs are
+        found
+    """
+    # type checking
+    if not isinstance(meta, pd.DataFrame):
+        raise TypeError("'meta' must be a pandas dataframe")
+    if not isinstance(permuted_labels, np.ndarray) or permuted_labels.ndim != 2:
+        raise TypeError("'permuted_labels' must be a 2D numpy array")
+    if label_col not in meta.columns:
+        raise ValueError(f"'{label_col}' is not a column of 'meta'")
+    n_permutations, n_cells = permuted_labels.shape[0], meta.shape[0]
+    if permuted_labels.shape[1] != n_cells:
+        raise ValueError("'permuted_labels' must have one label per 'meta' row")
+
+    if similarity is not None and np.shape(similarity) != (n_cells, n_cells):
+        raise ValueError("'similarity' must be a square matrix matching 'meta' rows")
+    if rank_ix is None:
+        if not isinstance(similarity, np.ndarray):
+            raise TypeError("'similarity' or 'rank_ix' must be a numpy array")
+        rank_ix = rank_lists(similarity, batch_size=batch_size)
+    if rank_ix.shape != (n_cells, n_cells):
+        raise ValueError("'rank_ix' must be a square matrix matching 'meta' rows")
+
+    # pairs rules without the permuted label, found once for all permutations
+    fixed_codes = {
+        name: encode_columns(meta, [col for col in columns if col != label_col])
+        for name, columns in (
+            ("pos_sameby", pos_sameby),
+            ("pos_diffby", pos_diffby),
+            ("neg_sameby", neg_sameby),
+            ("neg_diffby", neg_diffby),
+        )
+    }
+    pos_relation = _label_relation(label_col, pos_sameby, pos_diffby)
+    neg_relation = _label_relation(label_col, neg_sameby, neg_diffby)
+
+    # cells with missing values in the pair columns are never paired
+    fixed_valid = valid_cells(*fixed_codes.values())
+    label_used = pos_relation is not None or neg_relation is not None
+
+    # permuted labels are encoded with the same codes for all permutations
+    label_dtype = meta[label_col].dtype
+    if isinstance(label_dtype, pd.CategoricalDtype):
+        if np.issubdtype(permuted_labels.dtype, np.integer):
+            permuted_labels = pd.Categorical.from_codes(
+                permuted_labels.ravel(), dtype=label_dtype
+            )
+        else:
+            permuted_labels = pd.Categorical(permuted_labels.ravel(), dtype=label_dtype)
+        label_codes = permuted_labels.codes.reshape(n_permutations, n_cells)
+    else:
+        label_codes, _ = pd.factorize(permuted_labels.ravel())
+        label_codes = label_codes.reshape(n_permutations, n_cells)
+        permuted_labels = permuted_labels.ravel()
+
+    # computing average precision for all permutations in batches of query cells
+    ap_scores = np.empty((n_permutations, n_cells), dtype=np.float64)
+    n_pos = np.empty((n_permutations, n_cells), dtype=np.int64)
+    n_total = np.empty((n_permutations, n_cells), dtype=np.int64)
+    query_batch_size = max(1, batch_size // n_permutations)
+    for start in range(0, n_cells, query_batch_size):
+        rows = slice(start, start + query_batch_size)
+        batch_rank_ix = rank_ix[rows]
+        fixed_pos = np.take_along_axis(
+            pair_mask(fixed_codes["pos_sameby"], fixed_codes["pos_diffby"], rows),
+            batch_rank_ix,
+            axis=1,
+        )
+        fixed_neg = np.take_along_axis(
+            pair_mask(fixed_codes["neg_sameby"], fixed_codes["neg_diffby"], rows),
+            batch_rank_ix,
+            axis=1,
+        )
+
+        # permuted labels of the ranked cells compared to the query label,
+        # shape (n_permutations, n_query_cells, n_cells)
+        query_labels = label_codes[:, rows, None]
+        same_label = label_codes[:, batch_rank_ix] == query_labels
+
+        valid_k = fixed_valid[rows, None] & fixed_valid[batch_rank_ix]
+        if label_used:
+            valid_k = (
+                valid_k
+                & (label_codes[:, rows, None] >= 0)
+                & (label_codes[:, batch_rank_ix] >= 0)
+            )
+
+        rel_k = fixed_pos[None, :, :] & valid_k
+        if pos_relation is not None:
+            rel_k = rel_k & (same_label if pos_relation else ~same_label)
+        neg_k = fixed_neg[None, :, :] & valid_k
+        if neg_relation is not None:
+            neg_k = neg_k & (same_label if neg_relation else ~same_label)
+        rel_k = np.broadcast_to(rel_k, same_label.shape)
+
+        # groups of tied cells are shared by all the permutations
+        tie_starts = None
+        if similarity is not None:
+            tie_starts = _tie_starts(
+                np.take_along_axis(similarity[rows], batch_rank_ix, axis=1)
+            )
+
+        (
+            ap_scores[:, rows],
+            n_pos[:, rows],
+            n_total[:, rows],
+        ) = _ranked_average_precision(rel_k, rel_k | neg_k, tie_starts)
+
+    if n_pos.sum() == 0:
+        raise ValueError("Unable to find positive pairs.")
+
+    # all the permutations share the same null distributions
+    pvals = _compute_p_values(
+        ap_scores.ravel(),
+        n_pos.ravel(),
+        n_total.ravel(),
+        null_size,
+        seed,
+        null_cache,
+        p_value_threshold,
+    )
+
+    # creating result dataframe
+    result = pd.concat(
+        [meta.reset_index(drop=True)] * n_permutations, ignore_index=True
+    )
+    result[label_col] = permuted_labels
+    result["n_pos_pairs"] = n_pos.ravel()
+    result["n_total_pairs"] = n_total.ravel()
+    result["average_precision"] = ap_scores.ravel()
+    result["p_value"] = pvals
+
+    return result
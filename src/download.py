@@ -0,0 +1,527 @@
+"""
+Contains a downloader for the raw MitoCheck datasets.
+
+Files are downloaded concurrently, each one into a `.part` file that is renamed once
+the download is complete and verified. Interrupted downloads are resumed with HTTP
+range requests from the end of the `.part` file, so a failure never restarts a large
+download from the beginning.
+
+Downloaded files are verified against their expected size and checksum and the
+verified checksum is recorded next to the file. Files without an expected checksum
+are refused, unless unverified downloads are explicitly allowed, in which case their
+SHA-256 checksum is logged so it can be pinned. Files that are
+already valid are skipped, and the recorded checksum is only computed again when the
+size or modification time of the file changes.
+
+A mirror can be provided to provision the files without accessing the original
+servers (e.g. offline or on compute nodes): either a local directory or a base URL
+(e.g. a local HTTP server) containing the files under the same names.
+
+(Gzip compressed) CSV files can also be transcoded into parquet files while they are
+downloaded: the response is decompressed and parsed as it arrives and written as
+parquet row groups, so the CSV file is never written to disk nor parsed again by the
+analysis. Since the parser state cannot be resumed, a failed transcoding is restarted
+from the beginning. The size and checksum of the downloaded bytes are still verified.
+"""
+import gzip
+import hashlib
+import io
+import json
+import logging
+import pathlib
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from typing import BinaryIO, Iterator, List, Optional, Sequence, Tuple, Union
+from urllib.parse import urlparse
+
+import requests
+
+from . import loader
+
+# number of bytes written per chunk
+DOWNLOAD_CHUNK_SIZE = 1024**2
+
+# number of attempts before a download fails
+MAX_RETRIES = 5
+
+
+@dataclass(frozen=True)
+class RemoteFile:
+    """File to download
+
+    Parameters
+    ----------
+    url : str
+        URL of the file
+    out_path : pathlib.Path
+        path where the file is saved
+    size : Optional[int]
+        expected size in bytes, by default the size announced by the server
+    checksum : Optional[str]
+        expected checksum formatted as "{algorithm}:{hex digest}" (e.g.
+        "sha256:..." or the "md5:..." checksums listed by Zenodo). Required unless
+        unverified downloads are allowed.
+    transcode : bool
+        if True, the (gzip compressed) CSV file is transcoded into the parquet file
+        `out_path` while it is downloaded. `size` and `checksum` describe the
+        downloaded CSV file. By default False.
+    """
+
+    url: str
+    out_path: pathlib.Path
+    size: Optional[int] = None
+    checksum: Optional[str] = None
+    transcode: bool = False
+
+
+def file_checksum(file_path: Union[str, pathlib.Path], algorithm: str = "md5") -> str:
+    """Computes the checksum of a file
+
+    Parameters
+    ----------
+    file_path : Union[str, pathlib.Path]
+        path to the file
+    algorithm : str, optional
+        hashlib algorithm, by default "md5"
+
+    Returns
+    -------
+    str
+        checksum formatted as "{algorithm}:{hex digest}"
+    """
+    digest = hashlib.new(algorithm)
+    with open(file_path, "rb") as in_file:
+        for chunk in iter(lambda: in_file.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return f"{algorithm}:{digest.hexdigest()}"
+
+
+def _record_path(out_path: pathlib.Path) -> pathlib.Path:
+    return out_path.with_name(f"{out_path.name}.checksum.json")
+
+
+def _part_path(out_path: pathlib.Path) -> pathlib.Path:
+    return out_path.with_name(f"{out_path.name}.part")
+
+
+def _source_name(remote_file: RemoteFile) -> str:
+    """Name of the file in a mirror. Transcoded files are named after their URL."""
+    if remote_file.transcode:
+        return pathlib.PurePosixPath(urlparse(remote_file.url).path).name
+    return pathlib.Path(remote_file.out_path).name
+
+
+def _checksum_algorithm(remote_file: RemoteFile) -> str:
+    if remote_file.checksum is not None:
+        return remote_file.checksum.split(":", 1)[0]
+    return "sha256"
+
+
+def _check_source(remote_file: RemoteFile, size: int, checksum: str) -> None:
+    """Checks the size and checksum of the downloaded bytes"""
+    name = pathlib.Path(remote_file.out_path).name
+    if remote_file.size is not None and size != remote_file.size:
+        raise ValueError(f"{name}: expected {remote_file.size} bytes, got {size} bytes")
+    if remote_file.checksum is not None and checksum != remote_file.checksum:
+        raise ValueError(
+            f"{name}: checksum mismatch, expected {remote_file.checksum} got {checksum}"
+        )
+
+
+def _write_record(out_path: pathlib.Path, source_size: int, checksum: str) -> None:
+    """Records the size and checksum of the downloaded bytes next to the file"""
+    stat = out_path.stat()
+    with open(_record_path(out_path), "w") as record_file:
+        json.dump(
+            {
+                "checksum": checksum,
+                "source_size": source_size,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            },
+            record_file,
+        )
+
+
+def is_valid(remote_file: RemoteFile) -> bool:
+    """Checks whether a file has already been downloaded and verified. The checksum
+    recorded after the download is trusted as long as the size and modification time
+    of the file are unchanged.
+
+    Parameters
+    ----------
+    remote_file : RemoteFile
+        file to check
+
+    Returns
+    -------
+    bool
+        True if the file does not need to be downloaded again
+    """
+    out_path = pathlib.Path(remote_file.out_path)
+    record_path = _record_path(out_path)
+    if not out_path.is_file() or not record_path.is_file():
+        return False
+
+    with open(record_path) as record_file:
+        record = json.load(record_file)
+    stat = out_path.stat()
+    source_size = record.get("source_size", record["size"])
+    if remote_file.size is not None and source_size != remote_file.size:
+        return False
+    if (stat.st_size, stat.st_mtime_ns) != (record["size"], record["mtime_ns"]):
+        return False
+    if remote_file.checksum is not None and record["checksum"] != remote_file.checksum:
+        return False
+
+    return True
+
+
+def _verify(remote_file: RemoteFile, part_path: pathlib.Path) -> None:
+    """Verifies a complete `.part` file, renames it and records its checksum"""
+    out_path = pathlib.Path(remote_file.out_path)
+    size = part_path.stat().st_size
+    checksum = file_checksum(part_path, algorithm=_checksum_algorithm(remote_file))
+    try:
+        _check_source(remote_file, size, checksum)
+    except ValueError:
+        part_path.unlink()
+        raise
+
+    part_path.replace(out_path)
+    _write_record(out_path, size, checksum)
+    _log_unverified(remote_file, size, checksum)
+
+
+def _log_unverified(remote_file: RemoteFile, size: int, checksum: str) -> None:
+    """Logs the size and checksum of a file downloaded without an expected
+    checksum, so they can be pinned"""
+    if remote_file.checksum is None:
+        logging.warning(
+            f"{pathlib.Path(remote_file.out_path).name} was downloaded without an"
+            f" expected checksum: size={size}, checksum={checksum!r}"
+        )
+
+
+def _fetch(
+    url: str,
+    part_path: pathlib.Path,
+    session: requests.Session,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+) -> None:
+    """Downloads a URL into a `.part` file, resuming from the end of the file"""
+    offset = part_path.stat().st_size if part_path.is_file() else 0
+
+    # requesting the raw bytes, so the offset matches the size of the file
+    headers = {"Accept-Encoding": "identity"}
+    if offset > 0:
+        headers["Range"] = f"bytes={offset}-"
+
+    with session.get(url, headers=headers, stream=True, timeout=60) as r:
+        # the requested range starts at the end of the file: already complete
+        if r.status_code == 416:
+            return
+        r.raise_for_status()
+
+        # servers that ignore range requests send the whole file again
+        mode = "ab" if r.status_code == 206 else "wb"
+        logging.info(
+            f"Downloading {part_path.name} from byte {offset if mode == 'ab' else 0}:"
+            f" {r.headers.get('Content-Length')} bytes left"
+        )
+        with open(part_path, mode=mode) as out_file:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                out_file.write(chunk)
+
+
+def _total_size(url: str, session: requests.Session) -> Optional[int]:
+    """Returns the size announced by the server, or None if it is unknown"""
+    with session.head(
+        url, headers={"Accept-Encoding": "identity"}, allow_redirects=True, timeout=60
+    ) as r:
+        size = r.headers.get("Content-Length")
+    return int(size) if r.ok and size is not None else None
+
+
+class _HashingStream(io.RawIOBase):
+    """Readable stream over chunks of bytes (e.g. the content of a response), which
+    counts and hashes the bytes read
+    """
+
+    def __init__(self, chunks: Iterator[bytes], algorithm: str = "md5"):
+        self._chunks = chunks
+        self._chunk = memoryview(b"")
+        self.digest = hashlib.new(algorithm)
+        self.size = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while len(self._chunk) == 0:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self.digest.update(chunk)
+            self.size += len(chunk)
+            self._chunk = memoryview(chunk)
+
+        n_bytes = min(len(buffer), len(self._chunk))
+        buffer[:n_bytes] = self._chunk[:n_bytes]
+        self._chunk = self._chunk[n_bytes:]
+        return n_bytes
+
+
+def _transcode(
+    chunks: Iterator[bytes],
+    out_path: pathlib.Path,
+    is_gzip: bool,
+    algorithm: str = "md5",
+    feature_dtype: str = "float64",
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+) -> Tuple[int, str]:
+    """Transcodes chunks of a (gzip compressed) CSV file into a parquet file and
+    returns the size and checksum of the chunks
+    """
+    source = _HashingStream(chunks, algorithm=algorithm)
+    csv_stream: BinaryIO = io.BufferedReader(source, buffer_size=chunk_size)
+    if is_gzip:
+        csv_stream = gzip.GzipFile(fileobj=csv_stream)
+    loader.stream_csv_to_parquet(csv_stream, out_path, feature_dtype=feature_dtype)
+
+    # hashing trailing bytes that were not needed to parse the CSV file
+    while source.read(chunk_size):
+        pass
+
+    return source.size, f"{algorithm}:{source.digest.hexdigest()}"
+
+
+def _download_transcoded(
+    remote_file: RemoteFile,
+    mirror: Optional[Union[str, pathlib.Path]] = None,
+    feature_dtype: str = "float64",
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+    max_retries: int = MAX_RETRIES,
+) -> pathlib.Path:
+    """Downloads a (gzip compressed) CSV file and transcodes it into a parquet file in
+    a single streaming pass, see `download_file()`
+    """
+    out_path = pathlib.Path(remote_file.out_path)
+    source_name = _source_name(remote_file)
+    algorithm = _checksum_algorithm(remote_file)
+    is_gzip = source_name.endswith(".gz")
+
+    # reading from a local mirror directory
+    if mirror is not None and not str(mirror).startswith(("http://", "https://")):
+        logging.info(f"Transcoding {source_name} from mirror: {mirror}")
+        with open(pathlib.Path(mirror) / source_name, mode="rb") as in_file:
+            size, checksum = _transcode(
+                iter(lambda: in_file.read(chunk_size), b""),
+                out_path,
+                is_gzip,
+                algorithm=algorithm,
+                feature_dtype=feature_dtype,
+                chunk_size=chunk_size,
+            )
+    else:
+        url = remote_file.url
+        if mirror is not None:
+            url = f"{str(mirror).rstrip('/')}/{source_name}"
+
+        with requests.Session() as session:
+            for attempt in range(1, max_retries + 1):
+                try:
+                    # requesting the raw bytes, so they match the expected checksum
+                    with session.get(
+                        url,
+                        headers={"Accept-Encoding": "identity"},
+                        stream=True,
+                        timeout=60,
+                    ) as r:
+                        r.raise_for_status()
+                        logging.info(
+                            f"Transcoding {source_name} into {out_path.name}:"
+                            f" {r.headers.get('Content-Length')} bytes"
+                        )
+                        size, checksum = _transcode(
+                            r.iter_content(chunk_size=chunk_size),
+                            out_path,
+                            is_gzip,
+                            algorithm=algorithm,
+                            feature_dtype=feature_dtype,
+                            chunk_size=chunk_size,
+                        )
+                    break
+                except requests.RequestException as e:
+                    if attempt == max_retries:
+                        raise
+                    logging.warning(
+                        f"Transcoding of {source_name} failed (attempt {attempt}):"
+                        f" {e}. Restarting"
+                    )
+                    time.sleep(min(2**attempt, 60))
+
+    try:
+        _check_source(remote_file, size, checksum)
+    except ValueError:
+        out_path.unlink()
+        raise
+
+    _write_record(out_path, size, checksum)
+    _log_unverified(remote_file, size, checksum)
+    return out_path
+
+
+def download_file(
+    remote_file: RemoteFile,
+    mirror: Optional[Union[str, pathlib.Path]] = None,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+    max_retries: int = MAX_RETRIES,
+    feature_dtype: str = "float64",
+    allow_unverified: bool = False,
+) -> pathlib.Path:
+    """Downloads a single file with resume support, unless it is already valid.
+    Files with `remote_file.transcode` are transcoded into parquet files instead.
+
+    Parameters
+    ----------
+    remote_file : RemoteFile
+        file to download
+    mirror : Optional[Union[str, pathlib.Path]]
+        local directory or base URL containing the file under the same name as
+        `remote_file.out_path` (or as the URL for transcoded files), used instead of
+        `remote_file.url`
+    chunk_size : int, optional
+        number of bytes written per chunk, by default DOWNLOAD_CHUNK_SIZE
+    max_retries : int, optional
+        number of attempts, the download is resumed after each failure (transcoding
+        is restarted). By default MAX_RETRIES.
+    feature_dtype : str, optional
+        type of the feature columns of transcoded files, by default "float64"
+    allow_unverified : bool, optional
+        if True, a file without an expected checksum is downloaded and its SHA-256
+        checksum is logged. By default False.
+
+    Returns
+    -------
+    pathlib.Path
+        path to the downloaded file
+
+    Raises
+    ------
+    ValueError
+        raised if the file has no expected checksum and `allow_unverified` is False,
+        or if the downloaded file does not have the expected size or checksum. The
+        invalid file is deleted.
+    requests.RequestException
+        raised if the download still fails after `max_retries` attempts
+    """
+    out_path = pathlib.Path(remote_file.out_path)
+    if remote_file.checksum is None and not allow_unverified:
+        raise ValueError(
+            f"{out_path.name}: no expected checksum, set the checksum of the file or"
+            " allow unverified downloads"
+        )
+    if is_valid(remote_file):
+        logging.info(f"Skipping {out_path.name}: already downloaded and verified")
+        return out_path
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    if remote_file.transcode:
+        return _download_transcoded(
+            remote_file,
+            mirror=mirror,
+            feature_dtype=feature_dtype,
+            chunk_size=chunk_size,
+            max_retries=max_retries,
+        )
+
+    part_path = _part_path(out_path)
+
+    # copying from a local mirror directory
+    if mirror is not None and not str(mirror).startswith(("http://", "https://")):
+        logging.info(f"Copying {out_path.name} from mirror: {mirror}")
+        shutil.copyfile(pathlib.Path(mirror) / out_path.name, part_path)
+        _verify(remote_file, part_path)
+        return out_path
+
+    url = remote_file.url
+    if mirror is not None:
+        url = f"{str(mirror).rstrip('/')}/{out_path.name}"
+
+    with requests.Session() as session:
+        for attempt in range(1, max_retries + 1):
+            try:
+                # the expected size is used to detect incomplete downloads
+                if remote_file.size is None:
+                    remote_file = replace(remote_file, size=_total_size(url, session))
+                _fetch(url, part_path, session, chunk_size=chunk_size)
+                if (
+                    remote_file.size is not None
+                    and part_path.stat().st_size < remote_file.size
+                ):
+                    raise requests.ConnectionError(f"{out_path.name}: incomplete")
+                break
+            except requests.RequestException as e:
+                if attempt == max_retries:
+                    raise
+                logging.warning(
+                    f"Download of {out_path.name} failed (attempt {attempt}): {e}."
+                    " Resuming"
+                )
+                time.sleep(min(2**attempt, 60))
+
+    _verify(remote_file, part_path)
+    return out_path
+
+
+def download_files(
+    remote_files: Sequence[RemoteFile],
+    mirror: Optional[Union[str, pathlib.Path]] = None,
+    n_workers: int = 4,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+    max_retries: int = MAX_RETRIES,
+    feature_dtype: str = "float64",
+    allow_unverified: bool = False,
+) -> List[pathlib.Path]:
+    """Downloads several files concurrently, see `download_file()`
+
+    Parameters
+    ----------
+    remote_files : Sequence[RemoteFile]
+        files to download
+    mirror : Optional[Union[str, pathlib.Path]]
+        local directory or base URL containing the files
+    n_workers : int, optional
+        number of concurrent downloads, by default 4
+    chunk_size : int, optional
+        number of bytes written per chunk, by default DOWNLOAD_CHUNK_SIZE
+    max_retries : int, optional
+        number of attempts per file, by default MAX_RETRIES
+    feature_dtype : str, optional
+        type of the feature columns of transcoded files, by default "float64"
+    allow_unverified : bool, optional
+        if True, files without an expected checksum are downloaded and their SHA-256
+        checksums are logged. By default False.
+
+    Returns
+    -------
+    List[pathlib.Path]
+        paths to the downloaded files, in the same order as `remote_files`
+    """
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = [
+            pool.submit(
+                download_file,
+                remote_file,
+                mirror=mirror,
+                chunk_size=chunk_size,
+                max_retries=max_retries,
+                feature_dtype=feature_dtype,
+                allow_unverified=allow_unverified,
+            )
+            for remote_file in remote_files
+        ]
+        return [future.result() for future in futures]
@@ -0,0 +1,183 @@
+"""
+Contains a selective extractor for zip archives of single-cell profiles.
+
+The normalized data archive of the MitoCheck dataset contains several profile files,
+while the analysis only reads some of them. Only the requested members are streamed
+out of the archive, the other members are never decompressed nor written to disk.
+
+Members can either be extracted as they are, or transcoded into parquet files during
+the extraction (see `loader.stream_csv_to_parquet()`). Transcoding removes both the
+CSV file from disk and the extra pass over the CSV data needed to build the parquet
+cache of the analysis.
+
+Every extracted member is recorded next to its output file with its size and CRC in
+the archive, so members that are already extracted are skipped.
+"""
+import gzip
+import json
+import logging
+import pathlib
+import shutil
+import zipfile
+from typing import List, Sequence, Union
+
+from . import loader
+
+# number of bytes copied per chunk when extracting members
+EXTRACT_CHUNK_SIZE = 1024**2
+
+
+def _record_path(out_path: pathlib.Path) -> pathlib.Path:
+    return out_path.with_name(f"{out_path.name}.member.json")
+
+
+def _member_record(info: zipfile.ZipInfo, out_path: pathlib.Path) -> dict:
+    stat = out_path.stat()
+    return {
+        "member": info.filename,
+        "crc": info.CRC,
+        "file_size": info.file_size,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def is_extracted(info: zipfile.ZipInfo, out_path: Union[str, pathlib.Path]) -> bool:
+    """Checks whether a member has already been extracted into a file that has not
+    been modified since
+
+    Parameters
+    ----------
+    info : zipfile.ZipInfo
+        member of the archive
+    out_path : Union[str, pathlib.Path]
+        path of the extracted (or transcoded) file
+
+    Returns
+    -------
+    bool
+        True if the member does not need to be extracted again
+    """
+    out_path = pathlib.Path(out_path)
+    record_path = _record_path(out_path)
+    if not out_path.is_file() or not record_path.is_file():
+        return False
+
+    with open(record_path) as record_file:
+        record = json.load(record_file)
+    return record == _member_record(info, out_path)
+
+
+def find_members(
+    zip_file: zipfile.ZipFile, members: Sequence[str]
+) -> List[zipfile.ZipInfo]:
+    """Finds members of an archive from their name, with or without their directory
+    within the archive (e.g. "negative_control_data.csv.gz")
+
+    Parameters
+    ----------
+    zip_file : zipfile.ZipFile
+        opened archive
+    members : Sequence[str]
+        names of the members
+
+    Returns
+    -------
+    List[zipfile.ZipInfo]
+        members of the archive, in the same order as `members`
+
+    Raises
+    ------
+    KeyError
+        raised if a member is missing from the archive or if a name matches several
+        members
+    """
+    infos = [info for info in zip_file.infolist() if not info.is_dir()]
+
+    found = []
+    for member in members:
+        matches = [
+            info
+            for info in infos
+            if info.filename == member
+            or pathlib.PurePosixPath(info.filename).name == member
+        ]
+        if len(matches) != 1:
+            raise KeyError(
+                f"{member} matches {len(matches)} members of {zip_file.filename}"
+            )
+        found.append(matches[0])
+
+    return found
+
+
+def extract_members(
+    zip_path: Union[str, pathlib.Path],
+    members: Sequence[str],
+    out_dir: Union[str, pathlib.Path],
+    transcode: bool = False,
+    feature_dtype: str = "float64",
+) -> List[pathlib.Path]:
+    """Streams selected members out of a zip archive. Members keep their directory
+    within the archive (e.g. "normalized_data/negative_control_data.csv.gz"), like
+    `zipfile.ZipFile.extractall()`.
+
+    Parameters
+    ----------
+    zip_path : Union[str, pathlib.Path]
+        path to the zip archive
+    members : Sequence[str]
+        names of the members to extract, see `find_members()`
+    out_dir : Union[str, pathlib.Path]
+        directory where the members are extracted
+    transcode : bool, optional
+        if True, (gzip compressed) CSV members are transcoded into parquet files
+        named after the member (e.g. "negative_control_data.parquet") instead of
+        being extracted. By default False.
+    feature_dtype : str, optional
+        type of the feature columns of transcoded members, by default "float64"
+
+    Returns
+    -------
+    List[pathlib.Path]
+        paths to the extracted (or transcoded) files, in the same order as `members`
+    """
+    out_dir = pathlib.Path(out_dir)
+
+    out_paths = []
+    with zipfile.ZipFile(zip_path, mode="r") as zip_file:
+        for info in find_members(zip_file, members):
+            out_path = out_dir / info.filename
+            if transcode:
+                # removing all suffixes (e.g ".csv.gz") from the member name
+                out_path = out_path.with_name(f"{out_path.name.split('.')[0]}.parquet")
+            out_paths.append(out_path)
+
+            if is_extracted(info, out_path):
+                logging.info(f"Skipping {info.filename}: already extracted")
+                continue
+
+            logging.info(f"Extracting {info.filename} into: {out_path}")
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            with zip_file.open(info) as member_file:
+                if transcode and info.filename.endswith(".gz"):
+                    with gzip.GzipFile(fileobj=member_file) as csv_stream:
+                        loader.stream_csv_to_parquet(
+                            csv_stream, out_path, feature_dtype=feature_dtype
+                        )
+                elif transcode:
+                    loader.stream_csv_to_parquet(
+                        member_file, out_path, feature_dtype=feature_dtype
+                    )
+                else:
+                    # writing into a temporary file first, a crash never leaves a
+                    # partial file behind
+                    tmp_path = out_path.with_name(f"{out_path.name}.tmp")
+                    with open(tmp_path, mode="wb") as out_file:
+                        shutil.copyfileobj(member_file, out_file, EXTRACT_CHUNK_SIZE)
+                    tmp_path.replace(out_path)
+
+            with open(_record_path(out_path), "w") as record_file:
+                json.dump(_member_record(info, out_path), record_file)
+
+    return out_paths
@@ -0,0 +1,61 @@
+"""
+Contains a function to apply feature selection once on several profile files.
+
+The training and control profiles are selected together, so both datasets keep the
+same feature columns. The pycytominer rules are applied from streaming statistics
+(`feature_stats`) computed on the profile files, so the profiles are never loaded
+into memory and the whole control population can be used.
+
+The selected features are not cached by this module, the analysis caches them as a
+stage of its `stage_cache.StageCache`.
+"""
+import pathlib
+from typing import List, Optional, Sequence, Union
+
+from . import feature_stats
+
+
+def select_features_streaming(
+    profile_paths: Sequence[Union[str, pathlib.Path]],
+    features: List[str],
+    operation: Union[str, List[str]] = "variance_threshold",
+    profile_cache_dir: Optional[Union[str, pathlib.Path]] = None,
+    **kwargs,
+) -> List[str]:
+    """Applies feature selection on several profile files from streaming feature
+    statistics. The files are read in row batches, so memory only depends on the
+    number of features.
+
+    Parameters
+    ----------
+    profile_paths : Sequence[Union[str, pathlib.Path]]
+        paths to (gzip compressed) CSV or parquet files selected together
+    features : List[str]
+        feature columns to select from, must exist in all files
+    operation : Union[str, List[str]], optional
+        operations supported by `feature_stats.excluded_features()`,
+        by default "variance_threshold"
+    profile_cache_dir : Optional[Union[str, pathlib.Path]]
+        directory of the parquet cache used to stream CSV files
+    **kwargs
+        rule parameters passed to `feature_stats.excluded_features()`
+
+    Returns
+    -------
+    List[str]
+        selected features, in the same order as `features`
+
+    Raises
+    ------
+    TypeError
+        raised if `features` is not a list
+    """
+    # type checking
+    if not isinstance(features, list):
+        raise TypeError(f"`features` must be a list not {type(features)}")
+
+    stats = feature_stats.stats_from_profiles(
+        profile_paths, features, cache_dir=profile_cache_dir
+    )
+    excluded = set(feature_stats.excluded_features(stats, operation, **kwargs))
+    return [colname for colname in features if colname not in excluded]
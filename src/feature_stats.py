@@ -0,0 +1,335 @@
+"""
+Contains a streaming feature statistics engine used to apply feature selection
+without loading whole datasets into memory.
+
+Profiles are read in row batches from parquet files (CSV files are converted through
+the parquet cache of `loader`). Each batch updates running counts, means, sums of
+squared deviations and a co-moment matrix. Statistics computed on different files
+or row groups (e.g. by different workers) are merged with the pairwise update of
+Chan et al., so the memory used only depends on the number of features.
+
+The variance, missing values, correlation and blocklist rules of pycytominer
+`feature_select()` are then applied on the accumulated statistics.
+"""
+import pathlib
+from typing import List, Optional, Sequence, Union
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from . import loader
+
+# number of rows read per batch
+STATS_BATCH_SIZE = 65536
+
+
+class FeatureStats:
+    """Mergeable statistics of a set of feature columns.
+
+    Means and variances are computed for each feature over its non missing values.
+    The covariance matrix is computed over complete rows (rows without missing or
+    infinite values).
+
+    Parameters
+    ----------
+    features : List[str]
+        names of the feature columns
+    """
+
+    def __init__(self, features: List[str]):
+        n_features = len(features)
+        self.features = list(features)
+        self.n_rows = 0
+        self.n_missing = np.zeros(n_features, dtype=np.int64)
+
+        # per feature moments over non missing values
+        self.count = np.zeros(n_features, dtype=np.int64)
+        self.mean = np.zeros(n_features, dtype=np.float64)
+        self.m2 = np.zeros(n_features, dtype=np.float64)
+
+        # moments over complete rows
+        self.n_complete = 0
+        self.complete_mean = np.zeros(n_features, dtype=np.float64)
+        self.comoment = np.zeros((n_features, n_features), dtype=np.float64)
+
+    def update(self, feats: np.ndarray) -> "FeatureStats":
+        """Adds a batch of rows to the statistics
+
+        Parameters
+        ----------
+        feats : np.ndarray
+            feature values with shape (n_rows, n_features)
+
+        Returns
+        -------
+        FeatureStats
+            updated statistics
+        """
+        if not isinstance(feats, np.ndarray) or feats.ndim != 2:
+            raise TypeError("'feats' must be a 2D numpy array")
+        if feats.shape[1] != len(self.features):
+            raise ValueError("'feats' must have one column per feature")
+
+        batch = FeatureStats(self.features)
+        feats = np.asarray(feats, dtype=np.float64)
+        is_finite = np.isfinite(feats)
+        batch.n_rows = feats.shape[0]
+        batch.n_missing = np.isnan(feats).sum(axis=0)
+
+        # per feature moments, missing values are skipped
+        batch.count = is_finite.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            batch.mean = np.where(is_finite, feats, 0).sum(axis=0) / batch.count
+        batch.mean[batch.count == 0] = 0
+        deviations = np.where(is_finite, feats - batch.mean, 0)
+        batch.m2 = np.einsum("ij,ij->j", deviations, deviations)
+
+        # co-moments over complete rows
+        complete_feats = feats[is_finite.all(axis=1)]
+        batch.n_complete = complete_feats.shape[0]
+        if batch.n_complete > 0:
+            batch.complete_mean = complete_feats.mean(axis=0)
+            centered = complete_feats - batch.complete_mean
+            batch.comoment = centered.T @ centered
+
+        return self.merge(batch)
+
+    def merge(self, other: "FeatureStats") -> "FeatureStats":
+        """Merges the statistics of another set of rows into these statistics
+
+        Parameters
+        ----------
+        other : FeatureStats
+            statistics of the same features computed on other rows
+
+        Returns
+        -------
+        FeatureStats
+            merged statistics
+        """
+        if other.features != self.features:
+            raise ValueError("statistics must be computed on the same features")
+
+        self.n_rows += other.n_rows
+        self.n_missing = self.n_missing + other.n_missing
+
+        # per feature moments
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            other_weight = np.where(count > 0, other.count / count, 0)
+        self.m2 = self.m2 + other.m2 + delta**2 * self.count * other_weight
+        self.mean = self.mean + delta * other_weight
+        self.count = count
+
+        # co-moments over complete rows
+        n_complete = self.n_complete + other.n_complete
+        if other.n_complete > 0:
+            delta = other.complete_mean - self.complete_mean
+            self.comoment = (
+                self.comoment
+                + other.comoment
+                + np.outer(delta, delta)
+                * self.n_complete
+                * other.n_complete
+                / n_complete
+            )
+            self.complete_mean = (
+                self.complete_mean + delta * other.n_complete / n_complete
+            )
+        self.n_complete = n_complete
+
+        return self
+
+    @property
+    def variance(self) -> np.ndarray:
+        """Population variance (ddof=0) of each feature"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.m2 / self.count
+
+    @property
+    def na_fraction(self) -> np.ndarray:
+        """Fraction of missing values of each feature"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.n_missing / self.n_rows
+
+    def correlation(self) -> np.ndarray:
+        """Pearson correlation matrix computed over complete rows. Correlations of
+        constant features are NaN.
+
+        Returns
+        -------
+        np.ndarray
+            correlation matrix with shape (n_features, n_features)
+        """
+        std = np.sqrt(np.diag(self.comoment))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.comoment / np.outer(std, std)
+
+
+def stats_from_parquet(
+    parquet_path: Union[str, pathlib.Path],
+    features: List[str],
+    row_groups: Optional[List[int]] = None,
+    batch_size: int = STATS_BATCH_SIZE,
+) -> FeatureStats:
+    """Computes feature statistics by streaming a parquet file in row batches.
+    Different row groups of the same file can be processed by different workers and
+    merged with `FeatureStats.merge()`.
+
+    Parameters
+    ----------
+    parquet_path : Union[str, pathlib.Path]
+        path to the parquet file
+    features : List[str]
+        feature columns
+    row_groups : Optional[List[int]]
+        row groups to read, by default all row groups
+    batch_size : int, optional
+        number of rows read per batch, by default STATS_BATCH_SIZE
+
+    Returns
+    -------
+    FeatureStats
+        statistics of the read rows
+    """
+    stats = FeatureStats(features)
+    parquet_file = pq.ParquetFile(parquet_path)
+    for batch in parquet_file.iter_batches(
+        batch_size=batch_size, row_groups=row_groups, columns=features
+    ):
+        feats = np.column_stack(
+            [
+                batch.column(colname).to_numpy(zero_copy_only=False)
+                for colname in features
+            ]
+        )
+        stats.update(feats.astype(np.float64, copy=False))
+
+    return stats
+
+
+def stats_from_profiles(
+    profile_paths: Sequence[Union[str, pathlib.Path]],
+    features: List[str],
+    cache_dir: Optional[Union[str, pathlib.Path]] = None,
+    batch_size: int = STATS_BATCH_SIZE,
+) -> FeatureStats:
+    """Computes feature statistics over several (gzip compressed) CSV or parquet
+    files. CSV files are streamed through the parquet cache of `loader`.
+
+    Parameters
+    ----------
+    profile_paths : Sequence[Union[str, pathlib.Path]]
+        paths to the profiles
+    features : List[str]
+        feature columns, must exist in all files
+    cache_dir : Optional[Union[str, pathlib.Path]]
+        directory of the parquet cache
+    batch_size : int, optional
+        number of rows read per batch, by default STATS_BATCH_SIZE
+
+    Returns
+    -------
+    FeatureStats
+        merged statistics of all files
+    """
+    stats = FeatureStats(features)
+    for profile_path in profile_paths:
+        profile_path = pathlib.Path(profile_path)
+        if profile_path.suffix != ".parquet":
+            profile_path = loader.build_cache(profile_path, cache_dir=cache_dir)
+        stats.merge(stats_from_parquet(profile_path, features, batch_size=batch_size))
+
+    return stats
+
+
+def correlated_features(stats: FeatureStats, threshold: float = 0.9) -> List[str]:
+    """Returns the features excluded by the pycytominer correlation threshold rule.
+    For every pair of features with a correlation above `threshold`, the feature
+    with the highest sum of absolute correlations with all features is excluded.
+
+    Parameters
+    ----------
+    stats : FeatureStats
+        feature statistics
+    threshold : float, optional
+        correlation threshold, by default 0.9
+
+    Returns
+    -------
+    List[str]
+        excluded features
+    """
+    corr = stats.correlation()
+
+    # position of each feature sorted by total absolute correlation
+    abs_corr_sum = np.nansum(np.abs(corr), axis=0)
+    corr_rank = np.empty(len(abs_corr_sum), dtype=np.int64)
+    corr_rank[np.argsort(abs_corr_sum, kind="stable")] = np.arange(len(abs_corr_sum))
+
+    # pairs of the lower triangle above the threshold
+    with np.errstate(invalid="ignore"):
+        pair_a, pair_b = np.nonzero(np.tril(corr > threshold, k=-1))
+    excluded_idx = np.where(corr_rank[pair_a] > corr_rank[pair_b], pair_a, pair_b)
+
+    return [stats.features[idx] for idx in np.unique(excluded_idx)]
+
+
+def excluded_features(
+    stats: FeatureStats,
+    operation: Union[str, List[str]] = "variance_threshold",
+    na_cutoff: float = 0.05,
+    corr_threshold: float = 0.9,
+    min_variance: float = 1e-6,
+    blocklist: Optional[List[str]] = None,
+) -> List[str]:
+    """Applies feature selection rules on feature statistics. As in pycytominer
+    `feature_select()`, every operation is applied on all the features and the
+    excluded features of all operations are combined.
+
+    Parameters
+    ----------
+    stats : FeatureStats
+        feature statistics
+    operation : Union[str, List[str]], optional
+        operations, any of "variance_threshold", "drop_na_columns",
+        "correlation_threshold" and "blocklist". By default "variance_threshold".
+    na_cutoff : float, optional
+        largest fraction of missing values, by default 0.05
+    corr_threshold : float, optional
+        correlation threshold, by default 0.9
+    min_variance : float, optional
+        features with a variance below or equal to this value are excluded,
+        by default 1e-6
+    blocklist : Optional[List[str]]
+        features excluded by the "blocklist" operation
+
+    Returns
+    -------
+    List[str]
+        excluded features, in the same order as the features of `stats`
+
+    Raises
+    ------
+    ValueError
+        raised if an unknown operation is provided
+    """
+    operations = [operation] if isinstance(operation, str) else operation
+
+    excluded = set()
+    for op in operations:
+        if op == "variance_threshold":
+            is_excluded = ~(stats.variance > min_variance)
+            excluded.update(np.array(stats.features)[is_excluded])
+        elif op == "drop_na_columns":
+            is_excluded = stats.na_fraction > na_cutoff
+            excluded.update(np.array(stats.features)[is_excluded])
+        elif op == "correlation_threshold":
+            excluded.update(correlated_features(stats, threshold=corr_threshold))
+        elif op == "blocklist":
+            excluded.update(set(blocklist or []) & set(stats.features))
+        else:
+            raise ValueError(f"unsupported feature selection operation: {op}")
+
+    return [colname for colname in stats.features if colname in excluded]
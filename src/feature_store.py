@@ -0,0 +1,205 @@
+"""
+Contains a store of numpy arrays that are shared between worker processes through
+memory-mapped `.npy` files.
+
+Arrays are written once by the main process, then every process (including the
+workers) memory maps them when they are first accessed. The data lives in the page
+cache of the operating system and is shared by all processes, so the memory used by
+each worker does not grow with the size of the stored arrays.
+
+A `FeatureStore` only holds the path of its directory when it is pickled, therefore
+workers attach to the stored arrays by name without copying them.
+"""
+import os
+import pathlib
+import tempfile
+from typing import Dict, List, Union
+
+import numpy as np
+import pandas as pd
+
+
+class FeatureStore:
+    """Numpy arrays stored as memory-mapped `.npy` files within a directory
+
+    Parameters
+    ----------
+    store_dir : Union[str, pathlib.Path]
+        directory where the arrays are stored
+    """
+
+    def __init__(self, store_dir: Union[str, pathlib.Path]):
+        self.store_dir = pathlib.Path(store_dir)
+        self._arrays = {}
+        self._levels = {}
+
+    @classmethod
+    def create(cls, store_dir: Union[str, pathlib.Path]) -> "FeatureStore":
+        """Creates an empty store. Arrays left by a previous run in the same
+        directory are removed.
+
+        Parameters
+        ----------
+        store_dir : Union[str, pathlib.Path]
+            directory where the arrays are stored
+
+        Returns
+        -------
+        FeatureStore
+            empty store
+        """
+        store_dir = pathlib.Path(store_dir)
+        store_dir.mkdir(parents=True, exist_ok=True)
+        for stored_path in [*store_dir.glob("*.npy"), *store_dir.glob("*.pkl")]:
+            stored_path.unlink()
+
+        return cls(store_dir)
+
+    def __getstate__(self) -> dict:
+        # memory maps are not pickled, processes attach to the files by name
+        return {"store_dir": self.store_dir}
+
+    def __setstate__(self, state: dict) -> None:
+        self.store_dir = state["store_dir"]
+        self._arrays = {}
+        self._levels = {}
+
+    def __contains__(self, name: str) -> bool:
+        return self._path(name).is_file()
+
+    def _path(self, name: str) -> pathlib.Path:
+        return self.store_dir / f"{name}.npy"
+
+    def names(self) -> List[str]:
+        """Returns the names of all stored arrays"""
+        return sorted(stored_path.stem for stored_path in self.store_dir.glob("*.npy"))
+
+    def save(self, name: str, array: np.ndarray) -> np.ndarray:
+        """Writes an array into the store and returns its memory map. The memory
+        layout (C or Fortran order) of the array is preserved. Processes can write
+        the same array concurrently, the last write replaces the others.
+
+        Parameters
+        ----------
+        name : str
+            name of the array
+        array : np.ndarray
+            array to store
+
+        Returns
+        -------
+        np.ndarray
+            read-only memory map of the stored array
+        """
+        if not isinstance(array, np.ndarray):
+            raise TypeError("'array' must be a numpy array")
+
+        # writing into a temporary file unique to this writer first, processes never
+        # map a partial file and concurrent writers never replace each other's file
+        tmp_file = tempfile.NamedTemporaryFile(
+            dir=self.store_dir, prefix=f"{name}.", suffix=".npy.tmp", delete=False
+        )
+        try:
+            with tmp_file:
+                np.save(tmp_file, array, allow_pickle=False)
+            os.replace(tmp_file.name, self._path(name))
+        except BaseException:
+            os.unlink(tmp_file.name)
+            raise
+        self._arrays.pop(name, None)
+
+        return self.load(name)
+
+    def load(self, name: str) -> np.ndarray:
+        """Returns the memory map of a stored array. The file is mapped once per
+        process.
+
+        Parameters
+        ----------
+        name : str
+            name of the array
+
+        Returns
+        -------
+        np.ndarray
+            read-only memory map of the stored array
+
+        Raises
+        ------
+        KeyError
+            raised if the array is not stored
+        """
+        if name not in self._arrays:
+            if name not in self:
+                raise KeyError(f"'{name}' is not stored in {self.store_dir}")
+            self._arrays[name] = np.load(self._path(name), mmap_mode="r")
+
+        return self._arrays[name]
+
+    def save_metadata(self, name: str, meta: pd.DataFrame) -> None:
+        """Stores a metadata dataframe as an integer code matrix. The distinct values
+        of each column are stored separately and are small compared to the codes.
+        Categorical columns (see `metadata_codec`) keep their codes and categories.
+
+        Parameters
+        ----------
+        name : str
+            name of the metadata
+        meta : pd.DataFrame
+            metadata dataframe
+        """
+        codes = np.empty(meta.shape, dtype=np.int32)
+        levels = {}
+        for col_idx, colname in enumerate(meta.columns):
+            if isinstance(meta[colname].dtype, pd.CategoricalDtype):
+                codes[:, col_idx] = meta[colname].cat.codes
+                levels[colname] = meta[colname].dtype
+            else:
+                codes[:, col_idx], levels[colname] = pd.factorize(meta[colname])
+
+        self.save(f"{name}_codes", codes)
+        pd.to_pickle(levels, self.store_dir / f"{name}_levels.pkl")
+        self._levels.pop(name, None)
+
+    def load_metadata(self, name: str, idx: np.ndarray) -> pd.DataFrame:
+        """Decodes the rows of stored metadata
+
+        Parameters
+        ----------
+        name : str
+            name of the metadata
+        idx : np.ndarray
+            positions of the selected rows
+
+        Returns
+        -------
+        pd.DataFrame
+            metadata of the selected rows with a default index
+        """
+        if name not in self._levels:
+            self._levels[name] = pd.read_pickle(self.store_dir / f"{name}_levels.pkl")
+        levels: Dict[str, Union[pd.Index, pd.CategoricalDtype]] = self._levels[name]
+
+        codes = self.load(f"{name}_codes")[np.asarray(idx, dtype=np.intp)]
+        return pd.DataFrame(
+            {
+                colname: _decode_column(codes[:, col_idx], col_levels)
+                for col_idx, (colname, col_levels) in enumerate(levels.items())
+            }
+        )
+
+
+def _decode_column(
+    codes: np.ndarray, levels: Union[pd.Index, pd.CategoricalDtype]
+) -> pd.Series:
+    """Decodes the codes of a metadata column, missing values are encoded as -1.
+    Categorical columns are not decoded, they keep their codes and categories.
+    """
+    if isinstance(levels, pd.CategoricalDtype):
+        return pd.Series(pd.Categorical.from_codes(codes, dtype=levels))
+
+    values = pd.Series(pd.Categorical.from_codes(codes, categories=levels))
+    values_dtype = levels.dtype
+    if values_dtype.kind in "iu" and (codes < 0).any():
+        values_dtype = np.float64
+    return values.astype(values_dtype)
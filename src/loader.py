@@ -0,0 +1,364 @@
+"""
+Contains functions to load single-cell profiles through a columnar (Parquet) cache.
+
+The raw MitoCheck profiles are distributed as gzip compressed CSV files. Parsing
+these files dominates the start-up time of the analysis, therefore each CSV file is
+converted once into a Parquet file that is stored in a cache directory. The cached
+file is keyed by the size and modification time of the source file and by the type
+of the feature columns, so the cache is rebuilt automatically when the source file
+changes.
+
+CSV files are streamed in blocks and pyarrow only infers column types from the first
+block, so a metadata column could be typed from its first rows only. Feature columns
+have a fixed type and metadata columns are stored as strings. Metadata columns are
+typed when they are loaded, from all their values.
+
+Since Parquet is a columnar format, only the requested columns are decoded when
+loading, which allows CP-only or DP-only runs to skip the other feature block.
+"""
+import csv
+import pathlib
+from typing import BinaryIO, List, Optional, Sequence, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+# block size (in bytes) used when streaming CSV files into parquet row groups
+CSV_BLOCK_SIZE = 64 * 1024**2
+
+# types tried in order when typing a metadata column stored as strings, columns that
+# match none of them stay strings
+METADATA_TYPES = [pa.int64(), pa.float64(), pa.bool_()]
+
+
+def is_feature_column(colname: str, dataset: str = "CP_and_DP") -> bool:
+    """Checks if a column name belongs to the selected feature space. Follows the
+    same naming rules used by `utils.split_data()`
+
+    Parameters
+    ----------
+    colname : str
+        name of the column
+    dataset : str, optional
+        feature space, can be "CP" or "DP" or by default "CP_and_DP"
+
+    Returns
+    -------
+    bool
+        True if the column is a feature of the selected feature space
+
+    Raises
+    ------
+    ValueError
+        raised if an unknown feature space is provided
+    """
+    if dataset == "CP":
+        return "CP__" in colname
+    elif dataset == "DP":
+        return "DP__" in colname
+    elif dataset == "CP_and_DP":
+        return "P__" in colname
+    raise ValueError(f"`dataset` must be 'CP', 'DP' or 'CP_and_DP' not {dataset}")
+
+
+def get_cache_path(
+    csv_path: Union[str, pathlib.Path],
+    cache_dir: Optional[Union[str, pathlib.Path]] = None,
+    feature_dtype: str = "float64",
+) -> pathlib.Path:
+    """Returns the path of the cached parquet file of a CSV file. The name of the
+    cached file contains the size and modification time of the CSV file and the type
+    of the feature columns.
+
+    Parameters
+    ----------
+    csv_path : Union[str, pathlib.Path]
+        path to the (gzip compressed) CSV file
+    cache_dir : Optional[Union[str, pathlib.Path]]
+        directory where the cached files are stored. By default, the cache is stored
+        next to the CSV file.
+    feature_dtype : str, optional
+        type of the feature columns, by default "float64"
+
+    Returns
+    -------
+    pathlib.Path
+        path to the cached parquet file
+    """
+    csv_path = pathlib.Path(csv_path).resolve(strict=True)
+    cache_dir = csv_path.parent if cache_dir is None else pathlib.Path(cache_dir)
+
+    # removing all suffixes (e.g ".csv.gz") from the file name
+    stem = csv_path.name.split(".")[0]
+    stat = csv_path.stat()
+    return (
+        cache_dir / f"{stem}__{stat.st_size}_{stat.st_mtime_ns}_{feature_dtype}.parquet"
+    )
+
+
+def _rename_empty_columns(colnames: Sequence[str]) -> List[str]:
+    """Renames empty column names (e.g. the saved index of a dataframe) with the
+    pandas convention "Unnamed: {idx}"
+    """
+    return [
+        colname if colname != "" else f"Unnamed: {idx}"
+        for idx, colname in enumerate(colnames)
+    ]
+
+
+def _read_csv_header(csv_path: pathlib.Path) -> List[str]:
+    """Reads the column names of a CSV file"""
+    reader = pv.open_csv(csv_path, read_options=pv.ReadOptions(block_size=1024**2))
+    return _rename_empty_columns(reader.schema.names)
+
+
+def _convert_options(colnames: Sequence[str], feature_dtype: str) -> pv.ConvertOptions:
+    """Returns the CSV conversion options pinning the type of every column. Feature
+    columns have the `feature_dtype` type and metadata columns are read as strings,
+    where missing values are null as with `pd.read_csv()`.
+    """
+    return pv.ConvertOptions(
+        column_types={
+            colname: (
+                pa.type_for_alias(feature_dtype)
+                if is_feature_column(colname)
+                else pa.string()
+            )
+            for colname in colnames
+        },
+        strings_can_be_null=True,
+    )
+
+
+def _type_metadata(table: pa.Table) -> pa.Table:
+    """Types the metadata columns stored as strings from all their values, with the
+    first type of `METADATA_TYPES` that all values can be converted to
+    """
+    for col_idx, colname in enumerate(table.column_names):
+        column = table.column(col_idx)
+        if is_feature_column(colname) or not pa.types.is_string(column.type):
+            continue
+        for metadata_type in METADATA_TYPES:
+            try:
+                column = pc.cast(column, metadata_type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                continue
+            table = table.set_column(col_idx, colname, column)
+            break
+    return table
+
+
+def _write_parquet(
+    reader: pv.CSVStreamingReader, parquet_path: pathlib.Path
+) -> pathlib.Path:
+    """Writes every block of a CSV reader as a parquet row group"""
+    parquet_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # writing into a temporary file first, prevents leaving a corrupted cache file
+    # behind if the conversion is interrupted
+    tmp_path = parquet_path.with_suffix(".parquet.tmp")
+    with pq.ParquetWriter(tmp_path, reader.schema) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+    tmp_path.replace(parquet_path)
+
+    return parquet_path
+
+
+def csv_to_parquet(
+    csv_path: Union[str, pathlib.Path],
+    parquet_path: Union[str, pathlib.Path],
+    feature_dtype: str = "float64",
+    block_size: int = CSV_BLOCK_SIZE,
+) -> pathlib.Path:
+    """Converts a (gzip compressed) CSV file into a parquet file. The CSV file is
+    streamed in blocks and every block is written as a parquet row group, therefore
+    the whole file is never loaded into memory.
+
+    Parameters
+    ----------
+    csv_path : Union[str, pathlib.Path]
+        path to the CSV file
+    parquet_path : Union[str, pathlib.Path]
+        path where the parquet file will be written
+    feature_dtype : str, optional
+        type of the feature columns, by default "float64"
+    block_size : int, optional
+        number of bytes parsed per block, by default CSV_BLOCK_SIZE
+
+    Returns
+    -------
+    pathlib.Path
+        path to the written parquet file
+    """
+    csv_path = pathlib.Path(csv_path).resolve(strict=True)
+
+    colnames = _read_csv_header(csv_path)
+    reader = pv.open_csv(
+        csv_path,
+        read_options=pv.ReadOptions(
+            column_names=colnames, skip_rows=1, block_size=block_size
+        ),
+        convert_options=_convert_options(colnames, feature_dtype),
+    )
+
+    return _write_parquet(reader, pathlib.Path(parquet_path))
+
+
+def stream_csv_to_parquet(
+    csv_stream: BinaryIO,
+    parquet_path: Union[str, pathlib.Path],
+    feature_dtype: str = "float64",
+    block_size: int = CSV_BLOCK_SIZE,
+) -> pathlib.Path:
+    """Converts an uncompressed CSV stream (e.g. a decompressed zip member) into a
+    parquet file. Unlike `csv_to_parquet()`, the stream is only read once, so the
+    CSV data never needs to be written to disk.
+
+    Parameters
+    ----------
+    csv_stream : BinaryIO
+        readable binary stream positioned at the CSV header
+    parquet_path : Union[str, pathlib.Path]
+        path where the parquet file will be written
+    feature_dtype : str, optional
+        type of the feature columns, by default "float64"
+    block_size : int, optional
+        number of bytes parsed per block, by default CSV_BLOCK_SIZE
+
+    Returns
+    -------
+    pathlib.Path
+        path to the written parquet file
+    """
+    # the header is consumed from the stream, the rows are parsed by pyarrow
+    colnames = _rename_empty_columns(
+        next(csv.reader([csv_stream.readline().decode("utf-8")]))
+    )
+    reader = pv.open_csv(
+        csv_stream,
+        read_options=pv.ReadOptions(column_names=colnames, block_size=block_size),
+        convert_options=_convert_options(colnames, feature_dtype),
+    )
+
+    return _write_parquet(reader, pathlib.Path(parquet_path))
+
+
+def build_cache(
+    csv_path: Union[str, pathlib.Path],
+    cache_dir: Optional[Union[str, pathlib.Path]] = None,
+    feature_dtype: str = "float64",
+) -> pathlib.Path:
+    """Returns the cached parquet file of a CSV file. The cache is only generated if
+    it does not exist or if the CSV file has been modified. Outdated cache files of
+    the same CSV file are removed, cache files with other feature types are kept.
+
+    Parameters
+    ----------
+    csv_path : Union[str, pathlib.Path]
+        path to the (gzip compressed) CSV file
+    cache_dir : Optional[Union[str, pathlib.Path]]
+        directory where the cached files are stored. By default, the cache is stored
+        next to the CSV file.
+    feature_dtype : str, optional
+        type of the feature columns, by default "float64"
+
+    Returns
+    -------
+    pathlib.Path
+        path to the cached parquet file
+    """
+    cache_path = get_cache_path(csv_path, cache_dir, feature_dtype=feature_dtype)
+    if cache_path.is_file():
+        return cache_path
+
+    # removing outdated cache files generated from previous versions of the CSV file
+    stem = cache_path.name.split("__")[0]
+    version = cache_path.name[: -len(f"{feature_dtype}.parquet")]
+    for outdated_path in cache_path.parent.glob(f"{stem}__*.parquet"):
+        if not outdated_path.name.startswith(version):
+            outdated_path.unlink()
+
+    return csv_to_parquet(csv_path, cache_path, feature_dtype=feature_dtype)
+
+
+def get_columns(parquet_path: Union[str, pathlib.Path]) -> List[str]:
+    """Returns all the column names stored within a parquet file without loading
+    any data.
+
+    Parameters
+    ----------
+    parquet_path : Union[str, pathlib.Path]
+        path to the parquet file
+
+    Returns
+    -------
+    List[str]
+        column names
+    """
+    return pq.read_schema(parquet_path).names
+
+
+def load_profiles(
+    profile_path: Union[str, pathlib.Path],
+    dataset: Optional[str] = "CP_and_DP",
+    columns: Optional[List[str]] = None,
+    cache_dir: Optional[Union[str, pathlib.Path]] = None,
+    feature_dtype: str = "float64",
+) -> pd.DataFrame:
+    """Loads single-cell profiles through the parquet cache.
+
+    Only the metadata columns and the feature columns of the selected feature space
+    are decoded, the remaining feature columns are never read. Metadata columns
+    stored as strings are typed from all their values, as `pd.read_csv()` would.
+
+    Parameters
+    ----------
+    profile_path : Union[str, pathlib.Path]
+        path to a (gzip compressed) CSV or a parquet file
+    dataset : Optional[str]
+        which feature space to load, can be "CP", "DP" or by default "CP_and_DP".
+        If None, only the metadata columns are loaded.
+    columns : Optional[List[str]]
+        explicit list of columns to load. Overwrites the `dataset` selection.
+    cache_dir : Optional[Union[str, pathlib.Path]]
+        directory where the cached files are stored. By default, the cache is stored
+        next to the CSV file.
+    feature_dtype : str, optional
+        type of the feature columns in the cache, by default "float64"
+
+    Returns
+    -------
+    pd.DataFrame
+        loaded single-cell profiles
+
+    Raises
+    ------
+    TypeError
+        raised if `columns` is not a list
+    """
+    profile_path = pathlib.Path(profile_path).resolve(strict=True)
+
+    # csv files are converted into parquet files
+    if profile_path.suffix == ".parquet":
+        parquet_path = profile_path
+    else:
+        parquet_path = build_cache(
+            profile_path, cache_dir=cache_dir, feature_dtype=feature_dtype
+        )
+
+    # selecting columns to decode
+    if columns is None:
+        columns = [
+            colname
+            for colname in get_columns(parquet_path)
+            if not is_feature_column(colname)
+            or (dataset is not None and is_feature_column(colname, dataset))
+        ]
+    if not isinstance(columns, list):
+        raise TypeError(f"`columns` must be a list not {type(columns)}")
+
+    return _type_metadata(pq.read_table(parquet_path, columns=columns)).to_pandas()
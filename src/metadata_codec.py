@@ -0,0 +1,192 @@
+"""
+Contains a codec that dictionary-encodes the metadata columns of single-cell
+profiles.
+
+Phenotype labels, cell identifiers, plates and wells are strings repeated on every
+row. They are encoded once at load time into pandas categorical columns: integer
+codes and a dictionary of the distinct values, shared by all the profiles encoded by
+the same codec. Comparisons, grouping and pair finding then operate on the codes,
+and the dictionary is only used to decode the values at output (e.g. when writing
+CSV files).
+
+Since every profile encoded by a codec shares the same dictionaries, encoded
+profiles can be concatenated and compared without decoding them, and hashing an
+encoded column (`pd.util.hash_pandas_object()`) gives the same hashes as the values.
+"""
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+# metadata columns encoded by default
+CODED_COLUMNS = [
+    "Mitocheck_Phenotypic_Class",
+    "Cell_UUID",
+    "Metadata_Plate",
+    "Metadata_Well",
+]
+
+
+class MetadataCodec:
+    """Dictionaries of the encoded metadata columns
+
+    Parameters
+    ----------
+    categories : Dict[str, pd.Index]
+        distinct values of each encoded column, the code of a value is its position
+    """
+
+    def __init__(self, categories: Dict[str, pd.Index]):
+        self.dtypes = {
+            colname: pd.CategoricalDtype(col_categories)
+            for colname, col_categories in categories.items()
+        }
+
+    @classmethod
+    def fit(
+        cls,
+        profiles: Sequence[pd.DataFrame],
+        columns: Optional[List[str]] = None,
+    ) -> "MetadataCodec":
+        """Builds the dictionaries of the values found in a set of profiles. Values
+        are sorted, so codes follow the same order as the values.
+
+        Parameters
+        ----------
+        profiles : Sequence[pd.DataFrame]
+            profiles that will be encoded with the codec
+        columns : Optional[List[str]]
+            columns to encode, by default CODED_COLUMNS. Columns missing from all
+            the profiles are ignored.
+
+        Returns
+        -------
+        MetadataCodec
+            codec of the profiles
+        """
+        if columns is None:
+            columns = CODED_COLUMNS
+
+        categories = {}
+        for colname in columns:
+            col_values = [
+                pd.Series(profile[colname].unique()).dropna()
+                for profile in profiles
+                if colname in profile.columns
+            ]
+            if len(col_values) == 0:
+                continue
+            categories[colname] = pd.Index(
+                pd.concat(col_values, ignore_index=True).unique()
+            ).sort_values()
+
+        return cls(categories)
+
+    @property
+    def columns(self) -> List[str]:
+        """Names of the encoded columns"""
+        return list(self.dtypes)
+
+    def encode(self, profile: pd.DataFrame) -> pd.DataFrame:
+        """Encodes the metadata columns of a profile. Columns already encoded by
+        this codec are kept as they are.
+
+        Parameters
+        ----------
+        profile : pd.DataFrame
+            profile to encode, encoded columns missing from the profile are ignored
+
+        Returns
+        -------
+        pd.DataFrame
+            copy of the profile with categorical metadata columns
+
+        Raises
+        ------
+        ValueError
+            raised if a column contains values missing from the codec dictionary
+        """
+        encoded = profile.copy(deep=False)
+        for colname, dtype in self.dtypes.items():
+            if colname not in encoded.columns:
+                continue
+
+            col_values = encoded[colname]
+            unknown = ~col_values.isin(dtype.categories) & col_values.notna()
+            if unknown.any():
+                raise ValueError(
+                    f"{colname} contains values missing from the codec: "
+                    f"{col_values[unknown].unique()[:5].tolist()}"
+                )
+            encoded[colname] = col_values.astype(dtype)
+
+        return encoded
+
+    def decode(self, profile: pd.DataFrame) -> pd.DataFrame:
+        """Decodes the metadata columns of a profile back into their values
+
+        Parameters
+        ----------
+        profile : pd.DataFrame
+            encoded profile
+
+        Returns
+        -------
+        pd.DataFrame
+            copy of the profile with the original metadata values
+        """
+        decoded = profile.copy(deep=False)
+        for colname in self.dtypes:
+            if colname not in decoded.columns or not isinstance(
+                decoded[colname].dtype, pd.CategoricalDtype
+            ):
+                continue
+
+            # integer values with missing values are decoded as floats, like the
+            # values parsed by pandas
+            col_values = decoded[colname]
+            values_dtype = col_values.cat.categories.dtype
+            if values_dtype.kind in "iu" and col_values.isna().any():
+                values_dtype = np.float64
+            decoded[colname] = col_values.astype(values_dtype)
+
+        return decoded
+
+    def codes(self, profile: pd.DataFrame, colname: str) -> np.ndarray:
+        """Returns the integer codes of a column, missing values are coded as -1
+
+        Parameters
+        ----------
+        profile : pd.DataFrame
+            profile encoded with this codec
+        colname : str
+            encoded column
+
+        Returns
+        -------
+        np.ndarray
+            codes of the column
+        """
+        return profile[colname].astype(self.dtypes[colname]).cat.codes.to_numpy()
+
+    def code(self, colname: str, value) -> int:
+        """Returns the code of a single value
+
+        Parameters
+        ----------
+        colname : str
+            encoded column
+        value
+            value of the column
+
+        Returns
+        -------
+        int
+            code of the value
+
+        Raises
+        ------
+        KeyError
+            raised if the value is missing from the codec dictionary
+        """
+        return int(self.dtypes[colname].categories.get_loc(value))
@@ -0,0 +1,278 @@
+"""
+Contains indexes of the positive and negative pairs of a set of cells.
+
+Pairs follow the `sameby`/`diffby` rules of `average_precision.run_pipeline()`:
+a cell is paired with a query if it shares all the `sameby` values and differs in
+all the `diffby` values. An index is built once from the integer codes of the
+metadata of the selected cells and returns the pair masks of any batch of query
+cells, so the cells selected for a phenotype and a seed share the same index across
+feature spaces and shuffling modes.
+
+The mAP analysis compares the cells of a single phenotype with the same number of
+controls: positive pairs are the other cells of the same class and negative pairs
+are the cells of the other class. When the cells of each class are contiguous and
+the `diffby` columns of positive pairs (e.g. Cell_UUID) are unique, pairs only
+depend on the block of each cell. `BlockPairIndex` stores the bounds of the blocks
+and writes the masks as slices, without comparing any metadata. Other layouts use a
+`CodedPairIndex`, which compares the codes of the pair columns.
+
+As in copairs, cells with missing values in the pair columns are left out: they are
+never paired, so their average precision is NaN.
+"""
+import abc
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+def encode_columns(meta: pd.DataFrame, columns: List[str]) -> np.ndarray:
+    """Encodes metadata columns into integer codes, missing values are coded as -1.
+    Categorical columns (see `metadata_codec`) are already encoded, their codes are
+    used as they are.
+
+    Parameters
+    ----------
+    meta : pd.DataFrame
+        metadata dataframe
+    columns : List[str]
+        columns to encode
+
+    Returns
+    -------
+    np.ndarray
+        integer codes with shape (n_cells, len(columns))
+    """
+    codes = np.empty((meta.shape[0], len(columns)), dtype=np.int64)
+    for col_idx, colname in enumerate(columns):
+        if isinstance(meta[colname].dtype, pd.CategoricalDtype):
+            codes[:, col_idx] = meta[colname].cat.codes
+        else:
+            codes[:, col_idx] = pd.factorize(meta[colname])[0]
+    return codes
+
+
+def pair_mask(
+    sameby_codes: np.ndarray, diffby_codes: np.ndarray, rows: slice
+) -> np.ndarray:
+    """Generates a boolean mask of pairs for a batch of query cells. A cell is paired
+    with the query if it shares all the `sameby` values and differs in all the
+    `diffby` values. Cells are never paired with themselves, nor with a cell with
+    missing values (code -1) in these columns.
+
+    Parameters
+    ----------
+    sameby_codes : np.ndarray
+        integer codes of the `sameby` columns with shape (n_cells, n_sameby)
+    diffby_codes : np.ndarray
+        integer codes of the `diffby` columns with shape (n_cells, n_diffby)
+    rows : slice
+        query cells of the batch
+
+    Returns
+    -------
+    np.ndarray
+        boolean mask with shape (n_query_cells, n_cells)
+    """
+    n_cells = sameby_codes.shape[0]
+    query_idx = np.arange(n_cells)[rows]
+
+    valid = valid_cells(sameby_codes, diffby_codes)
+    mask = valid[query_idx, None] & valid[None, :]
+    for col_idx in range(sameby_codes.shape[1]):
+        col_codes = sameby_codes[:, col_idx]
+        mask &= col_codes[query_idx, None] == col_codes[None, :]
+    for col_idx in range(diffby_codes.shape[1]):
+        col_codes = diffby_codes[:, col_idx]
+        mask &= col_codes[query_idx, None] != col_codes[None, :]
+    mask[np.arange(len(query_idx)), query_idx] = False
+
+    return mask
+
+
+def valid_cells(*codes: np.ndarray) -> np.ndarray:
+    """Returns a boolean mask of the cells without missing values (code -1) in any
+    of the encoded columns
+
+    Parameters
+    ----------
+    *codes : np.ndarray
+        integer codes generated with `encode_columns()`, shape (n_cells, n_columns)
+
+    Returns
+    -------
+    np.ndarray
+        boolean mask with shape (n_cells,)
+    """
+    return np.logical_and.reduce([(col_codes >= 0).all(axis=1) for col_codes in codes])
+
+
+class PairIndex(abc.ABC):
+    """Positive and negative pairs of a set of cells, subclasses implement
+    `masks()`
+
+    Parameters
+    ----------
+    n_cells : int
+        number of cells
+    """
+
+    def __init__(self, n_cells: int):
+        self.n_cells = n_cells
+
+    @abc.abstractmethod
+    def masks(self, rows: slice) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the pairs of a batch of query cells
+
+        Parameters
+        ----------
+        rows : slice
+            query cells of the batch
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            boolean masks of the positive and negative pairs, with shape
+            (n_query_cells, n_cells). Negative pairs exclude the positive pairs.
+        """
+
+
+class CodedPairIndex(PairIndex):
+    """Pairs found by comparing the integer codes of the pair columns. Cells with
+    missing values in any pair column are never paired, as copairs drops them.
+
+    Parameters
+    ----------
+    meta : pd.DataFrame
+        metadata of the cells
+    pos_sameby : List[str]
+        columns that positive pairs share
+    pos_diffby : List[str]
+        columns in which positive pairs differ
+    neg_sameby : List[str]
+        columns that negative pairs share
+    neg_diffby : List[str]
+        columns in which negative pairs differ
+    """
+
+    def __init__(
+        self,
+        meta: pd.DataFrame,
+        pos_sameby: List[str],
+        pos_diffby: List[str],
+        neg_sameby: List[str],
+        neg_diffby: List[str],
+    ):
+        super().__init__(meta.shape[0])
+        self.pos_sameby_codes = encode_columns(meta, pos_sameby)
+        self.pos_diffby_codes = encode_columns(meta, pos_diffby)
+        self.neg_sameby_codes = encode_columns(meta, neg_sameby)
+        self.neg_diffby_codes = encode_columns(meta, neg_diffby)
+        self.valid = valid_cells(
+            self.pos_sameby_codes,
+            self.pos_diffby_codes,
+            self.neg_sameby_codes,
+            self.neg_diffby_codes,
+        )
+
+    def masks(self, rows: slice) -> Tuple[np.ndarray, np.ndarray]:
+        valid_pairs = self.valid[rows, None] & self.valid[None, :]
+        pos_mask = pair_mask(self.pos_sameby_codes, self.pos_diffby_codes, rows)
+        neg_mask = pair_mask(self.neg_sameby_codes, self.neg_diffby_codes, rows)
+        return pos_mask & valid_pairs, neg_mask & ~pos_mask & valid_pairs
+
+
+class BlockPairIndex(PairIndex):
+    """Pairs of cells sorted into contiguous blocks (e.g. a phenotype followed by
+    its controls): positive pairs are the other cells of the same block and negative
+    pairs are the cells of the other blocks
+
+    Parameters
+    ----------
+    block_bounds : np.ndarray
+        position of the first cell of every block followed by the number of cells,
+        shape (n_blocks + 1,)
+    """
+
+    def __init__(self, block_bounds: np.ndarray):
+        super().__init__(int(block_bounds[-1]))
+        self.block_bounds = np.asarray(block_bounds, dtype=np.int64)
+
+    def masks(self, rows: slice) -> Tuple[np.ndarray, np.ndarray]:
+        query_idx = np.arange(self.n_cells)[rows]
+        query_blocks = np.searchsorted(self.block_bounds, query_idx, side="right") - 1
+        diagonal = (np.arange(len(query_idx)), query_idx)
+
+        # query cells of the same block are contiguous, their pairs are filled as
+        # rectangular slices
+        pos_mask = np.zeros((len(query_idx), self.n_cells), dtype=bool)
+        for block in np.unique(query_blocks):
+            block_rows = np.flatnonzero(query_blocks == block)
+            pos_mask[
+                block_rows[0] : block_rows[-1] + 1,
+                self.block_bounds[block] : self.block_bounds[block + 1],
+            ] = True
+        pos_mask[diagonal] = False
+
+        neg_mask = ~pos_mask
+        neg_mask[diagonal] = False
+        return pos_mask, neg_mask
+
+
+def build_pair_index(
+    meta: pd.DataFrame,
+    pos_sameby: List[str],
+    pos_diffby: List[str],
+    neg_sameby: List[str],
+    neg_diffby: List[str],
+) -> PairIndex:
+    """Indexes the pairs of a set of cells. The closed-form `BlockPairIndex` is used
+    when positive pairs share a single label column and differ in unique columns,
+    negative pairs differ in the same label, the cells of every label are
+    contiguous and no pair column has missing values. Otherwise, a `CodedPairIndex`
+    is returned.
+
+    Parameters
+    ----------
+    meta : pd.DataFrame
+        metadata of the cells, in the same order as the similarities
+    pos_sameby : List[str]
+        columns that positive pairs share
+    pos_diffby : List[str]
+        columns in which positive pairs differ
+    neg_sameby : List[str]
+        columns that negative pairs share
+    neg_diffby : List[str]
+        columns in which negative pairs differ
+
+    Returns
+    -------
+    PairIndex
+        index of the pairs
+    """
+    is_block_layout = (
+        len(pos_sameby) == 1
+        and list(neg_diffby) == list(pos_sameby)
+        and len(neg_sameby) == 0
+        and meta.shape[0] > 0
+    )
+    if is_block_layout:
+        label_codes = encode_columns(meta, pos_sameby)
+        diffby_codes = encode_columns(meta, pos_diffby)
+        is_complete = valid_cells(label_codes, diffby_codes).all()
+        label_codes = label_codes[:, 0]
+
+        # every cell differs from the others in all the positive diffby columns, so
+        # these columns only exclude the query cell itself
+        is_unique = all(
+            np.unique(col_codes).shape[0] == meta.shape[0]
+            for col_codes in diffby_codes.T
+        )
+
+        # labels are contiguous if they only change at block boundaries
+        block_starts = np.flatnonzero(np.diff(label_codes)) + 1
+        is_contiguous = block_starts.shape[0] == np.unique(label_codes).shape[0] - 1
+        if is_complete and is_unique and is_contiguous:
+            return BlockPairIndex(np.concatenate([[0], block_starts, [meta.shape[0]]]))
+
+    return CodedPairIndex(meta, pos_sameby, pos_diffby, neg_sameby, neg_diffby)
@@ -0,0 +1,82 @@
+"""
+Contains functions to resample the negative control cells matched to each phenotype.
+
+The controls of every seed are drawn once as integer position arrays, following the
+same draws as `pd.DataFrame.sample(frac=frac, random_state=seed)`. Each phenotype
+then selects the first `n` positions of a seed, so all the shuffling modes and
+feature spaces of a seed use exactly the same control cells and rows are gathered
+directly from the feature matrices without sampling the control dataframe again.
+"""
+from typing import Sequence, Tuple
+
+import numpy as np
+
+
+def sample_positions(n_rows: int, frac: float, seed: int) -> np.ndarray:
+    """Draws random row positions without replacement. Returns the same rows as
+    `pd.DataFrame.sample(frac=frac, random_state=seed)` on a dataframe with
+    `n_rows` rows.
+
+    Parameters
+    ----------
+    n_rows : int
+        number of rows to sample from
+    frac : float
+        fraction of rows to draw
+    seed : int
+        random seed
+
+    Returns
+    -------
+    np.ndarray
+        positions of the drawn rows, in the order they were drawn
+    """
+    random_state = np.random.RandomState(seed)
+    return random_state.choice(n_rows, size=round(frac * n_rows), replace=False)
+
+
+def draw_controls(
+    n_controls: int, seeds: Sequence[int], n_entries: int, frac: float = 0.010
+) -> np.ndarray:
+    """Draws the control cells of every seed. The controls matched to a phenotype
+    with `n` cells are the first `n` positions of the seed.
+
+    Parameters
+    ----------
+    n_controls : int
+        number of control cells
+    seeds : Sequence[int]
+        random seeds, one per resample
+    n_entries : int
+        largest number of controls selected per seed (size of the largest phenotype)
+    frac : float, optional
+        fraction of the control cells that is drawn, by default 0.010
+
+    Returns
+    -------
+    np.ndarray
+        positions of the drawn controls, shape (len(seeds), n_entries). Rows follow
+        the order of `seeds`. As with `.iloc[:n_entries]`, fewer columns are
+        returned if `frac` of the controls is less than `n_entries` cells.
+    """
+    draws = [sample_positions(n_controls, frac, seed)[:n_entries] for seed in seeds]
+    return np.stack(draws)
+
+
+def control_pool(draws: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the control cells that can be selected by any of the draws, and the
+    positions of the draws within this pool of cells
+
+    Parameters
+    ----------
+    draws : np.ndarray
+        control positions generated with `draw_controls()`
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        sorted positions of the pool control cells, and the positions of the draws
+        within the pool with the same shape as `draws`
+    """
+    pool_positions, pool_draws = np.unique(draws, return_inverse=True)
+    return pool_positions, pool_draws.reshape(draws.shape)
@@ -0,0 +1,326 @@
+"""
+Contains a resumable store of the mAP analysis results.
+
+The result of every phenotype, seed, feature space and shuffling mode is written as
+a partition of a parquet dataset as soon as its job finishes:
+
+    {store_dir}/feature_space={...}/shuffle_mode={...}/phenotype={...}/seed={...}/
+
+Each partition directory contains the results (`part.parquet`) and a `_SUCCESS`
+marker written once all the results of the job are stored. Modes without results
+(e.g. phenotypes without positive pairs) only contain the marker. Partitions are
+written into temporary files first, so a crash never leaves a partial partition
+behind. When a run is restarted, jobs whose partitions are all complete are skipped.
+
+The marker holds a fingerprint of the rows and columns used by the job (see
+`job_fingerprint()`). Jobs are only skipped if their fingerprint is unchanged, so
+when phenotypes, seeds or cells are added only the new jobs and the jobs whose input
+rows have changed are computed, and they are merged with the stored results.
+
+Results are never held in memory for the whole grid: the final CSV files are
+written by appending the partitions one at a time in the order of a sequential run.
+
+Metadata encoded by `metadata_codec` is stored as dictionary-encoded columns, each
+partition only keeps the values used by its own rows. Values are decoded when the
+CSV files are written.
+"""
+import hashlib
+import pathlib
+from typing import Dict, Iterator, List, Optional, Sequence, Union
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+from .scheduler import MapJob
+
+# name of the file marking a complete partition
+SUCCESS_MARKER = "_SUCCESS"
+
+
+def row_hashes(values: Union[np.ndarray, pd.DataFrame]) -> np.ndarray:
+    """Hashes every row of a feature matrix or a metadata dataframe
+
+    Parameters
+    ----------
+    values : Union[np.ndarray, pd.DataFrame]
+        2D array or dataframe
+
+    Returns
+    -------
+    np.ndarray
+        uint64 hash of each row
+    """
+    if isinstance(values, np.ndarray):
+        values = pd.DataFrame(values)
+    return pd.util.hash_pandas_object(values, index=False).to_numpy()
+
+
+def job_fingerprint(
+    hashes: Sequence[np.ndarray], columns: Sequence[str], **params
+) -> str:
+    """Fingerprints the input of a job from the hashes of its rows and the names of
+    its columns
+
+    Parameters
+    ----------
+    hashes : Sequence[np.ndarray]
+        row hashes of each input block (e.g. metadata and feature blocks), in the
+        order the rows are used by the job
+    columns : Sequence[str]
+        names of the columns used by the job
+    **params
+        additional parameters of the job
+
+    Returns
+    -------
+    str
+        hexadecimal sha256 digest
+    """
+    digest = hashlib.sha256()
+    for block_hashes in hashes:
+        digest.update(np.ascontiguousarray(block_hashes, dtype=np.uint64).tobytes())
+    digest.update("\0".join(columns).encode())
+    digest.update(repr(sorted(params.items())).encode())
+    return digest.hexdigest()
+
+
+def _remove_unused_categories(results: pd.DataFrame) -> pd.DataFrame:
+    """Removes the categories that are not used by the rows of categorical columns,
+    so the dictionaries stored within a partition stay small
+    """
+    categorical_cols = [
+        colname
+        for colname in results.columns
+        if isinstance(results[colname].dtype, pd.CategoricalDtype)
+    ]
+    if len(categorical_cols) == 0:
+        return results
+
+    results = results.copy()
+    for colname in categorical_cols:
+        results[colname] = results[colname].cat.remove_unused_categories()
+    return results
+
+
+class ResultsStore:
+    """Parquet dataset of mAP results partitioned by feature space, shuffling mode,
+    phenotype and seed
+
+    Parameters
+    ----------
+    store_dir : Union[str, pathlib.Path]
+        directory of the parquet dataset
+    """
+
+    def __init__(self, store_dir: Union[str, pathlib.Path]):
+        self.store_dir = pathlib.Path(store_dir)
+
+    def partition_dir(self, job: MapJob, mode: str) -> pathlib.Path:
+        """Returns the partition directory of a job and a shuffling mode
+
+        Parameters
+        ----------
+        job : MapJob
+            job of the analysis grid
+        mode : str
+            shuffling mode
+
+        Returns
+        -------
+        pathlib.Path
+            partition directory
+        """
+        return (
+            self.store_dir
+            / f"feature_space={quote(job.feature_space, safe='')}"
+            / f"shuffle_mode={quote(mode, safe='')}"
+            / f"phenotype={quote(str(job.phenotype), safe='')}"
+            / f"seed={job.seed}"
+        )
+
+    def is_complete(self, job: MapJob, fingerprint: Optional[str] = None) -> bool:
+        """Checks whether the results of all the shuffling modes of a job are stored
+
+        Parameters
+        ----------
+        job : MapJob
+            job of the analysis grid
+        fingerprint : Optional[str]
+            fingerprint of the job input. If provided, stored results generated
+            from a different input are not complete.
+
+        Returns
+        -------
+        bool
+            True if the job does not need to be computed again
+        """
+        for mode in job.modes:
+            marker_path = self.partition_dir(job, mode) / SUCCESS_MARKER
+            if not marker_path.is_file():
+                return False
+            if fingerprint is not None and marker_path.read_text() != fingerprint:
+                return False
+
+        return True
+
+    def pending_jobs(
+        self,
+        jobs: Sequence[MapJob],
+        fingerprints: Optional[Dict[MapJob, str]] = None,
+    ) -> List[MapJob]:
+        """Returns the jobs that are not stored, or whose input has changed
+
+        Parameters
+        ----------
+        jobs : Sequence[MapJob]
+            jobs of the analysis grid
+        fingerprints : Optional[Dict[MapJob, str]]
+            fingerprint of the input of each job
+
+        Returns
+        -------
+        List[MapJob]
+            jobs to compute, in the same order as `jobs`
+        """
+        fingerprints = fingerprints or {}
+        return [job for job in jobs if not self.is_complete(job, fingerprints.get(job))]
+
+    def add(
+        self,
+        job: MapJob,
+        job_results: Dict[str, pd.DataFrame],
+        fingerprint: Optional[str] = None,
+    ) -> None:
+        """Writes the results of a finished job, one partition per shuffling mode
+
+        Parameters
+        ----------
+        job : MapJob
+            finished job
+        job_results : Dict[str, pd.DataFrame]
+            results of the job for each shuffling mode. Modes of the job missing from
+            `job_results` are marked as complete without results.
+        fingerprint : Optional[str]
+            fingerprint of the job input, stored in the partition markers
+        """
+        for mode in job.modes:
+            partition_dir = self.partition_dir(job, mode)
+            partition_dir.mkdir(parents=True, exist_ok=True)
+
+            # removing the results of an interrupted write of the same partition
+            (partition_dir / SUCCESS_MARKER).unlink(missing_ok=True)
+            (partition_dir / "part.parquet").unlink(missing_ok=True)
+
+            if mode in job_results:
+                tmp_path = partition_dir / "part.parquet.tmp"
+                _remove_unused_categories(job_results[mode]).to_parquet(
+                    tmp_path, index=False
+                )
+                tmp_path.replace(partition_dir / "part.parquet")
+
+            (partition_dir / SUCCESS_MARKER).write_text(fingerprint or "")
+
+    def iter_results(
+        self, feature_space: str, mode: str, jobs: Sequence[MapJob]
+    ) -> Iterator[pd.DataFrame]:
+        """Yields the stored results of a feature space and a shuffling mode in the
+        order of a sequential run
+
+        Parameters
+        ----------
+        feature_space : str
+            feature space, can be "CP", "DP" or "CP_and_DP"
+        mode : str
+            shuffling mode
+        jobs : Sequence[MapJob]
+            jobs of the analysis grid, generated with `scheduler.expand_grid()`
+
+        Yields
+        ------
+        pd.DataFrame
+            results of a single phenotype and seed
+        """
+        selected_jobs = [
+            job
+            for job in jobs
+            if job.feature_space == feature_space and mode in job.modes
+        ]
+        for job in sorted(selected_jobs, key=lambda job: job.order):
+            part_path = self.partition_dir(job, mode) / "part.parquet"
+            if part_path.is_file():
+                yield pd.read_parquet(part_path)
+
+    def results(
+        self, feature_space: str, mode: str, jobs: Sequence[MapJob]
+    ) -> pd.DataFrame:
+        """Returns the concatenated results of a feature space and a shuffling mode
+
+        Parameters
+        ----------
+        feature_space : str
+            feature space, can be "CP", "DP" or "CP_and_DP"
+        mode : str
+            shuffling mode
+        jobs : Sequence[MapJob]
+            jobs of the analysis grid, generated with `scheduler.expand_grid()`
+
+        Returns
+        -------
+        pd.DataFrame
+            concatenated results
+
+        Raises
+        ------
+        ValueError
+            raised if no results are stored
+        """
+        stored_results = list(self.iter_results(feature_space, mode, jobs))
+        if len(stored_results) == 0:
+            raise ValueError(f"no results stored for {feature_space} {mode}")
+
+        return pd.concat(stored_results, ignore_index=True)
+
+    def to_csv(
+        self,
+        csv_path: Union[str, pathlib.Path],
+        feature_space: str,
+        mode: str,
+        jobs: Sequence[MapJob],
+    ) -> None:
+        """Writes the results of a feature space and a shuffling mode into a CSV file.
+        Partitions are appended one at a time, so the results are never all loaded
+        in memory.
+
+        Parameters
+        ----------
+        csv_path : Union[str, pathlib.Path]
+            path of the CSV file
+        feature_space : str
+            feature space, can be "CP", "DP" or "CP_and_DP"
+        mode : str
+            shuffling mode
+        jobs : Sequence[MapJob]
+            jobs of the analysis grid, generated with `scheduler.expand_grid()`
+
+        Raises
+        ------
+        ValueError
+            raised if no results are stored
+        """
+        csv_path = pathlib.Path(csv_path)
+        tmp_path = csv_path.with_name(f"{csv_path.name}.tmp")
+
+        n_partitions = 0
+        for result in self.iter_results(feature_space, mode, jobs):
+            result.to_csv(
+                tmp_path,
+                index=False,
+                mode="w" if n_partitions == 0 else "a",
+                header=n_partitions == 0,
+            )
+            n_partitions += 1
+
+        if n_partitions == 0:
+            raise ValueError(f"no results stored for {feature_space} {mode}")
+        tmp_path.replace(csv_path)
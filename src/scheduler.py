@@ -0,0 +1,192 @@
+"""
+Contains functions to run the mAP analysis grid (phenotypes x seeds x feature spaces
+x shuffling modes) as independent jobs on a process pool.
+
+Every job computes the results of a single phenotype, seed and feature space. Modes
+that share the same similarities are grouped into a single job: the regular run and
+the shuffled phenotype labels run reuse the same rank lists, therefore they are
+never split into separate jobs. Jobs are sent to the workers from the largest
+phenotype to the smallest one, so the most expensive jobs do not finish last.
+
+Workers are forked from the main process, so large objects that are created before
+the pool is started (profiles, similarity caches) are shared with all the workers
+instead of being copied to each job. Results of finished jobs are written into a
+`results_store.ResultsStore` as soon as they are received, and jobs already stored
+by a previous (interrupted) run are skipped.
+"""
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import pandas as pd
+
+if TYPE_CHECKING:
+    from .results_store import ResultsStore
+
+# shuffling modes that are computed within the same job
+MODE_GROUPS = (("non-shuffled", "phenotype_shuffled"), ("features_shuffled",))
+
+
+@dataclass(frozen=True)
+class MapJob:
+    """Single job of the mAP analysis grid
+
+    Parameters
+    ----------
+    phenotype : str
+        selected phenotype
+    seed : int
+        seed used to resample the controls
+    feature_space : str
+        feature space, can be "CP", "DP" or "CP_and_DP"
+    modes : Tuple[str, ...]
+        shuffling modes computed by the job
+    n_cells : int
+        number of training cells of the phenotype, used to schedule larger jobs first
+    order : int
+        position of the job in a sequential run, used to order the results
+    """
+
+    phenotype: str
+    seed: int
+    feature_space: str
+    modes: Tuple[str, ...]
+    n_cells: int
+    order: int
+
+
+def expand_grid(
+    phenotype_sizes: Dict[str, int],
+    seeds: Sequence[int],
+    feature_spaces: Sequence[str],
+    modes: Sequence[str],
+) -> List[MapJob]:
+    """Expands the analysis grid into independent jobs sorted from the largest to the
+    smallest phenotype.
+
+    Parameters
+    ----------
+    phenotype_sizes : Dict[str, int]
+        number of training cells of each phenotype, in the order of a sequential run
+    seeds : Sequence[int]
+        seeds used to resample the controls
+    feature_spaces : Sequence[str]
+        feature spaces, "CP", "DP" or "CP_and_DP"
+    modes : Sequence[str]
+        shuffling modes, "non-shuffled", "phenotype_shuffled" or "features_shuffled"
+
+    Returns
+    -------
+    List[MapJob]
+        jobs in scheduling order
+
+    Raises
+    ------
+    ValueError
+        raised if an unknown shuffling mode is provided
+    """
+    known_modes = {mode for group in MODE_GROUPS for mode in group}
+    unknown_modes = set(modes) - known_modes
+    if len(unknown_modes) > 0:
+        raise ValueError(f"unknown shuffling modes: {sorted(unknown_modes)}")
+
+    # modes of the same group are computed by the same job
+    mode_groups = [
+        tuple(mode for mode in group if mode in modes) for group in MODE_GROUPS
+    ]
+    mode_groups = [group for group in mode_groups if len(group) > 0]
+
+    jobs = []
+    for mode_group in mode_groups:
+        for phenotype, n_cells in phenotype_sizes.items():
+            for seed in seeds:
+                for feature_space in feature_spaces:
+                    jobs.append(
+                        MapJob(
+                            phenotype=phenotype,
+                            seed=seed,
+                            feature_space=feature_space,
+                            modes=mode_group,
+                            n_cells=n_cells,
+                            order=len(jobs),
+                        )
+                    )
+
+    # stable sort, jobs of the same size keep their sequential order
+    return sorted(jobs, key=lambda job: job.n_cells, reverse=True)
+
+
+def run_jobs(
+    jobs: Sequence[MapJob],
+    job_fn: Callable[[MapJob], Dict[str, pd.DataFrame]],
+    store: "ResultsStore",
+    n_workers: Optional[int] = None,
+    fingerprints: Optional[Dict[MapJob, str]] = None,
+) -> "ResultsStore":
+    """Runs jobs on a pool of forked worker processes and writes their results into
+    a results store. Jobs that are already complete in the store are skipped, unless
+    their input fingerprint has changed.
+
+    Parameters
+    ----------
+    jobs : Sequence[MapJob]
+        jobs in scheduling order, generated with `expand_grid()`
+    job_fn : Callable[[MapJob], Dict[str, pd.DataFrame]]
+        function that computes a job and returns its result for each shuffling mode.
+        Must be defined at the top level of a module or notebook.
+    store : ResultsStore
+        store where the results are written
+    n_workers : Optional[int]
+        number of worker processes, by default all CPUs. If 1, jobs are computed
+        within the main process.
+    fingerprints : Optional[Dict[MapJob, str]]
+        fingerprint of the input of each job, generated with
+        `results_store.job_fingerprint()`
+
+    Returns
+    -------
+    ResultsStore
+        store containing the results of all jobs
+    """
+    fingerprints = fingerprints or {}
+    pending_jobs = store.pending_jobs(jobs, fingerprints)
+    if len(pending_jobs) < len(jobs):
+        logging.info(f"Skipping {len(jobs) - len(pending_jobs)} stored jobs")
+
+    for job, job_results in _iter_results(pending_jobs, job_fn, n_workers):
+        logging.info(
+            f"Finished job: {job.phenotype} seed {job.seed} {job.feature_space}"
+        )
+        store.add(job, job_results, fingerprints.get(job))
+
+    return store
+
+
+def _iter_results(
+    jobs: Sequence[MapJob],
+    job_fn: Callable[[MapJob], Dict[str, pd.DataFrame]],
+    n_workers: Optional[int] = None,
+) -> Iterator[Tuple[MapJob, Dict[str, pd.DataFrame]]]:
+    """Yields the results of the jobs as they finish"""
+    if n_workers == 1:
+        for job in jobs:
+            yield job, job_fn(job)
+        return
+
+    # forking shares the objects of the main process with all workers
+    mp_context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context) as pool:
+        futures = {pool.submit(job_fn, job): job for job in jobs}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
@@ -0,0 +1,127 @@
+"""
+Contains grouped statistics of single-cell scores: sampling errors and bootstrap
+confidence intervals of the mean scores.
+
+Both statistics are computed for all groups at once. Bootstrap resamples are drawn
+as a single matrix of random positions per batch of resamples: every position draws
+a random position within its own group, and the means of all groups and resamples
+are computed with one reduction. The tables returned have one row per group with the
+group columns, so they can be merged with the mAP scores.
+"""
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+
+# largest number of values drawn per batch of bootstrap resamples
+BOOTSTRAP_BATCH_VALUES = 2**24
+
+
+def sampling_error(
+    profile: pd.DataFrame, by: Sequence[str], score_col: str = "average_precision"
+) -> pd.DataFrame:
+    """Computes the sampling error (standard error of the mean, with the population
+    standard deviation) of the scores of each group
+
+    Parameters
+    ----------
+    profile : pd.DataFrame
+        single-cell scores
+    by : Sequence[str]
+        columns used to group rows
+    score_col : str, optional
+        score column, by default "average_precision"
+
+    Returns
+    -------
+    pd.DataFrame
+        group columns and "sampling_error", one row per group
+    """
+    grouped = profile.groupby(list(by), sort=True, observed=True)[score_col]
+    errors = grouped.std(ddof=0) / np.sqrt(grouped.count())
+
+    return errors.rename("sampling_error").reset_index()
+
+
+def bootstrap_ci(
+    profile: pd.DataFrame,
+    by: Sequence[str],
+    score_col: str = "average_precision",
+    n_resamples: int = 1000,
+    confidence: float = 0.95,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Computes percentile bootstrap confidence intervals of the mean score of each
+    group. The rows of each group are resampled with replacement `n_resamples`
+    times.
+
+    Parameters
+    ----------
+    profile : pd.DataFrame
+        single-cell scores
+    by : Sequence[str]
+        columns used to group rows
+    score_col : str, optional
+        score column, by default "average_precision"
+    n_resamples : int, optional
+        number of bootstrap resamples, by default 1000
+    confidence : float, optional
+        confidence level of the intervals, by default 0.95
+    seed : int, optional
+        random seed, by default 0
+
+    Returns
+    -------
+    pd.DataFrame
+        group columns, "ci_low" and "ci_high", one row per group. Intervals of groups
+        without scores are NaN.
+
+    Raises
+    ------
+    ValueError
+        raised if `confidence` is not between 0 and 1
+    """
+    if not 0 < confidence < 1:
+        raise ValueError("'confidence' must be between 0 and 1")
+
+    grouped = profile.groupby(list(by), sort=True, observed=True)
+    n_groups = grouped.ngroups
+    group_ids = grouped.ngroup().to_numpy()
+    scores = profile[score_col].to_numpy(dtype=np.float64)
+
+    # scores sorted by group, missing scores and keys are dropped
+    is_valid = (group_ids >= 0) & ~np.isnan(scores)
+    order = np.argsort(group_ids[is_valid], kind="stable")
+    scores = scores[is_valid][order]
+    score_groups = group_ids[is_valid][order].astype(np.intp)
+
+    group_sizes = np.bincount(score_groups, minlength=n_groups)
+    group_starts = np.concatenate([[0], np.cumsum(group_sizes)[:-1]])
+    has_scores = group_sizes > 0
+
+    # means of every resample and group, positions of each batch are drawn at once
+    rng = np.random.default_rng(seed)
+    boot_means = np.full((n_resamples, n_groups), np.nan)
+    batch_size = max(1, BOOTSTRAP_BATCH_VALUES // max(scores.shape[0], 1))
+    for batch_start in range(0, n_resamples, batch_size):
+        batch_end = min(batch_start + batch_size, n_resamples)
+        draws = group_starts[score_groups] + rng.integers(
+            0,
+            group_sizes[score_groups],
+            size=(batch_end - batch_start, scores.shape[0]),
+        )
+        if scores.shape[0] > 0:
+            group_sums = np.add.reduceat(
+                scores[draws], group_starts[has_scores], axis=1
+            )
+            boot_means[batch_start:batch_end, has_scores] = (
+                group_sums / group_sizes[has_scores]
+            )
+
+    alpha = (1 - confidence) / 2
+    ci_low, ci_high = np.quantile(boot_means, [alpha, 1 - alpha], axis=0)
+
+    intervals = grouped.size().index.to_frame(index=False)
+    intervals["ci_low"] = ci_low
+    intervals["ci_high"] = ci_high
+    return intervals
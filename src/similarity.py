@@ -0,0 +1,233 @@
+"""
+Contains functions to compute cosine similarities between single-cell profiles.
+
+`BlockSimilarityCache` stores the raw dot products and squared norms of each feature
+block (CP and DP) of a pool of cells (e.g. all the training cells and the control
+cells that can be selected when resampling). The similarity matrix of a resampled
+dataset is then assembled from a sub-block of the pool dot products, therefore dot
+products are computed only once and reused across phenotypes and seeds. The cosine
+similarity of any combination of blocks is assembled by adding the parts of each
+block, so the CP_and_DP similarities are derived from the CP and DP parts without
+another product over the wide matrix.
+When a `FeatureStore` is provided, the dot products are kept in memory-mapped files
+that are shared by all worker processes.
+
+Similarities are float64 by default, so cells with close similarities are ranked
+at full precision. float32 similarities halve the memory of the stored dot products
+and are ranked faster by `average_precision.rank_lists()`, but similarities that
+only differ beyond float32 precision become ties.
+"""
+from typing import Dict, Optional
+
+import numpy as np
+
+from .feature_store import FeatureStore
+
+# feature blocks that form each feature space
+DATASET_BLOCKS = {"CP": ("CP",), "DP": ("DP",), "CP_and_DP": ("CP", "DP")}
+
+
+def l2_normalize(feats: np.ndarray) -> np.ndarray:
+    """Scales each row of a feature matrix to unit length
+
+    Parameters
+    ----------
+    feats : np.ndarray
+        feature matrix with shape (n_cells, n_features)
+
+    Returns
+    -------
+    np.ndarray
+        C ordered matrix with unit length rows
+    """
+    if not isinstance(feats, np.ndarray):
+        raise TypeError("'feats' must be a numpy array")
+    if feats.ndim != 2:
+        raise TypeError("'feats' must be a 2D matrix")
+
+    # cells without any feature value have an undefined (NaN) similarity
+    with np.errstate(invalid="ignore", divide="ignore"):
+        norms = np.linalg.norm(feats, axis=1, keepdims=True)
+        return np.ascontiguousarray(feats / norms)
+
+
+def batched_dot(
+    x_feats: np.ndarray,
+    y_feats: np.ndarray,
+    batch_size: int = 4096,
+    dtype: str = "float64",
+) -> np.ndarray:
+    """Computes the dot products between the rows of two matrices. The product is
+    computed in row batches to bound the size of temporary arrays.
+
+    Parameters
+    ----------
+    x_feats : np.ndarray
+        matrix with shape (n_cells_x, n_features)
+    y_feats : np.ndarray
+        matrix with shape (n_cells_y, n_features)
+    batch_size : int, optional
+        number of rows computed per batch, by default 4096
+    dtype : str, optional
+        type of the dot products, by default "float64"
+
+    Returns
+    -------
+    np.ndarray
+        matrix of dot products with shape (n_cells_x, n_cells_y)
+    """
+    dots = np.empty((x_feats.shape[0], y_feats.shape[0]), dtype=dtype)
+    for start in range(0, x_feats.shape[0], batch_size):
+        end = start + batch_size
+        dots[start:end] = x_feats[start:end] @ y_feats.T
+
+    return dots
+
+
+def cosine_similarity(
+    feats: np.ndarray, batch_size: int = 4096, dtype: str = "float64"
+) -> np.ndarray:
+    """Computes the cosine similarity between all the cells of a feature matrix
+
+    Parameters
+    ----------
+    feats : np.ndarray
+        feature matrix with shape (n_cells, n_features)
+    batch_size : int, optional
+        number of rows computed per batch, by default 4096
+    dtype : str, optional
+        type of the similarities, by default "float64"
+
+    Returns
+    -------
+    np.ndarray
+        similarity matrix with shape (n_cells, n_cells)
+    """
+    normalized_feats = l2_normalize(feats)
+    return batched_dot(
+        normalized_feats, normalized_feats, batch_size=batch_size, dtype=dtype
+    )
+
+
+class BlockSimilarityCache:
+    """Cosine similarities between all the cells of a pool of cells for every
+    combination of feature blocks.
+
+    For each feature block, the raw dot products between all the cells and the
+    squared norm of each cell are stored. The cosine similarity of a feature space
+    made of multiple blocks is then
+
+        sum(dots) / sqrt(sum(squared norms of x) * sum(squared norms of y))
+
+    which is equal to the cosine similarity of the concatenated blocks. The dot
+    products of the whole pool are computed on first access. If the pool is larger
+    than `max_cells`, they are never stored and the dot products of each subset are
+    computed from the features instead.
+
+    Parameters
+    ----------
+    blocks : Dict[str, np.ndarray]
+        feature matrix of each block, all with shape (n_cells, n_block_features).
+        Blocks are named after the feature spaces in `DATASET_BLOCKS` ("CP", "DP").
+    max_cells : int, optional
+        largest pool for which the dot products are stored, by default 20000
+    batch_size : int, optional
+        number of rows computed per batch, by default 4096
+    store : Optional[FeatureStore]
+        store where the dot products are saved, named "{block}_dots". If None, the
+        dot products are kept in memory.
+    dtype : str, optional
+        type of the stored dot products and of the returned similarities, by
+        default "float64". "float32" halves the memory of the dot products but
+        similarities closer than float32 precision become ties.
+    """
+
+    def __init__(
+        self,
+        blocks: Dict[str, np.ndarray],
+        max_cells: int = 20000,
+        batch_size: int = 4096,
+        store: Optional[FeatureStore] = None,
+        dtype: str = "float64",
+    ):
+        if not isinstance(blocks, dict):
+            raise TypeError("'blocks' must be a dictionary of numpy arrays")
+        if len({feats.shape[0] for feats in blocks.values()}) != 1:
+            raise ValueError("all blocks must have the same number of cells")
+
+        self.blocks = blocks
+        self.max_cells = max_cells
+        self.batch_size = batch_size
+        self.store = store
+        self.dtype = dtype
+        self.sq_norms = {
+            name: np.einsum("ij,ij->i", feats, feats) for name, feats in blocks.items()
+        }
+        self._dots = {}
+
+    @property
+    def n_cells(self) -> int:
+        """Number of cells in the pool"""
+        return next(iter(self.blocks.values())).shape[0]
+
+    def dots(self, block: str) -> np.ndarray:
+        """Dot products between all the cells of the pool for a single block,
+        computed on first access"""
+        if block not in self._dots:
+            if self.store is not None and f"{block}_dots" in self.store:
+                self._dots[block] = self.store.load(f"{block}_dots")
+                return self._dots[block]
+
+            feats = self.blocks[block]
+            dots = batched_dot(
+                feats, feats, batch_size=self.batch_size, dtype=self.dtype
+            )
+            if self.store is not None:
+                dots = self.store.save(f"{block}_dots", dots)
+            self._dots[block] = dots
+        return self._dots[block]
+
+    def precompute(self) -> None:
+        """Computes the dot products of all blocks. Used before forking worker
+        processes, so the stored dot products are shared by all workers instead of
+        being computed by each of them."""
+        if self.n_cells <= self.max_cells:
+            for block in self.blocks:
+                self.dots(block)
+
+    def submatrix(self, idx: np.ndarray, dataset: str = "CP_and_DP") -> np.ndarray:
+        """Returns the similarity matrix of a subset of cells of the pool
+
+        Parameters
+        ----------
+        idx : np.ndarray
+            positions of the selected cells within the pool. The rows and columns of
+            the returned matrix follow the same order.
+        dataset : str, optional
+            feature space, can be "CP" or "DP" or by default "CP_and_DP"
+
+        Returns
+        -------
+        np.ndarray
+            similarity matrix with shape (len(idx), len(idx)) and type `dtype`
+        """
+        if dataset not in DATASET_BLOCKS:
+            raise ValueError(
+                f"`dataset` must be 'CP', 'DP' or 'CP_and_DP' not {dataset}"
+            )
+        idx = np.asarray(idx, dtype=np.intp)
+
+        # adding the parts of each block
+        dots = np.zeros((len(idx), len(idx)), dtype=np.float64)
+        sq_norms = np.zeros(len(idx), dtype=np.float64)
+        for block in DATASET_BLOCKS[dataset]:
+            if self.n_cells <= self.max_cells:
+                dots += self.dots(block)[np.ix_(idx, idx)]
+            else:
+                selected_feats = self.blocks[block][idx]
+                dots += selected_feats @ selected_feats.T
+            sq_norms += self.sq_norms[block][idx]
+
+        norms = np.sqrt(sq_norms)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (dots / np.outer(norms, norms)).astype(self.dtype, copy=False)
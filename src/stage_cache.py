@@ -0,0 +1,195 @@
+"""
+Contains a content-addressed cache for the stages of the analysis.
+
+The analysis is a chain of stages (load, feature selection, mAP pipeline, per cell
+aggregation, mAP aggregation, plots). Each stage is identified by a key hashed from
+its name, its parameters and the keys of its inputs:
+
+- input files are identified by their name, size and modification time
+- input stages are identified by their own key
+
+Since the key of a stage depends on the keys of its inputs, changing a parameter or
+an input file only changes the keys (and recomputes the artefacts) of the stages
+that depend on it. Artefacts of all the computed keys are kept, so switching back to
+previous parameters reuses the artefacts computed with them.
+
+Artefacts are either pickled values returned by the stage (`StageCache.run()`) or
+directories filled by the stage itself (`StageCache.stage_dir()`), e.g. the
+partitioned results of `results_store.ResultsStore`.
+"""
+import hashlib
+import json
+import logging
+import pathlib
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Sequence, Union
+
+import pandas as pd
+
+
+@dataclass(frozen=True)
+class StageResult:
+    """Artefact of a stage
+
+    Parameters
+    ----------
+    name : str
+        name of the stage
+    key : str
+        content hash of the stage parameters and inputs
+    value : Any
+        artefact generated by the stage
+    """
+
+    name: str
+    key: str
+    value: Any
+
+
+def file_key(file_path: Union[str, pathlib.Path]) -> str:
+    """Identifies a file by its name, size and modification time
+
+    Parameters
+    ----------
+    file_path : Union[str, pathlib.Path]
+        path to the file
+
+    Returns
+    -------
+    str
+        file identifier
+    """
+    file_path = pathlib.Path(file_path)
+    stat = file_path.stat()
+    return f"{file_path.name}_{stat.st_size}_{stat.st_mtime_ns}"
+
+
+class StageCache:
+    """Stores the artefacts of the analysis stages keyed by their content hash
+
+    Parameters
+    ----------
+    cache_dir : Union[str, pathlib.Path]
+        directory where the artefacts are stored
+    """
+
+    def __init__(self, cache_dir: Union[str, pathlib.Path]):
+        self.cache_dir = pathlib.Path(cache_dir)
+
+    def key(
+        self,
+        name: str,
+        params: Optional[Dict[str, Any]] = None,
+        inputs: Optional[Sequence[Union[StageResult, str, pathlib.Path]]] = None,
+    ) -> str:
+        """Hashes the name, parameters and inputs of a stage
+
+        Parameters
+        ----------
+        name : str
+            name of the stage
+        params : Optional[Dict[str, Any]]
+            JSON serializable parameters of the stage
+        inputs : Optional[Sequence[Union[StageResult, str, pathlib.Path]]]
+            upstream stages and input files
+
+        Returns
+        -------
+        str
+            hexadecimal sha256 digest
+
+        Raises
+        ------
+        TypeError
+            raised if an input is neither a stage result nor a file path
+        """
+        input_keys = []
+        for stage_input in inputs or []:
+            if isinstance(stage_input, StageResult):
+                input_keys.append(f"{stage_input.name}:{stage_input.key}")
+            elif isinstance(stage_input, (str, pathlib.Path)):
+                input_keys.append(file_key(stage_input))
+            else:
+                raise TypeError(
+                    "stage inputs must be stage results or paths "
+                    f"not {type(stage_input)}"
+                )
+
+        content = json.dumps(
+            {"name": name, "params": params or {}, "inputs": input_keys},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def run(
+        self,
+        name: str,
+        stage_fn: Callable[[], Any],
+        params: Optional[Dict[str, Any]] = None,
+        inputs: Optional[Sequence[Union[StageResult, str, pathlib.Path]]] = None,
+    ) -> StageResult:
+        """Returns the cached artefact of a stage, or computes and caches it if the
+        stage parameters or inputs have changed
+
+        Parameters
+        ----------
+        name : str
+            name of the stage
+        stage_fn : Callable[[], Any]
+            function computing the artefact, its result must be picklable
+        params : Optional[Dict[str, Any]]
+            JSON serializable parameters of the stage
+        inputs : Optional[Sequence[Union[StageResult, str, pathlib.Path]]]
+            upstream stages and input files
+
+        Returns
+        -------
+        StageResult
+            artefact of the stage
+        """
+        key = self.key(name, params, inputs)
+        artefact_path = self.cache_dir / f"{name}_{key}.pkl"
+        if artefact_path.is_file():
+            logging.info(f"Stage {name}: reusing cached artefact {key[:12]}")
+            return StageResult(name, key, pd.read_pickle(artefact_path))
+
+        logging.info(f"Stage {name}: computing artefact {key[:12]}")
+        value = stage_fn()
+
+        # writing into a temporary file first, a crash never leaves a partial file
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = artefact_path.with_name(f"{artefact_path.name}.tmp")
+        pd.to_pickle(value, tmp_path)
+        tmp_path.replace(artefact_path)
+
+        return StageResult(name, key, value)
+
+    def stage_dir(
+        self,
+        name: str,
+        params: Optional[Dict[str, Any]] = None,
+        inputs: Optional[Sequence[Union[StageResult, str, pathlib.Path]]] = None,
+    ) -> StageResult:
+        """Returns the directory of a stage that stores its own artefacts. The
+        directory is shared by all the runs with the same parameters and inputs.
+
+        Parameters
+        ----------
+        name : str
+            name of the stage
+        params : Optional[Dict[str, Any]]
+            JSON serializable parameters of the stage
+        inputs : Optional[Sequence[Union[StageResult, str, pathlib.Path]]]
+            upstream stages and input files
+
+        Returns
+        -------
+        StageResult
+            stage result whose value is the (created) directory
+        """
+        key = self.key(name, params, inputs)
+        artefact_dir = self.cache_dir / f"{name}_{key}"
+        artefact_dir.mkdir(parents=True, exist_ok=True)
+
+        return StageResult(name, key, artefact_dir)
@@ -5,13 +5,220 @@ Contains utility functions to import into the analysis
 `split_data()` was develoepd by @roshankern:
 https://github.com/WayScience/mitocheck_data/blob/63f37859d993b8de25fefe1cb8a3aac421c3e08a/utils/load_utils.py#L84
 """
-from typing import Optional
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 
 
-def split_data(pycytominer_output: pd.DataFrame, dataset: str = "CP_and_DP"):
+@dataclass(frozen=True)
+class FeatureSchema:
+    """Column index of a pycytominer output. Stores the integer positions of the
+    metadata, CP and DP columns so the column lists are only built once per
+    dataframe instead of every time the data is split.
+
+    The features are gathered into a single Fortran ordered matrix where the CP
+    features are followed by the DP features. Therefore, the "CP", "DP" and
+    "CP_and_DP" feature spaces are contiguous views of the same matrix.
+
+    Attributes
+    ----------
+    columns : Tuple[str, ...]
+        all column names of the indexed dataframe
+    metadata_idx : np.ndarray
+        positions of the metadata columns
+    cp_idx : np.ndarray
+        positions of the CP feature columns
+    dp_idx : np.ndarray
+        positions of the DP feature columns
+    """
+
+    columns: Tuple[str, ...]
+    metadata_idx: np.ndarray
+    cp_idx: np.ndarray
+    dp_idx: np.ndarray
+
+    @classmethod
+    def from_dataframe(cls, pycytominer_output: pd.DataFrame) -> "FeatureSchema":
+        """Builds the column index of a pycytominer output
+
+        Parameters
+        ----------
+        pycytominer_output : pd.DataFrame
+            dataframe with pycytominer output
+
+        Returns
+        -------
+        FeatureSchema
+            column index of the dataframe
+        """
+        if not isinstance(pycytominer_output, pd.DataFrame):
+            raise TypeError("`pycytominer_output` must be a pandas dataframe")
+
+        all_cols = tuple(pycytominer_output.columns.tolist())
+        return cls(
+            columns=all_cols,
+            metadata_idx=np.array(
+                [idx for idx, col in enumerate(all_cols) if "P__" not in col],
+                dtype=np.intp,
+            ),
+            cp_idx=np.array(
+                [idx for idx, col in enumerate(all_cols) if "CP__" in col],
+                dtype=np.intp,
+            ),
+            dp_idx=np.array(
+                [idx for idx, col in enumerate(all_cols) if "DP__" in col],
+                dtype=np.intp,
+            ),
+        )
+
+    def feature_idx(self, dataset: str = "CP_and_DP") -> np.ndarray:
+        """Returns the positions of the feature columns in the same order as the
+        columns of the feature matrix
+
+        Parameters
+        ----------
+        dataset : str, optional
+            which dataset features to select,
+            can be "CP" or "DP" or by default "CP_and_DP"
+
+        Returns
+        -------
+        np.ndarray
+            positions of the feature columns
+        """
+        if dataset == "CP":
+            return self.cp_idx
+        elif dataset == "DP":
+            return self.dp_idx
+        elif dataset == "CP_and_DP":
+            return np.concatenate([self.cp_idx, self.dp_idx])
+        raise ValueError(f"`dataset` must be 'CP', 'DP' or 'CP_and_DP' not {dataset}")
+
+    def metadata_cols(self) -> List[str]:
+        """Returns the names of the metadata columns"""
+        return [self.columns[idx] for idx in self.metadata_idx]
+
+    def feature_cols(self, dataset: str = "CP_and_DP") -> List[str]:
+        """Returns the names of the feature columns in the same order as the
+        columns of the feature matrix"""
+        return [self.columns[idx] for idx in self.feature_idx(dataset)]
+
+    def feature_matrix(
+        self, pycytominer_output: pd.DataFrame, dtype: np.dtype = np.float64
+    ) -> np.ndarray:
+        """Gathers all feature values into a single Fortran ordered matrix where the
+        CP features are followed by the DP features. This is the only step that
+        copies the feature values.
+
+        Parameters
+        ----------
+        pycytominer_output : pd.DataFrame
+            dataframe with pycytominer output, must have the indexed columns
+        dtype : np.dtype, optional
+            type of the feature matrix, by default np.float64
+
+        Returns
+        -------
+        np.ndarray
+            feature matrix with shape (n_cells, n_cp_features + n_dp_features)
+        """
+        self._check_columns(pycytominer_output)
+
+        n_cp = len(self.cp_idx)
+        feature_mat = np.empty(
+            (pycytominer_output.shape[0], n_cp + len(self.dp_idx)),
+            dtype=dtype,
+            order="F",
+        )
+        feature_mat[:, :n_cp] = pycytominer_output.iloc[:, self.cp_idx].to_numpy(
+            dtype=dtype
+        )
+        feature_mat[:, n_cp:] = pycytominer_output.iloc[:, self.dp_idx].to_numpy(
+            dtype=dtype
+        )
+        return feature_mat
+
+    def feature_view(
+        self, feature_mat: np.ndarray, dataset: str = "CP_and_DP"
+    ) -> np.ndarray:
+        """Selects a feature space from a feature matrix generated with
+        `feature_matrix()` without copying any value
+
+        Parameters
+        ----------
+        feature_mat : np.ndarray
+            feature matrix generated with `feature_matrix()`
+        dataset : str, optional
+            which dataset features to select,
+            can be "CP" or "DP" or by default "CP_and_DP"
+
+        Returns
+        -------
+        np.ndarray
+            contiguous view of the selected feature space
+        """
+        n_cp = len(self.cp_idx)
+        if feature_mat.shape[1] != n_cp + len(self.dp_idx):
+            raise ValueError("`feature_mat` does not match the indexed feature columns")
+
+        if dataset == "CP":
+            return feature_mat[:, :n_cp]
+        elif dataset == "DP":
+            return feature_mat[:, n_cp:]
+        elif dataset == "CP_and_DP":
+            return feature_mat
+        raise ValueError(f"`dataset` must be 'CP', 'DP' or 'CP_and_DP' not {dataset}")
+
+    def split(
+        self,
+        pycytominer_output: pd.DataFrame,
+        dataset: str = "CP_and_DP",
+        feature_mat: Optional[np.ndarray] = None,
+    ) -> Tuple[pd.DataFrame, np.ndarray]:
+        """split pycytominer output to metadata dataframe and np array of feature
+        values using the column index
+
+        Parameters
+        ----------
+        pycytominer_output : pd.DataFrame
+            dataframe with pycytominer output, must have the indexed columns
+        dataset : str, optional
+            which dataset features to split,
+            can be "CP" or "DP" or by default "CP_and_DP"
+        feature_mat : Optional[np.ndarray]
+            feature matrix of `pycytominer_output` generated with
+            `feature_matrix()`. Providing it allows splitting the same dataframe
+            into multiple feature spaces without copying the feature values again.
+
+        Returns
+        -------
+        pd.Dataframe, np.ndarray
+            metadata dataframe, feature values
+        """
+        self._check_columns(pycytominer_output)
+        if feature_mat is None:
+            feature_mat = self.feature_matrix(pycytominer_output)
+
+        metadata_dataframe = pycytominer_output.iloc[:, self.metadata_idx]
+        feature_data = self.feature_view(feature_mat, dataset)
+
+        return metadata_dataframe, feature_data
+
+    def _check_columns(self, pycytominer_output: pd.DataFrame) -> None:
+        """Checks that the dataframe has the same number of columns as the index"""
+        if pycytominer_output.shape[1] != len(self.columns):
+            raise ValueError(
+                "`pycytominer_output` columns do not match the indexed columns"
+            )
+
+
+def split_data(
+    pycytominer_output: pd.DataFrame,
+    dataset: str = "CP_and_DP",
+    schema: Optional[FeatureSchema] = None,
+):
     """
     split pycytominer output to metadata dataframe and np array of feature values
 
@@ -22,6 +229,10 @@ def split_data(pycytominer_output: pd.DataFrame, dataset: str = "CP_and_DP"):
     dataset : str, optional
         which dataset features to split,
         can be "CP" or "DP" or by default "CP_and_DP"
+    schema : Optional[FeatureSchema]
+        precomputed column index of `pycytominer_output`. If provided, the column
+        lists are not rebuilt and the feature values are returned as a view of a
+        feature matrix where CP features are followed by DP features.
 
     Returns
     -------
@@ -31,6 +242,9 @@ def split_data(pycytominer_output: pd.DataFrame, dataset: str = "CP_and_DP"):
     Credit:
         @roshankern: https://github.com/roshankern
     """
+    if schema is not None:
+        return schema.split(pycytominer_output, dataset=dataset)
+
     all_cols = pycytominer_output.columns.tolist()
 
     # get DP,CP, or both features from all columns depending on desired dataset
@@ -82,6 +296,45 @@ def shuffle_by_labels(
     return profile
 
 
+def shuffle_columns(
+    feature_mat: np.ndarray, seed: Optional[int] = 1, inplace: bool = False
+) -> np.ndarray:
+    """Shuffles the values of every column of a feature matrix independently. All
+    columns are permuted in a single vectorised operation.
+
+    Parameters
+    ----------
+    feature_mat : np.ndarray
+        feature matrix with shape (n_cells, n_features)
+    seed : Optional[int]
+        random seed, the same seed always generates the same permutations
+    inplace : bool, optional
+        if True, `feature_mat` is shuffled in place, otherwise a shuffled copy is
+        returned. By default False.
+
+    Returns
+    -------
+    np.ndarray
+        shuffled feature matrix
+
+    Raises
+    ------
+    TypeError
+        raised if a 2D numpy array is not provided
+    """
+    # type checking
+    if not isinstance(feature_mat, np.ndarray):
+        raise TypeError(f"`feature_mat` must be a numpy array not {type(feature_mat)}")
+    if feature_mat.ndim != 2:
+        raise TypeError("`feature_mat` must be a 2D matrix")
+
+    # permuting each column independently
+    rng = np.random.default_rng(seed)
+    if inplace:
+        return rng.permuted(feature_mat, axis=0, out=feature_mat)
+    return rng.permuted(feature_mat, axis=0)
+
+
 def shuffle_feature_space(
     profile: pd.DataFrame, col_idx_split: int, seed=1
 ) -> pd.DataFrame:
@@ -89,8 +342,8 @@ def shuffle_feature_space(
 
     Parameters
     ----------
-    feature_val : pd.DataFrame
-        _description_
+    profile : pd.DataFrame
+        image-based profile with metadata
     col_idx_split : int
         column integer where to split the metadata and extracted features
     seed : Optional[int]
@@ -103,28 +356,18 @@ def shuffle_feature_space(
     """
 
     # type checker
-    if not (profile, pd.DataFrame):
+    if not isinstance(profile, pd.DataFrame):
         raise TypeError(f"`profile` must be a dataframe not {type(profile)}")
 
     # select
     try:
-        feature_vals = profile[profile.columns[col_idx_split:]].astype(float)
+        feature_mat = profile.iloc[:, col_idx_split:].to_numpy(dtype=float, copy=True)
     except Exception:
         raise TypeError("The selected index splitter captures non-numerical data")
 
-    # get metadata
-    metadata = profile[profile.columns[:col_idx_split]]
-
-    # shuffle feature
-    feature_mat = feature_vals.to_numpy()
-    for col in feature_mat.T:
-        np.random.shuffle(col)
-
-    # reconstruct shuffled data
-    feature_shuffled_data = pd.concat(
-        [metadata, pd.DataFrame(data=feature_mat)], axis=1
-    )
-    feature_shuffled_data.columns = profile.columns.tolist()
+    # shuffle feature space and replace the feature values of a copy of the profile
+    shuffle_columns(feature_mat, seed=seed, inplace=True)
+    feature_shuffled_data = profile.copy()
+    feature_shuffled_data.iloc[:, col_idx_split:] = feature_mat
 
-    # concat metadata with shuffled feature space
     return feature_shuffled_data